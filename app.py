@@ -3,29 +3,769 @@
 # Persistência usando SQLite
 # NÃO usar em produção — apenas para desenvolvimento / MVP.
 
-from flask import Flask, request, jsonify
+from flask import (Blueprint, Flask, Response, current_app, g, jsonify, make_response, request,
+                   send_file, stream_with_context)
 from flask_cors import CORS
+import click
 from datetime import datetime
+from decimal import Decimal, DecimalException, InvalidOperation, ROUND_HALF_UP
+import csv
+import io
+import os
 import sqlite3
-from flasgger import Swagger
+import queue
+import threading
+import time
+import atexit
+import base64
+import json
+import functools
+import hashlib
+import zlib
+import bisect
+import logging
+import math
+from collections import OrderedDict
+from contextlib import closing
+import hmac
+import re
+import secrets
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.test import EnvironBuilder
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 
-app = Flask(__name__)
-CORS(app)
-swagger = Swagger(app)
+try:
+    import orjson
+except ImportError:  # opcional: sem orjson, usa o json da biblioteca padrão
+    orjson = None
 
-import os
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Provider JSON do Flask baseado em orjson, que gera bytes diretamente."""
+
+    opcoes = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.opcoes).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        corpo = orjson.dumps(obj, default=self.default, option=self.opcoes)
+        return self._app.response_class(corpo, mimetype=self.mimetype)
+
+
+def escolher_json_provider(nome):
+    """Provider para JSON_ENCODER: "auto" (orjson se instalado), "orjson" ou "stdlib"."""
+    if nome == "stdlib" or (nome == "auto" and orjson is None):
+        return DefaultJSONProvider
+    if nome not in ("auto", "orjson"):
+        raise ValueError(f"JSON_ENCODER inválido: {nome!r}")
+    if orjson is None:
+        raise RuntimeError("JSON_ENCODER=orjson, mas o pacote orjson não está instalado")
+    return OrjsonProvider
+
+
+SWAGGER_TEMPLATE = {
+    "securityDefinitions": {
+        "Bearer": {"type": "apiKey", "name": "Authorization", "in": "header",
+                   "description": "Token de /login no formato: Bearer <token>"},
+    },
+    "security": [{"Bearer": []}],
+}
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_FILE = os.path.join(BASE_DIR, "dados.db")
+DB_FILE = os.environ.get("DB_FILE", os.path.join(BASE_DIR, "dados.db"))
+
+
+def _env_bool(nome, padrao=False):
+    valor = os.environ.get(nome)
+    if valor is None:
+        return padrao
+    return valor.strip().lower() in ("1", "true", "sim", "yes", "on")
+
+
+def configuracao_padrao():
+    """Configuração padrão, lida das variáveis de ambiente."""
+    return dict(
+        DB_FILE=DB_FILE,
+        # Número de arquivos com despesas e metas (0 ou 1 = sem sharding; usuários ficam em DB_FILE)
+        DB_SHARDS=int(os.environ.get("DB_SHARDS", "1")),
+        DB_POOL_SIZE=int(os.environ.get("DB_POOL_SIZE", "8")),
+        DB_POOL_TIMEOUT=float(os.environ.get("DB_POOL_TIMEOUT", "10")),
+        DB_BUSY_TIMEOUT_MS=int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000")),
+        # Modo WAL (opcional): journal WAL, pragmas ajustados e escritor único
+        DB_MODO_WAL=_env_bool("DB_MODO_WAL"),
+        DB_SYNCHRONOUS=os.environ.get("DB_SYNCHRONOUS", "NORMAL"),
+        DB_CACHE_SIZE=int(os.environ.get("DB_CACHE_SIZE", "-20000")),
+        DB_MMAP_SIZE=int(os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024))),
+        DB_TEMP_STORE=os.environ.get("DB_TEMP_STORE", "MEMORY"),
+        DB_ESCRITA_LOTE_MAX=int(os.environ.get("DB_ESCRITA_LOTE_MAX", "256")),
+        DB_ESCRITA_ESPERA_MS=float(os.environ.get("DB_ESCRITA_ESPERA_MS", "2")),
+        # Paginação das listagens
+        PAGINA_PADRAO=int(os.environ.get("PAGINA_PADRAO", "100")),
+        PAGINA_MAX=int(os.environ.get("PAGINA_MAX", "1000")),
+        # Linhas lidas do cursor por vez na exportação
+        EXPORT_LOTE=int(os.environ.get("EXPORT_LOTE", "500")),
+        # Máximo de linhas aceitas por POST /despesas/batch
+        BATCH_MAX_LINHAS=int(os.environ.get("BATCH_MAX_LINHAS", "10000")),
+        # Cache de respostas GET por usuário
+        CACHE_ATIVO=_env_bool("CACHE_ATIVO", True),
+        CACHE_MAX_BYTES=int(os.environ.get("CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+        CACHE_TTL=float(os.environ.get("CACHE_TTL", "60")),
+        # Hash de senhas (formato de método do werkzeug, ex.: "pbkdf2:sha256:600000")
+        SENHA_METODO=os.environ.get("SENHA_METODO", "scrypt:32768:8:1"),
+        SENHA_WORKERS=int(os.environ.get("SENHA_WORKERS", str(min(4, os.cpu_count() or 1)))),
+        SENHA_FILA_MAX=int(os.environ.get("SENHA_FILA_MAX", "64")),
+        SENHA_TIMEOUT=float(os.environ.get("SENHA_TIMEOUT", "10")),
+        # Tokens de sessão assinados (sem SECRET_KEY, os tokens valem só até reiniciar)
+        SECRET_KEY=os.environ.get("SECRET_KEY") or secrets.token_hex(32),
+        TOKEN_VALIDADE=int(os.environ.get("TOKEN_VALIDADE", str(24 * 3600))),
+        AUTH_OBRIGATORIA=_env_bool("AUTH_OBRIGATORIA"),
+        # Identificadores de login inexistentes lembrados por alguns segundos
+        LOGIN_CACHE_NEGATIVO_TTL=float(os.environ.get("LOGIN_CACHE_NEGATIVO_TTL", "30")),
+        LOGIN_CACHE_NEGATIVO_MAX=int(os.environ.get("LOGIN_CACHE_NEGATIVO_MAX", "10000")),
+        # Serializador das respostas: "auto" (orjson se instalado), "orjson" ou "stdlib"
+        JSON_ENCODER=os.environ.get("JSON_ENCODER", "auto"),
+        # Documentação: "dinamico" (flasgger), "estatico" (SWAGGER_SPEC_FILE) ou "desligado"
+        SWAGGER_MODO=os.environ.get("SWAGGER_MODO", "dinamico"),
+        SWAGGER_SPEC_FILE=os.environ.get("SWAGGER_SPEC_FILE", os.path.join(BASE_DIR, "static", "apispec.json")),
+        # Métricas em /metrics e log de consultas lentas (0 = desligado)
+        METRICAS_ATIVAS=_env_bool("METRICAS_ATIVAS", True),
+        SQL_LENTA_MS=float(os.environ.get("SQL_LENTA_MS", "0")),
+        # Máximo de operações por POST /batch
+        LOTE_MAX_OPERACOES=int(os.environ.get("LOTE_MAX_OPERACOES", "50")),
+        # Limite de requisições por usuário, por segundo (0 = sem limite), e rajada tolerada
+        LIMITE_LEITURA_POR_S=float(os.environ.get("LIMITE_LEITURA_POR_S", "0")),
+        LIMITE_LEITURA_RAJADA=float(os.environ.get("LIMITE_LEITURA_RAJADA", "100")),
+        LIMITE_ESCRITA_POR_S=float(os.environ.get("LIMITE_ESCRITA_POR_S", "0")),
+        LIMITE_ESCRITA_RAJADA=float(os.environ.get("LIMITE_ESCRITA_RAJADA", "50")),
+        # Rotas autenticadas em execução ao mesmo tempo (0 = sem teto) e espera por uma vaga
+        CONCORRENCIA_MAX=int(os.environ.get("CONCORRENCIA_MAX", "0")),
+        CONCORRENCIA_ESPERA_MS=float(os.environ.get("CONCORRENCIA_ESPERA_MS", "50")),
+        # Arquivo frio das despesas antigas (vazio = <DB_FILE sem extensão>.arquivo.db), meses
+        # mantidos na tabela despesas e intervalo do arquivamento automático (0 = só pelo comando)
+        ARQUIVO_FILE=os.environ.get("ARQUIVO_FILE", ""),
+        ARQUIVO_HORIZONTE_MESES=int(os.environ.get("ARQUIVO_HORIZONTE_MESES", "24")),
+        ARQUIVO_INTERVALO_S=float(os.environ.get("ARQUIVO_INTERVALO_S", "0")),
+    )
+
+
+# Todas as rotas ficam neste blueprint, registrado por create_app()
+api = Blueprint("api", __name__, cli_group=None)
+
+
+# -------------------------
+# Métricas
+# -------------------------
+BUCKETS_LATENCIA = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DESCRICOES_METRICAS = {
+    "http_requisicoes_total": "Requisições atendidas, por rota, método e status",
+    "http_recusadas_total": "Requisições recusadas pelo controle de admissão, por motivo",
+    "http_requisicao_segundos": "Latência das requisições, por rota e método",
+    "sqlite_consulta_segundos": "Tempo de execução dos statements SQL, por operação",
+    "sqlite_linhas_lidas_total": "Linhas devolvidas por fetchone/fetchmany/fetchall",
+    "sqlite_linhas_alteradas_total": "Linhas alteradas por INSERT/UPDATE/DELETE, por operação",
+    "sqlite_erros_total": "Statements que terminaram com erro do SQLite, por operação",
+    "sqlite_consultas_lentas_total": "Statements acima de SQL_LENTA_MS",
+    "sqlite_pool_espera_segundos": "Espera por uma conexão livre do pool",
+    "sqlite_pool_esgotado_total": "Requisições sem conexão disponível dentro do timeout",
+    "sqlite_pool_tamanho": "Máximo de conexões do pool",
+    "sqlite_pool_conexoes_abertas": "Conexões abertas pelo pool",
+    "sqlite_pool_conexoes_livres": "Conexões abertas aguardando uso",
+    "sqlite_escritor_fila": "Escritas aguardando o escritor único (modo WAL)",
+    "sqlite_escritor_lotes_total": "Transações (group commit) feitas pelo escritor único",
+    "sqlite_escritor_escritas_total": "Escritas executadas pelo escritor único",
+    "cache_respostas_bytes": "Memória ocupada pelo cache de respostas",
+    "cache_respostas_itens": "Respostas guardadas no cache",
+    "cache_respostas_acertos_total": "Leituras atendidas pelo cache",
+    "cache_respostas_falhas_total": "Leituras não encontradas no cache",
+    "senha_hash_em_fila": "Hashes de senha aguardando um worker",
+    "senha_hash_em_execucao": "Hashes de senha em cálculo",
+    "senha_hash_concluidos_total": "Hashes de senha calculados",
+    "senha_hash_rejeitados_total": "Hashes de senha recusados com a fila cheia",
+    "senha_hash_espera_segundos_total": "Tempo somado de espera na fila de hash",
+    "senha_hash_execucao_segundos_total": "Tempo somado de cálculo de hash",
+}
+
+log_sql = logging.getLogger(__name__ + ".sql")
+
+
+def _rotulos_prometheus(rotulos):
+    if not rotulos:
+        return ""
+    pares = []
+    for nome, valor in rotulos:
+        valor = str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pares.append(f'{nome}="{valor}"')
+    return "{" + ",".join(pares) + "}"
+
+
+class Metricas:
+    """
+    Contadores e histogramas em memória, exportados no formato texto do
+    Prometheus. Cada série é identificada pelo nome e pelos rótulos; os
+    histogramas guardam a contagem por faixa de BUCKETS_LATENCIA.
+    """
+
+    def __init__(self, buckets=BUCKETS_LATENCIA):
+        self.buckets = tuple(buckets)
+        self._contadores = {}
+        self._histogramas = {}
+        self._lock = threading.Lock()
+
+    def contar(self, nome, valor=1, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+
+    def observar(self, nome, segundos, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        faixa = bisect.bisect_left(self.buckets, segundos)
+        with self._lock:
+            hist = self._histogramas.get(chave)
+            if hist is None:
+                hist = self._histogramas[chave] = [[0] * (len(self.buckets) + 1), 0.0]
+            hist[0][faixa] += 1
+            hist[1] += segundos
+
+    def exportar(self, medidores=()):
+        """
+        Texto no formato de exposição do Prometheus. `medidores` são tuplas
+        (nome, tipo, valor) lidas no momento da coleta (pool, cache, ...).
+        """
+        with self._lock:
+            contadores = sorted(self._contadores.items())
+            histogramas = sorted((k, (list(v[0]), v[1])) for k, v in self._histogramas.items())
+        linhas = []
+        declarados = set()
+
+        def declarar(nome, tipo):
+            if nome not in declarados:
+                declarados.add(nome)
+                if nome in DESCRICOES_METRICAS:
+                    linhas.append(f"# HELP {nome} {DESCRICOES_METRICAS[nome]}")
+                linhas.append(f"# TYPE {nome} {tipo}")
+
+        for (nome, rotulos), valor in contadores:
+            declarar(nome, "counter")
+            linhas.append(f"{nome}{_rotulos_prometheus(rotulos)} {valor}")
+        limites = [f"{b:g}" for b in self.buckets] + ["+Inf"]
+        for (nome, rotulos), (faixas, soma) in histogramas:
+            declarar(nome, "histogram")
+            acumulado = 0
+            for le, quantidade in zip(limites, faixas):
+                acumulado += quantidade
+                linhas.append(f"{nome}_bucket{_rotulos_prometheus(rotulos + (('le', le),))} {acumulado}")
+            linhas.append(f"{nome}_sum{_rotulos_prometheus(rotulos)} {soma}")
+            linhas.append(f"{nome}_count{_rotulos_prometheus(rotulos)} {acumulado}")
+        for nome, tipo, valor in medidores:
+            declarar(nome, tipo)
+            linhas.append(f"{nome} {valor}")
+        return "\n".join(linhas) + "\n"
+
+
+def _operacao_sql(sql):
+    partes = sql.split(None, 1)
+    return partes[0].upper() if partes else ""
+
+
+class CursorMedido(sqlite3.Cursor):
+    """Cursor que mede cada execute/executemany e conta as linhas lidas."""
+
+    def execute(self, sql, parametros=()):
+        inicio = time.perf_counter()
+        try:
+            super().execute(sql, parametros)
+        except sqlite3.Error:
+            self.connection._registrar(sql, time.perf_counter() - inicio, -1, erro=True)
+            raise
+        self.connection._registrar(sql, time.perf_counter() - inicio, self.rowcount)
+        return self
+
+    def executemany(self, sql, parametros):
+        inicio = time.perf_counter()
+        try:
+            super().executemany(sql, parametros)
+        except sqlite3.Error:
+            self.connection._registrar(sql, time.perf_counter() - inicio, -1, erro=True)
+            raise
+        self.connection._registrar(sql, time.perf_counter() - inicio, self.rowcount)
+        return self
+
+    def fetchone(self):
+        linha = super().fetchone()
+        if linha is not None:
+            self.connection.metricas.contar("sqlite_linhas_lidas_total")
+        return linha
+
+    def fetchmany(self, size=None):
+        linhas = super().fetchmany(self.arraysize if size is None else size)
+        if linhas:
+            self.connection.metricas.contar("sqlite_linhas_lidas_total", len(linhas))
+        return linhas
+
+    def fetchall(self):
+        linhas = super().fetchall()
+        if linhas:
+            self.connection.metricas.contar("sqlite_linhas_lidas_total", len(linhas))
+        return linhas
+
+
+class ConexaoMedida(sqlite3.Connection):
+    """
+    Conexão SQLite que registra o tempo de cada statement em `metricas` e
+    grava no log os que passam de `lenta` segundos (None = sem log).
+    """
+
+    metricas = None
+    lenta = None
+
+    def cursor(self, factory=CursorMedido):
+        return super().cursor(factory)
+
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, parametros):
+        return self.cursor().executemany(sql, parametros)
+
+    def _registrar(self, sql, segundos, alteradas, erro=False):
+        operacao = _operacao_sql(sql)
+        self.metricas.observar("sqlite_consulta_segundos", segundos, operacao=operacao)
+        if erro:
+            self.metricas.contar("sqlite_erros_total", operacao=operacao)
+        elif alteradas > 0:
+            self.metricas.contar("sqlite_linhas_alteradas_total", alteradas, operacao=operacao)
+        if self.lenta is not None and segundos >= self.lenta:
+            self.metricas.contar("sqlite_consultas_lentas_total")
+            log_sql.warning("Consulta lenta (%.1f ms): %s", segundos * 1000, " ".join(sql.split()))
+
+
+def fabrica_conexao(cfg, metricas):
+    """Fábrica para sqlite3.connect: conexões medidas quando há métricas."""
+    if metricas is None:
+        return sqlite3.Connection
+    lenta = cfg["SQL_LENTA_MS"] / 1000 if cfg["SQL_LENTA_MS"] > 0 else None
+
+    def criar(*args, **kwargs):
+        conn = ConexaoMedida(*args, **kwargs)
+        conn.metricas = metricas
+        conn.lenta = lenta
+        return conn
+
+    return criar
+
+
+# -------------------------
+# Pool de conexões
+# -------------------------
+class PoolEsgotado(sqlite3.OperationalError):
+    """Nenhuma conexão livre no pool dentro do tempo limite."""
+
+
+class ConnectionPool:
+    """
+    Pool de conexões SQLite de longa duração compartilhado pelas rotas.
+
+    As conexões são abertas sob demanda até `size`, configuradas com os
+    pragmas uma única vez e devolvidas ao pool no fim do contexto da
+    aplicação. A fila é LIFO para que a conexão mais recente (com cache de
+    páginas e de statements já aquecidos) seja reaproveitada primeiro.
+    """
+
+    def __init__(self, db_file, size, timeout, pragmas=None, fabrica=sqlite3.Connection):
+        self.db_file = db_file
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = dict(pragmas or {})
+        self.fabrica = fabrica
+        self._livres = queue.LifoQueue()
+        self._vagas = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.abertas = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, check_same_thread=False, factory=self.fabrica)
+        for nome, valor in self.pragmas.items():
+            conn.execute(f"PRAGMA {nome}={valor}")
+        with self._lock:
+            self.abertas += 1
+        return conn
+
+    def acquire(self):
+        if not self._vagas.acquire(timeout=self.timeout):
+            raise PoolEsgotado("Nenhuma conexão disponível no pool")
+        try:
+            return self._livres.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except Exception:
+            self._vagas.release()
+            raise
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Conexão em estado inválido: descarta em vez de devolver
+            conn.close()
+            with self._lock:
+                self.abertas -= 1
+        else:
+            self._livres.put(conn)
+        finally:
+            self._vagas.release()
+
+    def close(self):
+        while True:
+            try:
+                conn = self._livres.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self.abertas -= 1
+
+
+class WriteQueue:
+    """
+    Escritor único para o modo WAL.
+
+    Todas as escritas são enfileiradas como funções `fn(conn)` e executadas
+    por uma thread dedicada com conexão própria. Escritas que chegam juntas
+    são agrupadas numa única transação (group commit): cada uma roda dentro
+    de um SAVEPOINT, de modo que a falha de uma não desfaz as demais, e o
+    resultado só é entregue a quem pediu depois do COMMIT.
+    """
+
+    def __init__(self, db_file, pragmas=None, lote_max=256, espera=0.002, fabrica=sqlite3.Connection):
+        self.db_file = db_file
+        self.pragmas = dict(pragmas or {})
+        self.lote_max = lote_max
+        self.espera = espera
+        self.fabrica = fabrica
+        self.lotes = 0
+        self.escritas = 0
+        self._fila = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="sqlite-escritor", daemon=True)
+        self._thread.start()
+
+    def pendentes(self):
+        return self._fila.qsize()
+
+    def submit(self, fn):
+        fut = Future()
+        self._fila.put((fn, fut))
+        return fut
+
+    def close(self):
+        self._fila.put(None)
+        self._thread.join()
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_file, isolation_level=None, check_same_thread=False,
+                               factory=self.fabrica)
+        for nome, valor in self.pragmas.items():
+            conn.execute(f"PRAGMA {nome}={valor}")
+        parar = False
+        while not parar:
+            item = self._fila.get()
+            if item is None:
+                break
+            lote = [item]
+            limite = time.monotonic() + self.espera
+            while len(lote) < self.lote_max:
+                restante = limite - time.monotonic()
+                try:
+                    item = self._fila.get(timeout=restante) if restante > 0 else self._fila.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    parar = True
+                    break
+                lote.append(item)
+            self._executar(conn, lote)
+        conn.close()
+
+    def _executar(self, conn, lote):
+        resultados = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, fut in lote:
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT escrita")
+                try:
+                    resultado = fn(conn)
+                except BaseException as e:
+                    conn.execute("ROLLBACK TO escrita")
+                    conn.execute("RELEASE escrita")
+                    resultados.append((fut, None, e))
+                else:
+                    conn.execute("RELEASE escrita")
+                    resultados.append((fut, resultado, None))
+            conn.execute("COMMIT")
+            self.lotes += 1
+            self.escritas += len(resultados)
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, fut in lote:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for fut, resultado, erro in resultados:
+            if erro is None:
+                fut.set_result(resultado)
+            else:
+                fut.set_exception(erro)
+
+
+def _pragmas(cfg):
+    pragmas = {"busy_timeout": cfg["DB_BUSY_TIMEOUT_MS"]}
+    if cfg["DB_MODO_WAL"]:
+        pragmas.update({
+            # Também em cada conexão: um banco criado sem WAL passa a usá-lo mesmo sem init-db
+            "journal_mode": "WAL",
+            "synchronous": cfg["DB_SYNCHRONOUS"],
+            "cache_size": cfg["DB_CACHE_SIZE"],
+            "mmap_size": cfg["DB_MMAP_SIZE"],
+            "temp_store": cfg["DB_TEMP_STORE"],
+        })
+    return pragmas
+
+
+_recursos_lock = threading.RLock()
+
+
+def recurso(nome, criar):
+    """
+    Objeto compartilhado da aplicação atual (pool, cache, ...), criado na
+    primeira utilização com `criar(config)` e guardado em app.extensions.
+    """
+    recursos = current_app.extensions["mvp"]
+    item = recursos.get(nome)
+    if item is None:
+        with _recursos_lock:
+            item = recursos.get(nome)
+            if item is None:
+                item = recursos[nome] = criar(current_app.config)
+    return item
+
+
+def get_metricas():
+    """Registro de métricas da aplicação, ou None quando desligado."""
+    if not current_app.config["METRICAS_ATIVAS"]:
+        return None
+    return recurso("metricas", lambda cfg: Metricas())
+
+
+def arquivo_shard(db_file, indice):
+    """Arquivo do shard `indice` ("dados.db" -> "dados.shard0.db")."""
+    raiz, ext = os.path.splitext(db_file)
+    return f"{raiz}.shard{indice}{ext or '.db'}"
+
+
+def arquivos_dados(db_file, shards):
+    """Arquivos com despesas e metas: o próprio DB_FILE ou um por shard."""
+    if shards <= 1:
+        return [db_file]
+    return [arquivo_shard(db_file, i) for i in range(shards)]
+
+
+def arquivo_frio(cfg):
+    """Arquivo das despesas arquivadas, comum a todos os shards ("dados.db" -> "dados.arquivo.db")."""
+    if cfg["ARQUIVO_FILE"]:
+        return cfg["ARQUIVO_FILE"]
+    raiz, ext = os.path.splitext(cfg["DB_FILE"])
+    return f"{raiz}.arquivo{ext or '.db'}"
+
+
+def shard_do_usuario(user_id, shards):
+    """Shard de um usuário: hash estável (CRC32) do id, igual em todos os processos."""
+    try:
+        chave = str(int(user_id))
+    except (TypeError, ValueError):
+        chave = str(user_id)
+    return zlib.crc32(chave.encode()) % shards
+
+
+def _nome_recurso(nome, shard):
+    return nome if shard is None else f"{nome}:{shard}"
+
+
+def get_pool(shard=None):
+    """
+    Pool de conexões da aplicação, criado na primeira utilização. Com
+    `shard`, o pool do arquivo daquele shard.
+    """
+    def criar(cfg):
+        return ConnectionPool(
+            cfg["DB_FILE"] if shard is None else arquivo_shard(cfg["DB_FILE"], shard),
+            size=cfg["DB_POOL_SIZE"],
+            timeout=cfg["DB_POOL_TIMEOUT"],
+            pragmas=_pragmas(cfg),
+            fabrica=fabrica_conexao(cfg, get_metricas()),
+        )
+    return recurso(_nome_recurso("pool", shard), criar)
+
+
+def get_pool_arquivo():
+    """Pool de conexões (só leitura) do arquivo frio, usado pelas rotas que leem meses arquivados."""
+    def criar(cfg):
+        return ConnectionPool(
+            arquivo_frio(cfg),
+            size=cfg["DB_POOL_SIZE"],
+            timeout=cfg["DB_POOL_TIMEOUT"],
+            pragmas={"busy_timeout": cfg["DB_BUSY_TIMEOUT_MS"], "query_only": 1},
+            fabrica=fabrica_conexao(cfg, get_metricas()),
+        )
+    return recurso("pool_arquivo", criar)
+
+
+def get_escritor(shard=None):
+    """Escritor único do modo WAL (um por arquivo), ou None quando o modo está desligado."""
+    if not current_app.config["DB_MODO_WAL"]:
+        return None
+
+    def criar(cfg):
+        escritor = WriteQueue(
+            cfg["DB_FILE"] if shard is None else arquivo_shard(cfg["DB_FILE"], shard),
+            pragmas=_pragmas(cfg),
+            lote_max=cfg["DB_ESCRITA_LOTE_MAX"],
+            espera=cfg["DB_ESCRITA_ESPERA_MS"] / 1000,
+            fabrica=fabrica_conexao(cfg, get_metricas()),
+        )
+        atexit.register(escritor.close)
+        return escritor
+    return recurso(_nome_recurso("escritor", shard), criar)
+
+
+def _adquirir(pool):
+    metricas = get_metricas()
+    if metricas is None:
+        return pool.acquire()
+    inicio = time.perf_counter()
+    try:
+        conn = pool.acquire()
+    except PoolEsgotado:
+        metricas.contar("sqlite_pool_esgotado_total")
+        raise
+    metricas.observar("sqlite_pool_espera_segundos", time.perf_counter() - inicio)
+    return conn
+
+
+def get_db():
+    """Conexão do pool vinculada ao contexto da aplicação atual."""
+    if "db" not in g:
+        g.db = _adquirir(get_pool())
+    return _na_transacao_lote(g.db)
+
+
+def _shard_atual(user_id):
+    shards = current_app.config["DB_SHARDS"]
+    return shard_do_usuario(user_id, shards) if shards > 1 else None
+
+
+def get_db_usuario(user_id):
+    """
+    Conexão com as despesas e metas de `user_id`: a mesma de get_db() sem
+    sharding, ou a do shard do usuário (uma por shard por requisição).
+    """
+    shard = _shard_atual(user_id)
+    if shard is None:
+        return get_db()
+    conexoes = g.setdefault("db_shards", {})
+    if shard not in conexoes:
+        conexoes[shard] = _adquirir(get_pool(shard))
+    return _na_transacao_lote(conexoes[shard])
+
+
+def executar_escrita(fn, user_id=None):
+    """
+    Executa `fn(conn)` numa transação de escrita e devolve seu resultado.
+    Com `user_id`, a escrita vai para o arquivo que guarda os dados do usuário.
+
+    No modo WAL a função roda na thread do escritor único; caso contrário,
+    usa a conexão do pool da requisição e faz commit ao final. Dentro de um
+    POST /batch com transação, usa a conexão da requisição e o commit fica
+    para o fim do lote.
+    """
+    shard = None if user_id is None else _shard_atual(user_id)
+    escritor = get_escritor(shard) if g.get("transacao_lote") is None else None
+    if escritor is not None:
+        return escritor.submit(fn).result()
+    with (get_db() if user_id is None else get_db_usuario(user_id)) as conn:
+        return fn(conn)
+
+
+def usuario_existe(user_id):
+    """Consulta no banco principal, onde ficam os usuários mesmo com sharding."""
+    return get_db().execute("SELECT 1 FROM users WHERE id=?", (user_id,)).fetchone() is not None
+
+
+def devolver_db(exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        get_pool().release(conn)
+    for shard, conn in g.pop("db_shards", {}).items():
+        get_pool(shard).release(conn)
 
 
 # -------------------------
 # Inicialização do banco
 # -------------------------
+class LayoutShardsDivergente(RuntimeError):
+    """DB_SHARDS difere da quantidade de shards em que os dados estão gravados."""
+
+
+# Faixa de ids de despesas/metas reservada a cada shard (ids continuam únicos entre
+# arquivos e abaixo de 2^53, seguros em JSON). Ver reservar_ids().
+ESPACO_IDS_SHARD = 10 ** 12
+
+
 def init_db():
-    with sqlite3.connect(DB_FILE) as conn:
+    """Cria/migra o banco principal e, com DB_SHARDS > 1, os arquivos dos shards."""
+    cfg = current_app.config
+    principal = cfg["DB_FILE"]
+    criar_schema(principal, cfg["DB_MODO_WAL"])
+    shards = max(1, cfg["DB_SHARDS"])
+
+    with closing(sqlite3.connect(principal)) as conn:
+        gravados = conn.execute("SELECT quantidade FROM shards").fetchone()[0]
+    if gravados != shards:
+        # Trocar de layout sem dados é só registrar; com dados, é preciso mover as linhas
+        if not layout_vazio(principal, gravados):
+            raise LayoutShardsDivergente(
+                f"Os dados estão em {gravados} shard(s) e DB_SHARDS={shards}. "
+                f"Rode `flask rebalancear-shards --para {shards}` com a aplicação parada.")
+    for caminho in arquivos_dados(principal, shards):
+        if caminho != principal:
+            criar_schema(caminho, cfg["DB_MODO_WAL"])
+    if gravados != shards:
+        if shards > 1:
+            reservar_ids(arquivos_dados(principal, shards), 0)
+        with closing(sqlite3.connect(principal)) as conn, conn:
+            conn.execute("UPDATE shards SET quantidade=?", (shards,))
+
+
+def criar_schema(caminho, wal=False):
+    """Cria as tabelas e aplica as migrações pendentes em um arquivo."""
+    with sqlite3.connect(caminho) as conn:
         c = conn.cursor()
 
+        if wal:
+            c.execute("PRAGMA journal_mode=WAL")
+
         # Tabela de usuários
         c.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -62,12 +802,1530 @@ def init_db():
             )
         ''')
 
-init_db()
+        # Migrações incrementais (controladas por PRAGMA user_version)
+        versao = c.execute("PRAGMA user_version").fetchone()[0]
+        for numero, migracao in enumerate(MIGRACOES[versao:], start=versao + 1):
+            migracao(c)
+            c.execute(f"PRAGMA user_version={numero}")
+
+
+def _migracao_indice_despesas_data(c):
+    # Datas antigas podem ter sido gravadas sem zero à esquerda ("2025-9-1");
+    # normaliza para que a comparação de intervalo em texto funcione.
+    c.execute("""
+        SELECT id, data FROM despesas
+        WHERE data NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+    """)
+    for despesa_id, data_str in c.fetchall():
+        try:
+            normalizada = datetime.strptime(data_str, "%Y-%m-%d").date().isoformat()
+        except ValueError:
+            continue
+        c.execute("UPDATE despesas SET data=? WHERE id=?", (normalizada, despesa_id))
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_despesas_user_data ON despesas(user_id, data)")
+
+
+def _migracao_indice_despesas_user(c):
+    # Atende a listagem paginada por id (rowid em ordem dentro de cada usuário)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_despesas_user ON despesas(user_id)")
+
+
+def _migracao_totais_mensais(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS despesas_mensal (
+            user_id INTEGER NOT NULL,
+            ano INTEGER NOT NULL,
+            mes INTEGER NOT NULL,
+            total REAL NOT NULL,
+            quantidade INTEGER NOT NULL,
+            minimo REAL NOT NULL,
+            maximo REAL NOT NULL,
+            PRIMARY KEY (user_id, ano, mes)
+        ) WITHOUT ROWID
+    """)
+    c.execute("""
+        INSERT INTO despesas_mensal (user_id, ano, mes, total, quantidade, minimo, maximo)
+        SELECT user_id,
+               CAST(substr(data, 1, 4) AS INTEGER),
+               CAST(substr(data, 6, 2) AS INTEGER),
+               SUM(valor), COUNT(*), MIN(valor), MAX(valor)
+        FROM despesas
+        GROUP BY user_id, substr(data, 1, 7)
+    """)
+
+
+def _migracao_normalizar_usuarios(c):
+    # O login passa a buscar e-mail em minúsculas e CPF só com dígitos.
+    # Linhas que colidiriam com outro usuário já normalizado ficam como estão.
+    c.execute("UPDATE OR IGNORE users SET email = lower(trim(email)) WHERE email != lower(trim(email))")
+    c.execute("""
+        UPDATE OR IGNORE users
+        SET cpf = replace(replace(replace(replace(cpf, '.', ''), '-', ''), ' ', ''), '/', '')
+        WHERE cpf GLOB '*[^0-9]*'
+    """)
+
+
+def _migracao_registro_shards(c):
+    # Quantidade de shards em que despesas e metas estão gravadas (1 = só DB_FILE)
+    c.execute("CREATE TABLE IF NOT EXISTS shards (quantidade INTEGER NOT NULL)")
+    c.execute("INSERT INTO shards (quantidade) VALUES (1)")
+
+
+def _migracao_centavos_e_datas(c):
+    # Valores passam a ser centavos inteiros (somas exatas) e datas um inteiro
+    # AAAAMMDD (comparação de intervalo sem texto). ALTER TABLE preserva ids e
+    # sqlite_sequence, de que dependem as faixas de ids dos shards.
+    c.execute("DROP INDEX IF EXISTS idx_despesas_user_data")
+    c.execute("ALTER TABLE despesas ADD COLUMN valor_centavos INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE despesas ADD COLUMN data_num INTEGER NOT NULL DEFAULT 0")
+    c.execute("""
+        UPDATE despesas SET valor_centavos = CAST(round(valor * 100) AS INTEGER),
+                            data_num = CAST(replace(data, '-', '') AS INTEGER)
+    """)
+    c.execute("ALTER TABLE despesas DROP COLUMN valor")
+    c.execute("ALTER TABLE despesas DROP COLUMN data")
+    c.execute("CREATE INDEX idx_despesas_user_data ON despesas(user_id, data_num)")
+
+    c.execute("ALTER TABLE metas ADD COLUMN valor_centavos INTEGER NOT NULL DEFAULT 0")
+    c.execute("UPDATE metas SET valor_centavos = CAST(round(valor * 100) AS INTEGER)")
+    c.execute("ALTER TABLE metas DROP COLUMN valor")
+
+    c.execute("DROP TABLE despesas_mensal")
+    c.execute("""
+        CREATE TABLE despesas_mensal (
+            user_id INTEGER NOT NULL,
+            ano INTEGER NOT NULL,
+            mes INTEGER NOT NULL,
+            total_centavos INTEGER NOT NULL,
+            quantidade INTEGER NOT NULL,
+            minimo_centavos INTEGER NOT NULL,
+            maximo_centavos INTEGER NOT NULL,
+            PRIMARY KEY (user_id, ano, mes)
+        ) WITHOUT ROWID
+    """)
+    c.execute("""
+        INSERT INTO despesas_mensal (user_id, ano, mes, total_centavos, quantidade, minimo_centavos, maximo_centavos)
+        SELECT user_id, data_num / 10000, data_num / 100 % 100,
+               SUM(valor_centavos), COUNT(*), MIN(valor_centavos), MAX(valor_centavos)
+        FROM despesas
+        GROUP BY user_id, data_num / 100
+    """)
+
+
+def _migracao_busca_descricoes(c):
+    # Índice de texto (FTS5) das descrições. external content: o texto fica só
+    # em despesas; os gatilhos mantêm o índice na mesma transação das escritas.
+    c.execute("""
+        CREATE VIRTUAL TABLE despesas_busca USING fts5(
+            descricao, content='despesas', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    c.execute("""
+        CREATE TRIGGER despesas_busca_ai AFTER INSERT ON despesas BEGIN
+            INSERT INTO despesas_busca (rowid, descricao) VALUES (new.id, new.descricao);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER despesas_busca_ad AFTER DELETE ON despesas BEGIN
+            INSERT INTO despesas_busca (despesas_busca, rowid, descricao) VALUES ('delete', old.id, old.descricao);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER despesas_busca_au AFTER UPDATE OF descricao ON despesas BEGIN
+            INSERT INTO despesas_busca (despesas_busca, rowid, descricao) VALUES ('delete', old.id, old.descricao);
+            INSERT INTO despesas_busca (rowid, descricao) VALUES (new.id, new.descricao);
+        END
+    """)
+    c.execute("INSERT INTO despesas_busca (despesas_busca) VALUES ('rebuild')")
+
+
+def _migracao_versoes_sync(c):
+    # Versão de alteração para GET /sync: um contador por arquivo, incrementado
+    # por gatilhos a cada inclusão, alteração ou remoção em despesas e metas.
+    # Remoções deixam um registro em `remocoes`. Linhas existentes ficam na versão 1.
+    c.execute("CREATE TABLE sync_versao (valor INTEGER NOT NULL)")
+    c.execute("INSERT INTO sync_versao (valor) VALUES (1)")
+    c.execute("""
+        CREATE TABLE remocoes (
+            tabela TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            versao INTEGER NOT NULL,
+            PRIMARY KEY (tabela, id)
+        ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX idx_remocoes_user_versao ON remocoes(user_id, versao)")
+    for tabela, colunas in (("despesas", "descricao, valor_centavos, data_num"),
+                            ("metas", "valor_centavos")):
+        c.execute(f"ALTER TABLE {tabela} ADD COLUMN versao INTEGER NOT NULL DEFAULT 0")
+        c.execute(f"UPDATE {tabela} SET versao = 1")
+        c.execute(f"CREATE INDEX idx_{tabela}_user_versao ON {tabela}(user_id, versao)")
+        c.execute(f"""
+            CREATE TRIGGER {tabela}_versao_ai AFTER INSERT ON {tabela} BEGIN
+                UPDATE sync_versao SET valor = valor + 1;
+                UPDATE {tabela} SET versao = (SELECT valor FROM sync_versao) WHERE id = new.id;
+                DELETE FROM remocoes WHERE tabela = '{tabela}' AND id = new.id;
+            END
+        """)
+        c.execute(f"""
+            CREATE TRIGGER {tabela}_versao_au AFTER UPDATE OF {colunas} ON {tabela} BEGIN
+                UPDATE sync_versao SET valor = valor + 1;
+                UPDATE {tabela} SET versao = (SELECT valor FROM sync_versao) WHERE id = new.id;
+            END
+        """)
+        c.execute(f"""
+            CREATE TRIGGER {tabela}_versao_ad AFTER DELETE ON {tabela} BEGIN
+                UPDATE sync_versao SET valor = valor + 1;
+                INSERT OR REPLACE INTO remocoes (tabela, id, user_id, versao)
+                VALUES ('{tabela}', old.id, old.user_id, (SELECT valor FROM sync_versao));
+            END
+        """)
+
+
+def _migracao_meses_arquivados(c):
+    # Meses cujas despesas foram movidas para o arquivo frio (ver arquivar_despesas):
+    # agregados para os totais mensais, faixas de id/versão para achar as linhas e a
+    # geração do blob vigente no arquivo frio. As descrições arquivadas continuam
+    # pesquisáveis num índice FTS5 próprio, separado da tabela despesas.
+    c.execute("""
+        CREATE TABLE meses_arquivados (
+            user_id INTEGER NOT NULL,
+            ano INTEGER NOT NULL,
+            mes INTEGER NOT NULL,
+            quantidade INTEGER NOT NULL,
+            total_centavos INTEGER NOT NULL,
+            minimo_centavos INTEGER NOT NULL,
+            maximo_centavos INTEGER NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            max_versao INTEGER NOT NULL,
+            geracao INTEGER NOT NULL,
+            PRIMARY KEY (user_id, ano, mes)
+        ) WITHOUT ROWID
+    """)
+    c.execute("""
+        CREATE VIRTUAL TABLE despesas_busca_arquivo USING fts5(
+            descricao, user_id UNINDEXED, valor_centavos UNINDEXED, data_num UNINDEXED,
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+
+
+def _migracao_busca_por_usuario(c):
+    # Os índices de busca ganham a coluna indexada `dono` ("u<user_id>"): a busca
+    # casa `dono:"u<id>" AND descricao:(...)` e o FTS5 só percorre e ordena as
+    # despesas do usuário, em vez de todas as que têm o termo. O índice da tabela
+    # continua external content, lendo de uma view com a coluna calculada.
+    for gatilho in ("ai", "ad", "au"):
+        c.execute(f"DROP TRIGGER despesas_busca_{gatilho}")
+    c.execute("DROP TABLE despesas_busca")
+    c.execute("CREATE VIEW despesas_busca_fonte AS SELECT id, 'u' || user_id AS dono, descricao FROM despesas")
+    c.execute("""
+        CREATE VIRTUAL TABLE despesas_busca USING fts5(
+            dono, descricao, content='despesas_busca_fonte', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3 4'
+        )
+    """)
+    c.execute("""
+        CREATE TRIGGER despesas_busca_ai AFTER INSERT ON despesas BEGIN
+            INSERT INTO despesas_busca (rowid, dono, descricao) VALUES (new.id, 'u' || new.user_id, new.descricao);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER despesas_busca_ad AFTER DELETE ON despesas BEGIN
+            INSERT INTO despesas_busca (despesas_busca, rowid, dono, descricao)
+            VALUES ('delete', old.id, 'u' || old.user_id, old.descricao);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER despesas_busca_au AFTER UPDATE OF descricao ON despesas BEGIN
+            INSERT INTO despesas_busca (despesas_busca, rowid, dono, descricao)
+            VALUES ('delete', old.id, 'u' || old.user_id, old.descricao);
+            INSERT INTO despesas_busca (rowid, dono, descricao) VALUES (new.id, 'u' || new.user_id, new.descricao);
+        END
+    """)
+    c.execute("INSERT INTO despesas_busca (despesas_busca) VALUES ('rebuild')")
+
+    c.execute("ALTER TABLE despesas_busca_arquivo RENAME TO despesas_busca_arquivo_antiga")
+    c.execute("""
+        CREATE VIRTUAL TABLE despesas_busca_arquivo USING fts5(
+            dono, descricao, user_id UNINDEXED, valor_centavos UNINDEXED, data_num UNINDEXED,
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3 4'
+        )
+    """)
+    c.execute("""
+        INSERT INTO despesas_busca_arquivo (rowid, dono, descricao, user_id, valor_centavos, data_num)
+        SELECT rowid, 'u' || user_id, descricao, user_id, valor_centavos, data_num FROM despesas_busca_arquivo_antiga
+    """)
+    c.execute("DROP TABLE despesas_busca_arquivo_antiga")
+    # A coluna dono não pesa na relevância
+    for tabela in ("despesas_busca", "despesas_busca_arquivo"):
+        c.execute(f"INSERT INTO {tabela} ({tabela}, rank) VALUES ('rank', 'bm25(0.0, 1.0)')")
+
+
+# Cada item é aplicado uma única vez, na ordem, a partir do user_version atual
+MIGRACOES = [
+    _migracao_indice_despesas_data,
+    _migracao_indice_despesas_user,
+    _migracao_totais_mensais,
+    _migracao_normalizar_usuarios,
+    _migracao_registro_shards,
+    _migracao_centavos_e_datas,
+    _migracao_busca_descricoes,
+    _migracao_versoes_sync,
+    _migracao_meses_arquivados,
+    _migracao_busca_por_usuario,
+]
+
+
+# -------------------------
+# Valores e datas
+# -------------------------
+# No banco, valores são centavos inteiros e datas são inteiros AAAAMMDD. A API
+# continua recebendo e devolvendo números decimais e texto YYYY-MM-DD.
+SQL_VALOR = "valor_centavos / 100.0"
+SQL_DATA = "printf('%04d-%02d-%02d', data_num / 10000, data_num / 100 % 100, data_num % 100)"
+
+
+# Maior valor aceito, em centavos (R$ 100 bilhões): cabe no INTEGER do SQLite com
+# folga para as somas dos totais mensais
+CENTAVOS_MAX = 10 ** 13
+
+
+def para_centavos(valor):
+    """Converte um valor decimal (número ou texto) em centavos inteiros (ValueError se inválido)."""
+    try:
+        centavos = int(Decimal(str(valor)).quantize(Decimal("0.01"), ROUND_HALF_UP) * 100)
+    except (InvalidOperation, ValueError, TypeError, OverflowError):
+        raise ValueError(f"Valor inválido: {valor!r}")
+    if abs(centavos) > CENTAVOS_MAX:
+        raise ValueError(f"Valor fora do intervalo aceito: {valor!r}")
+    return centavos
+
+
+def de_centavos(centavos):
+    return None if centavos is None else centavos / 100
+
+
+def data_para_num(data):
+    """date/datetime -> AAAAMMDD."""
+    return data.year * 10000 + data.month * 100 + data.day
+
+
+def num_para_data(data_num):
+    """AAAAMMDD -> texto YYYY-MM-DD."""
+    return f"{data_num // 10000:04d}-{data_num // 100 % 100:02d}-{data_num % 100:02d}"
+
+
+def ano_mes(data_num):
+    """AAAAMMDD -> (ano, mes)."""
+    return divmod(data_num // 100, 100)
+
+
+def intervalo_mes(ano, mes):
+    """Limites [inicio, fim) de um mês como inteiros AAAAMMDD."""
+    inicio = ano * 10000 + mes * 100
+    if mes == 12:
+        fim = (ano + 1) * 10000 + 100
+    else:
+        fim = inicio + 100
+    return inicio, fim
+
+# -------------------------
+# Totais mensais
+# -------------------------
+# despesas_mensal guarda soma, quantidade, mínimo e máximo por
+# (user_id, ano, mes). É mantida na mesma transação pelas rotas de escrita:
+# inserções somam incrementalmente; alterações e remoções recalculam só o
+# mês afetado (mínimo/máximo não podem ser desfeitos de forma incremental).
+def reconstruir_totais(c):
+    """Recalcula despesas_mensal inteira a partir de despesas e dos meses arquivados."""
+    c.execute("DELETE FROM despesas_mensal")
+    c.execute("""
+        INSERT INTO despesas_mensal (user_id, ano, mes, total_centavos, quantidade, minimo_centavos, maximo_centavos)
+        SELECT user_id, ano, mes, SUM(total), SUM(quantidade), MIN(minimo), MAX(maximo) FROM (
+            SELECT user_id, data_num / 10000 AS ano, data_num / 100 % 100 AS mes,
+                   SUM(valor_centavos) AS total, COUNT(*) AS quantidade,
+                   MIN(valor_centavos) AS minimo, MAX(valor_centavos) AS maximo
+            FROM despesas
+            GROUP BY user_id, data_num / 100
+            UNION ALL
+            SELECT user_id, ano, mes, total_centavos, quantidade, minimo_centavos, maximo_centavos
+            FROM meses_arquivados
+        )
+        GROUP BY user_id, ano, mes
+    """)
+
+
+def somar_totais(c, linhas):
+    """Acrescenta aos totais mensais as linhas (user_id, descricao, centavos, data_num) inseridas."""
+    meses = {}
+    for user_id, _, centavos, data_num in linhas:
+        chave = (user_id, *ano_mes(data_num))
+        atual = meses.get(chave)
+        if atual is None:
+            meses[chave] = [centavos, 1, centavos, centavos]
+        else:
+            atual[0] += centavos
+            atual[1] += 1
+            atual[2] = min(atual[2], centavos)
+            atual[3] = max(atual[3], centavos)
+    c.executemany("""
+        INSERT INTO despesas_mensal (user_id, ano, mes, total_centavos, quantidade, minimo_centavos, maximo_centavos)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, ano, mes) DO UPDATE SET
+            total_centavos = total_centavos + excluded.total_centavos,
+            quantidade = quantidade + excluded.quantidade,
+            minimo_centavos = MIN(minimo_centavos, excluded.minimo_centavos),
+            maximo_centavos = MAX(maximo_centavos, excluded.maximo_centavos)
+    """, [(*chave, *agregado) for chave, agregado in meses.items()])
+
+
+def recalcular_total_mes(c, user_id, data_num):
+    """
+    Recalcula o total do mês de `data_num` (AAAAMMDD) a partir das despesas
+    do usuário, somando as do mesmo mês que estejam arquivadas.
+    """
+    ano, mes = ano_mes(data_num)
+    inicio, fim = intervalo_mes(ano, mes)
+    c.execute("""
+        SELECT SUM(total), SUM(quantidade), MIN(minimo), MAX(maximo) FROM (
+            SELECT SUM(valor_centavos) AS total, COUNT(*) AS quantidade,
+                   MIN(valor_centavos) AS minimo, MAX(valor_centavos) AS maximo
+            FROM despesas
+            WHERE user_id=? AND data_num >= ? AND data_num < ?
+            UNION ALL
+            SELECT total_centavos, quantidade, minimo_centavos, maximo_centavos FROM meses_arquivados
+            WHERE user_id=? AND ano=? AND mes=?
+        )
+    """, (user_id, inicio, fim, user_id, ano, mes))
+    total, quantidade, minimo, maximo = c.fetchone()
+    if quantidade:
+        c.execute("""
+            INSERT OR REPLACE INTO despesas_mensal
+                (user_id, ano, mes, total_centavos, quantidade, minimo_centavos, maximo_centavos)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, ano, mes, total, quantidade, minimo, maximo))
+    else:
+        c.execute("DELETE FROM despesas_mensal WHERE user_id=? AND ano=? AND mes=?", (user_id, ano, mes))
+
+
+@api.cli.command("reconstruir-totais")
+def reconstruir_totais_comando():
+    """Recalcula a tabela de totais mensais a partir das despesas."""
+    for caminho in arquivos_dados(current_app.config["DB_FILE"], current_app.config["DB_SHARDS"]):
+        with sqlite3.connect(caminho) as conn:
+            reconstruir_totais(conn.cursor())
+    print("Totais mensais reconstruídos.")
+
+
+@api.cli.command("init-db")
+def init_db_comando():
+    """Cria o schema e aplica as migrações pendentes em DB_FILE."""
+    init_db()
+    print(f"Banco inicializado em {current_app.config['DB_FILE']}.")
+
+
+# -------------------------
+# Shards
+# -------------------------
+TABELAS_POR_USUARIO = ("despesas", "metas", "despesas_mensal", "remocoes", "meses_arquivados",
+                       "despesas_busca_arquivo")
+
+
+def layout_vazio(principal, shards):
+    """True se nenhum arquivo do layout atual tem despesas ou metas."""
+    for caminho in arquivos_dados(principal, shards):
+        if not os.path.exists(caminho):
+            continue
+        with closing(sqlite3.connect(caminho)) as conn:
+            if conn.execute("SELECT EXISTS(SELECT 1 FROM despesas) OR EXISTS(SELECT 1 FROM metas)").fetchone()[0]:
+                return False
+    return True
+
+
+def reservar_ids(caminhos, maior_id):
+    """
+    Dá a cada arquivo uma faixa própria de ids (AUTOINCREMENT) acima de
+    `maior_id`, de modo que despesas e metas criadas em shards diferentes
+    nunca repitam id e possam ser movidas entre shards depois.
+    """
+    inicio = (maior_id // ESPACO_IDS_SHARD + 1) * ESPACO_IDS_SHARD
+    for indice, caminho in enumerate(caminhos):
+        with closing(sqlite3.connect(caminho)) as conn, conn:
+            for tabela in ("despesas", "metas"):
+                conn.execute("DELETE FROM sqlite_sequence WHERE name=?", (tabela,))
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+                             (tabela, inicio + indice * ESPACO_IDS_SHARD))
+
+
+def rebalancear_shards(destino):
+    """
+    Move despesas e metas do layout gravado para `destino` shards (1 = só
+    DB_FILE). Offline: a aplicação precisa estar parada. Os arquivos antigos
+    são mantidos com sufixo ".antigo"; os totais mensais são recalculados.
+    Devolve a quantidade de linhas movidas por tabela.
+    """
+    cfg = current_app.config
+    principal = cfg["DB_FILE"]
+    destino = max(1, destino)
+    criar_schema(principal, cfg["DB_MODO_WAL"])
+    with closing(sqlite3.connect(principal)) as conn:
+        origem = conn.execute("SELECT quantidade FROM shards").fetchone()[0]
+    movidas = {"despesas": 0, "metas": 0}
+    if origem == destino:
+        return movidas
+
+    arquivos_origem = arquivos_dados(principal, origem)
+    arquivos_destino = arquivos_dados(principal, destino)
+    # Shards novos são montados em ".novo" e só substituem os atuais no fim
+    temporarios = [c if c == principal else c + ".novo" for c in arquivos_destino]
+    for caminho in temporarios:
+        if caminho != principal:
+            if os.path.exists(caminho):
+                os.remove(caminho)
+            criar_schema(caminho, cfg["DB_MODO_WAL"])
+
+    maior_id = maior_versao = 0
+    for caminho in arquivos_origem:
+        with closing(sqlite3.connect(caminho)) as conn:
+            # Inclui ids já usados e apagados, para que não voltem a ser atribuídos
+            maior_id = max(maior_id, conn.execute(
+                "SELECT coalesce(max(seq), 0) FROM sqlite_sequence WHERE name IN ('despesas', 'metas')"
+            ).fetchone()[0])
+            maior_versao = max(maior_versao, conn.execute("SELECT valor FROM sync_versao").fetchone()[0])
+    # As linhas copiadas ganham versões acima de todas as já vistas pelos clientes
+    # de GET /sync, que assim recebem de novo os dados que mudaram de arquivo
+    for caminho in temporarios:
+        with closing(sqlite3.connect(caminho)) as conn, conn:
+            conn.execute("UPDATE sync_versao SET valor = max(valor, ?)", (maior_versao,))
+    if destino > 1:
+        reservar_ids(temporarios, maior_id)
+    else:
+        with closing(sqlite3.connect(principal)) as conn, conn:
+            conn.execute("UPDATE sqlite_sequence SET seq=max(seq, ?) WHERE name IN ('despesas', 'metas')",
+                         (maior_id,))
+
+    for caminho in arquivos_origem:
+        with closing(sqlite3.connect(caminho)) as conn:
+            conn.create_function("shard_do_usuario", 1, lambda u: shard_do_usuario(u, destino),
+                                 deterministic=True)
+            for indice, alvo in enumerate(temporarios):
+                if alvo == caminho:
+                    continue
+                conn.execute("ATTACH DATABASE ? AS alvo", (alvo,))
+                with conn:
+                    for tabela in ("despesas", "metas"):
+                        movidas[tabela] += conn.execute(
+                            f"INSERT INTO alvo.{tabela} SELECT * FROM main.{tabela} WHERE shard_do_usuario(user_id)=?",
+                            (indice,)).rowcount
+                    conn.execute("INSERT OR IGNORE INTO alvo.remocoes SELECT * FROM main.remocoes "
+                                 "WHERE shard_do_usuario(user_id)=?", (indice,))
+                    # As linhas arquivadas ficam no arquivo frio, comum a todos os shards
+                    conn.execute("INSERT INTO alvo.meses_arquivados SELECT * FROM main.meses_arquivados "
+                                 "WHERE shard_do_usuario(user_id)=?", (indice,))
+                    conn.execute("""
+                        INSERT INTO alvo.despesas_busca_arquivo
+                            (rowid, dono, descricao, user_id, valor_centavos, data_num)
+                        SELECT rowid, dono, descricao, user_id, valor_centavos, data_num
+                        FROM main.despesas_busca_arquivo
+                        WHERE shard_do_usuario(user_id)=?
+                    """, (indice,))
+                conn.execute("DETACH DATABASE alvo")
+
+    for caminho in temporarios:
+        with closing(sqlite3.connect(caminho)) as conn, conn:
+            reconstruir_totais(conn.cursor())
+
+    # Troca: o principal perde as linhas que saíram dele; os shards antigos viram ".antigo"
+    if origem == 1:
+        if os.path.exists(principal + ".antigo"):
+            os.remove(principal + ".antigo")
+        with closing(sqlite3.connect(principal)) as conn:
+            conn.execute("VACUUM INTO ?", (principal + ".antigo",))
+            with conn:
+                for tabela in TABELAS_POR_USUARIO:
+                    conn.execute(f"DELETE FROM {tabela}")
+    for caminho in arquivos_origem:
+        if caminho != principal:
+            os.replace(caminho, caminho + ".antigo")
+    for caminho, final in zip(temporarios, arquivos_destino):
+        if caminho != final:
+            os.replace(caminho, final)
+    with closing(sqlite3.connect(principal)) as conn, conn:
+        conn.execute("UPDATE shards SET quantidade=?", (destino,))
+    return movidas
+
+
+@api.cli.command("rebalancear-shards")
+@click.option("--para", "destino", type=int, required=True, help="Quantidade de shards (1 = só DB_FILE)")
+def rebalancear_shards_comando(destino):
+    """Redistribui despesas e metas entre shards (com a aplicação parada)."""
+    movidas = rebalancear_shards(destino)
+    print(f"Movidas {movidas['despesas']} despesas e {movidas['metas']} metas. "
+          f"Use DB_SHARDS={max(1, destino)} ao iniciar a aplicação.")
+
+# -------------------------
+# Arquivo de despesas antigas
+# -------------------------
+# Despesas de meses anteriores ao horizonte (ARQUIVO_HORIZONTE_MESES) saem da
+# tabela despesas e vão para um arquivo SQLite separado (arquivo_frio), uma
+# linha por (usuário, mês, geração) com as despesas em JSON compactado por
+# zlib. No arquivo dos dados ficam meses_arquivados, com os agregados do mês e
+# a geração vigente do blob, e despesas_busca_arquivo, o índice FTS5 das
+# descrições arquivadas. Assim a tabela despesas e seus índices ficam pequenos
+# e cabem no cache de páginas.
+#
+# O arquivamento é feito mês a mês: o blob novo é gravado com uma geração
+# nova antes de tomar o lock de escrita, que só cobre a troca das linhas da
+# tabela pela geração nova. Blobs de gerações não referenciadas (execução
+# interrompida, mês restaurado) são apagados depois de ORFAOS_APOS_S.
+#
+# As leituras juntam as linhas arquivadas às da tabela sob demanda (ver
+# fonte_despesas); despesas incluídas depois num mês arquivado ficam na tabela
+# e entram no arquivo na próxima execução. Alterar ou remover uma despesa
+# arquivada devolve o mês inteiro à tabela (restaurar_se_arquivada).
+
+ORFAOS_APOS_S = 3600
+
+# Linhas arquivadas como tabela: parâmetros (user_id, JSON descompactado). Uma
+# linha que também esteja na tabela despesas prevalece sobre a do arquivo.
+SQL_ARQUIVADAS = """
+    SELECT json_extract(value, '$[0]') AS id, ? AS user_id, json_extract(value, '$[1]') AS descricao,
+           json_extract(value, '$[2]') AS valor_centavos, json_extract(value, '$[3]') AS data_num,
+           json_extract(value, '$[4]') AS versao
+    FROM json_each(?)
+    WHERE json_extract(value, '$[0]') NOT IN (SELECT id FROM despesas)
+"""
+
+
+def criar_schema_arquivo(caminho, wal=False):
+    """Cria a tabela do arquivo frio: uma linha por (usuário, mês, geração), com as despesas compactadas."""
+    with closing(sqlite3.connect(caminho)) as conn, conn:
+        if wal:
+            conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS despesas_arquivadas (
+                user_id INTEGER NOT NULL,
+                ano INTEGER NOT NULL,
+                mes INTEGER NOT NULL,
+                geracao INTEGER NOT NULL,
+                quantidade INTEGER NOT NULL,
+                criado_em REAL NOT NULL,
+                linhas BLOB NOT NULL,
+                PRIMARY KEY (user_id, ano, mes, geracao)
+            ) WITHOUT ROWID
+        """)
+
+
+def compactar_linhas(linhas):
+    """[[id, descricao, centavos, data_num, versao], ...] -> JSON compactado."""
+    return zlib.compress(json.dumps(linhas, ensure_ascii=False, separators=(",", ":")).encode())
+
+
+def descompactar_linhas(blob):
+    return zlib.decompress(blob).decode()
+
+
+def ler_blob_mes(frio, user_id, ano, mes, geracao):
+    """JSON descompactado das linhas de um mês arquivado ("[]" se o blob não existe)."""
+    row = frio.execute("SELECT linhas FROM despesas_arquivadas WHERE user_id=? AND ano=? AND mes=? AND geracao=?",
+                       (user_id, ano, mes, geracao)).fetchone()
+    return descompactar_linhas(row[0]) if row else "[]"
+
+
+def limite_horizonte(horizonte_meses, hoje=None):
+    """Primeiro dia (AAAAMMDD) do mês mais antigo mantido na tabela despesas."""
+    hoje = hoje or datetime.now()
+    indice = hoje.year * 12 + hoje.month - 1 - max(0, horizonte_meses)
+    return data_para_num(datetime(indice // 12, indice % 12 + 1, 1))
+
+
+def _arquivar_mes(quente, frio, user_id, ano, mes):
+    """
+    Arquiva um mês do usuário. Leitura e compactação correm sem lock; o lock
+    de escrita do arquivo de dados só cobre a troca, feita se o mês não mudou
+    desde a leitura. Devolve quantas despesas saíram da tabela (0 se o mês
+    mudou e ficou para a próxima execução).
+    """
+    inicio, fim = intervalo_mes(ano, mes)
+    filtro = "user_id=? AND data_num >= ? AND data_num < ?"
+    novas = [list(linha) for linha in quente.execute(f"""
+        SELECT id, descricao, valor_centavos, data_num, versao FROM despesas
+        WHERE {filtro} ORDER BY data_num, id
+    """, (user_id, inicio, fim))]
+    if not novas:
+        return 0
+    row = quente.execute("SELECT geracao FROM meses_arquivados WHERE user_id=? AND ano=? AND mes=?",
+                         (user_id, ano, mes)).fetchone()
+    anterior = row[0] if row else None
+    linhas = novas
+    if anterior is not None:
+        ids = {n[0] for n in novas}
+        antigas = [a for a in json.loads(ler_blob_mes(frio, user_id, ano, mes, anterior)) if a[0] not in ids]
+        linhas = sorted(antigas + novas, key=lambda n: (n[3], n[0]))
+
+    # O blob novo é confirmado antes da troca; se o processo parar entre os dois
+    # commits, as linhas continuam na tabela e o blob vira órfão
+    geracao = secrets.randbits(62)
+    with frio:
+        frio.execute("INSERT INTO despesas_arquivadas VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (user_id, ano, mes, geracao, len(linhas), time.time(), compactar_linhas(linhas)))
+
+    valores = [n[2] for n in linhas]
+    resumo = (user_id, ano, mes, len(linhas), sum(valores), min(valores), max(valores),
+              min(n[0] for n in linhas), max(n[0] for n in linhas), max(n[4] for n in linhas), geracao)
+    ids = [(n[0],) for n in novas]
+    quente.execute("BEGIN IMMEDIATE")
+    try:
+        atuais = quente.execute(f"SELECT id, versao FROM despesas WHERE {filtro} ORDER BY data_num, id",
+                                (user_id, inicio, fim)).fetchall()
+        row = quente.execute("SELECT geracao FROM meses_arquivados WHERE user_id=? AND ano=? AND mes=?",
+                             (user_id, ano, mes)).fetchone()
+        trocar = atuais == [(n[0], n[4]) for n in novas] and (row[0] if row else None) == anterior
+        if trocar:
+            quente.executemany("DELETE FROM despesas WHERE id=?", ids)
+            # A despesa continua existindo para os clientes de GET /sync: sem registro de remoção
+            quente.executemany("DELETE FROM remocoes WHERE tabela='despesas' AND id=?", ids)
+            quente.executemany("""
+                INSERT INTO despesas_busca_arquivo (rowid, dono, descricao, user_id, valor_centavos, data_num)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [(n[0], dono_busca(user_id), n[1], user_id, n[2], n[3]) for n in novas])
+            quente.execute("INSERT OR REPLACE INTO meses_arquivados VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           resumo)
+        quente.execute("COMMIT" if trocar else "ROLLBACK")
+    except BaseException:
+        quente.execute("ROLLBACK")
+        raise
+
+    with frio:
+        frio.execute("DELETE FROM despesas_arquivadas WHERE user_id=? AND ano=? AND mes=? AND geracao=?",
+                     (user_id, ano, mes, anterior if trocar else geracao))
+    return len(novas) if trocar else 0
+
+
+def _apagar_orfaos(caminhos, destino, antes_de):
+    # Gerações criadas antes de `antes_de` e não referenciadas por nenhum arquivo
+    # de dados; as mais novas podem ser de um arquivamento ainda em andamento
+    referenciadas = set()
+    for caminho in caminhos:
+        with closing(sqlite3.connect(caminho)) as quente:
+            referenciadas.update(quente.execute("SELECT user_id, ano, mes, geracao FROM meses_arquivados"))
+    with closing(sqlite3.connect(destino)) as frio, frio:
+        orfaos = [chave for chave in frio.execute(
+            "SELECT user_id, ano, mes, geracao FROM despesas_arquivadas WHERE criado_em < ?", (antes_de,))
+            if chave not in referenciadas]
+        frio.executemany("DELETE FROM despesas_arquivadas WHERE user_id=? AND ano=? AND mes=? AND geracao=?", orfaos)
+
+
+def arquivar_despesas(horizonte_meses, hoje=None):
+    """
+    Move para o arquivo frio as despesas anteriores ao horizonte, um mês de
+    um usuário por vez. Pode rodar com a aplicação no ar. Devolve quantas
+    despesas foram arquivadas.
+    """
+    cfg = current_app.config
+    destino = arquivo_frio(cfg)
+    criar_schema_arquivo(destino, cfg["DB_MODO_WAL"])
+    limite = limite_horizonte(horizonte_meses, hoje)
+    caminhos = arquivos_dados(cfg["DB_FILE"], max(1, cfg["DB_SHARDS"]))
+    arquivadas = 0
+    for caminho in caminhos:
+        with closing(sqlite3.connect(caminho, isolation_level=None)) as quente, \
+                closing(sqlite3.connect(destino)) as frio:
+            for conn in (quente, frio):
+                conn.execute(f"PRAGMA busy_timeout={cfg['DB_BUSY_TIMEOUT_MS']}")
+            meses = quente.execute("""
+                SELECT DISTINCT user_id, data_num / 10000, data_num / 100 % 100 FROM despesas
+                WHERE data_num < ? ORDER BY 1, 2, 3
+            """, (limite,)).fetchall()
+            for user_id, ano, mes in meses:
+                arquivadas += _arquivar_mes(quente, frio, user_id, ano, mes)
+    _apagar_orfaos(caminhos, destino, time.time() - ORFAOS_APOS_S)
+    return arquivadas
+
+
+def restaurar_se_arquivada(c, arquivo, user_id, despesa_id):
+    """
+    Se `despesa_id` está arquivada, devolve o mês inteiro dela à tabela
+    despesas (na transação de `c`), para que possa ser alterada ou removida.
+    """
+    if c.execute("SELECT 1 FROM despesas WHERE id=?", (despesa_id,)).fetchone():
+        return
+    meses = c.execute("""
+        SELECT ano, mes, geracao FROM meses_arquivados WHERE user_id=? AND ? BETWEEN min_id AND max_id
+    """, (user_id, despesa_id)).fetchall()
+    if not meses:
+        return
+    with closing(sqlite3.connect(arquivo)) as frio:
+        for ano, mes, geracao in meses:
+            linhas = json.loads(ler_blob_mes(frio, user_id, ano, mes, geracao))
+            if any(linha[0] == despesa_id for linha in linhas):
+                # O blob fica no arquivo frio, sem referência, até a limpeza de órfãos
+                c.executemany("""
+                    INSERT OR IGNORE INTO despesas (id, user_id, descricao, valor_centavos, data_num)
+                    VALUES (?, ?, ?, ?, ?)
+                """, [(linha[0], user_id, linha[1], linha[2], linha[3]) for linha in linhas])
+                c.executemany("DELETE FROM despesas_busca_arquivo WHERE rowid=?", [(linha[0],) for linha in linhas])
+                c.execute("DELETE FROM meses_arquivados WHERE user_id=? AND ano=? AND mes=?", (user_id, ano, mes))
+                return
+
+
+def meses_arquivados(c, user_id, condicao="1", args=()):
+    """Meses (ano, mes, geracao) arquivados do usuário que atendem `condicao` (SQL sobre meses_arquivados)."""
+    return c.execute(f"""
+        SELECT ano, mes, geracao FROM meses_arquivados WHERE user_id=? AND {condicao} ORDER BY ano, mes
+    """, (user_id, *args)).fetchall()
+
+
+def despesas_arquivadas_sql(user_id, meses):
+    """Subconsulta (sql, parâmetros) com as linhas arquivadas dos `meses` [(ano, mes, geracao), ...] do usuário."""
+    pool = get_pool_arquivo()
+    conn = _adquirir(pool)
+    try:
+        partes = [ler_blob_mes(conn, user_id, ano, mes, geracao)[1:-1] for ano, mes, geracao in meses]
+    finally:
+        pool.release(conn)
+    return f"({SQL_ARQUIVADAS})", (user_id, "[" + ",".join(p for p in partes if p) + "]")
+
+
+def fonte_despesas(user_id, meses):
+    """
+    Origem das despesas para o FROM de uma consulta: a tabela despesas ou,
+    com `meses` arquivados, a tabela unida às linhas desses meses. Devolve
+    (sql, parâmetros); os parâmetros vão antes dos demais da consulta.
+    """
+    if not meses:
+        return "despesas", ()
+    arquivadas, args = despesas_arquivadas_sql(user_id, meses)
+    return f"""(
+        SELECT id, user_id, descricao, valor_centavos, data_num, versao FROM despesas
+        UNION ALL
+        SELECT * FROM {arquivadas}
+    ) AS despesas""", args
+
+
+def meses_da_pagina(meses, ordem, chave, quantidade, inicio=None, fim=None, filtro_valor=False):
+    """
+    Dos meses arquivados (ano, mes, geracao, quantidade, min_id, max_id) de
+    um usuário, os (ano, mes, geracao) que podem ter despesas entre as
+    `quantidade` primeiras da listagem depois de `chave`. Só meses
+    inteiramente dentro dos filtros contam para completar a página; com
+    filtro de valor, nenhum conta.
+    """
+    candidatos = []
+    for ano, mes, geracao, total, min_id, max_id in meses:
+        primeiro, seguinte = intervalo_mes(ano, mes)
+        ultimo = primeiro + 31
+        if (inicio is not None and ultimo < inicio) or (fim is not None and primeiro > fim):
+            continue
+        completo = not filtro_valor and (inicio is None or inicio <= primeiro + 1) and (fim is None or fim >= ultimo)
+        if chave is not None:
+            if ordem == "id":
+                if max_id <= chave:
+                    continue
+                completo = completo and min_id > chave
+            else:
+                if seguinte <= chave[0]:
+                    continue
+                completo = completo and primeiro + 1 > chave[0]
+        candidatos.append((ano, mes, geracao, total if completo else 0, min_id, max_id))
+
+    # Meses em ordem de data não se sobrepõem; em ordem de id, a faixa de um mês
+    # pode cruzar a de outro, então entram também os que começam antes do maior
+    # id já coberto
+    candidatos.sort(key=(lambda m: (m[0], m[1])) if ordem == "data" else (lambda m: m[4]))
+    escolhidos = []
+    acumulado = 0
+    for indice, (ano, mes, geracao, total, min_id, max_id) in enumerate(candidatos):
+        escolhidos.append((ano, mes, geracao))
+        acumulado += total
+        if acumulado >= quantidade:
+            if ordem == "id":
+                teto = max(m[5] for m in candidatos[:indice + 1])
+                escolhidos += [m[:3] for m in candidatos[indice + 1:] if m[4] <= teto]
+            break
+    return escolhidos
+
+
+class ArquivadorPeriodico:
+    """Executa arquivar_despesas() a cada `intervalo` segundos numa thread própria."""
+
+    def __init__(self, app, intervalo):
+        self.app = app
+        self.intervalo = intervalo
+        self._parar = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="arquivador", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._parar.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._parar.wait(self.intervalo):
+            with self.app.app_context():
+                try:
+                    arquivar_despesas(self.app.config["ARQUIVO_HORIZONTE_MESES"])
+                except Exception:
+                    self.app.logger.exception("Erro no arquivamento de despesas antigas")
+
+
+def iniciar_arquivador(app):
+    """
+    Inicia o ArquivadorPeriodico da aplicação se ARQUIVO_INTERVALO_S > 0.
+    Não é chamado por create_app(): só o ponto de entrada que serve a
+    aplicação o chama, uma vez por implantação (no prefork, só o worker 0).
+    """
+    intervalo = app.config["ARQUIVO_INTERVALO_S"]
+    if intervalo > 0 and "arquivador" not in app.extensions["mvp"]:
+        app.extensions["mvp"]["arquivador"] = ArquivadorPeriodico(app, intervalo)
+    return app
+
+
+@api.cli.command("arquivar-despesas")
+@click.option("--meses", type=int, default=None, help="Meses mantidos na tabela (padrão ARQUIVO_HORIZONTE_MESES)")
+def arquivar_despesas_comando(meses):
+    """Move despesas antigas para o arquivo frio (pode rodar com a aplicação no ar)."""
+    if meses is None:
+        meses = current_app.config["ARQUIVO_HORIZONTE_MESES"]
+    arquivadas = arquivar_despesas(meses)
+    print(f"{arquivadas} despesas arquivadas em {arquivo_frio(current_app.config)}.")
+
+
+# -------------------------
+# Paginação
+# -------------------------
+class ParametroInvalido(ValueError):
+    """Parâmetro de consulta inválido (vira resposta 400)."""
+
+
+def codificar_cursor(ordem, chave):
+    dados = json.dumps({"o": ordem, "k": chave}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(dados.encode()).decode().rstrip("=")
+
+
+def _inteiro(valor):
+    return isinstance(valor, int) and not isinstance(valor, bool)
+
+
+def _par_de_inteiros(valor):
+    return isinstance(valor, list) and len(valor) == 2 and all(_inteiro(v) for v in valor)
+
+
+# Formato da chave de cada tipo de cursor. Cursores por data de antes da
+# migração para AAAAMMDD traziam texto e passam a ser recusados.
+CHAVES_CURSOR = {
+    "id": _inteiro,
+    "data": _par_de_inteiros,
+    "ano_mes": _par_de_inteiros,
+    "busca": lambda k: _inteiro(k) and k >= 0,
+}
+
+
+def decodificar_cursor(cursor, ordem):
+    """Chave de um cursor de `ordem`; ParametroInvalido se o cursor foi alterado ou é de outra ordem."""
+    try:
+        bruto = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        dados = json.loads(bruto)
+        if dados["o"] != ordem or not CHAVES_CURSOR[ordem](dados["k"]):
+            raise ValueError
+        return dados["k"]
+    except (ValueError, KeyError, TypeError):
+        raise ParametroInvalido("Parâmetro 'cursor' inválido")
+
+
+def parametro_limite():
+    limite = request.args.get("limit", type=int)
+    if limite is None:
+        return current_app.config["PAGINA_PADRAO"]
+    if limite < 1:
+        raise ParametroInvalido("Parâmetro 'limit' deve ser positivo")
+    return min(limite, current_app.config["PAGINA_MAX"])
+
+
+def parametro_campos(permitidos):
+    """Campos pedidos em `fields=a,b`, na ordem de `permitidos`."""
+    bruto = request.args.get("fields")
+    if not bruto:
+        return list(permitidos)
+    pedidos = {f.strip() for f in bruto.split(",") if f.strip()}
+    invalidos = pedidos - set(permitidos)
+    if invalidos:
+        raise ParametroInvalido(f"Campos inválidos em 'fields': {', '.join(sorted(invalidos))}")
+    return [f for f in permitidos if f in pedidos]
+
+
+def parametro_centavos(nome):
+    """Parâmetro em reais convertido para centavos, sem arredondar (compara com valor_centavos)."""
+    bruto = request.args.get(nome)
+    if bruto is None:
+        return None
+    try:
+        centavos = float(Decimal(bruto) * 100)
+    except DecimalException:
+        raise ParametroInvalido(f"Parâmetro '{nome}' deve ser numérico")
+    # NaN não casaria com nenhuma despesa; infinitos viram filtros sem efeito
+    if not math.isfinite(centavos):
+        raise ParametroInvalido(f"Parâmetro '{nome}' deve ser numérico")
+    return centavos
+
+
+def parametro_data(nome, formato="%Y-%m-%d"):
+    bruto = request.args.get(nome)
+    if bruto is None:
+        return None
+    try:
+        return datetime.strptime(bruto, formato)
+    except ValueError:
+        raise ParametroInvalido(f"Parâmetro '{nome}' inválido")
+
+# Campos da API guardados em outra representação no banco
+EXPRESSOES_CAMPOS = {"valor": SQL_VALOR, "data": SQL_DATA}
+
+
+def json_objeto_sql(campos):
+    """Expressão json_object(...) para serializar a linha no próprio SQLite."""
+    # `campos` sempre vem de listas fixas ou de parametro_campos (já validados)
+    return "json_object(" + ", ".join(f"'{c}', {EXPRESSOES_CAMPOS.get(c, c)}" for c in campos) + ")"
+
+
+def resposta_json_linhas(chave, objetos, **extras):
+    """
+    Resposta {chave: [...], **extras} montada a partir de objetos JSON já
+    serializados pelo SQLite, sem criar dicts intermediários em Python.
+    """
+    return resposta_json_listas({chave: objetos}, **extras)
+
+
+def resposta_json_listas(listas, **extras):
+    """Como resposta_json_linhas, com várias listas: {nome: [...], ..., **extras}."""
+    partes = []
+    for chave, objetos in listas.items():
+        partes.append(f'"{chave}":[{",".join(objetos)}]')
+    for nome, valor in extras.items():
+        partes.append(f'"{nome}":{current_app.json.dumps(valor)}')
+    return current_app.response_class("{" + ",".join(partes) + "}", mimetype="application/json")
+
+
+def gzip_em_trechos(trechos):
+    """Comprime em gzip cada trecho de uma resposta em streaming, sem esperar pelo fim."""
+    compressor = zlib.compressobj(wbits=31)
+    for trecho in trechos:
+        yield compressor.compress(trecho.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+# -------------------------
+# Cache de respostas
+# -------------------------
+class ResponseCache:
+    """
+    LRU em memória de respostas GET já serializadas, por usuário.
+
+    Cada entrada tem tags (ex.: "despesas", "despesas:2025-09") e as rotas de
+    escrita invalidam apenas as tags afetadas. Uma versão por (usuário, tag)
+    impede que uma leitura concorrente com uma escrita grave no cache um
+    resultado anterior à escrita. O total de bytes é limitado por `max_bytes`
+    e cada entrada expira após `ttl` segundos.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._itens = OrderedDict()
+        self._por_tag = {}
+        self._versoes = {}
+        self._lock = threading.Lock()
+
+    def versoes(self, user_id, tags):
+        with self._lock:
+            return tuple(self._versoes.get((user_id, t), 0) for t in tags)
+
+    def get(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None or item["expira"] < time.monotonic():
+                if item is not None:
+                    self._remover(chave)
+                self.misses += 1
+                return None
+            self._itens.move_to_end(chave)
+            self.hits += 1
+            return item
+
+    def put(self, chave, user_id, tags, versoes, corpo, mimetype):
+        tamanho = len(corpo) + len(chave[1]) + 200
+        if tamanho > self.max_bytes:
+            return None
+        item = {"corpo": corpo, "mimetype": mimetype, "tamanho": tamanho,
+                "etag": hashlib.sha1(corpo).hexdigest(),
+                "expira": time.monotonic() + self.ttl,
+                "tags": [(user_id, t) for t in tags]}
+        with self._lock:
+            # Houve escrita nessas tags durante a leitura: não guarda
+            if tuple(self._versoes.get(t, 0) for t in item["tags"]) != versoes:
+                return item
+            if chave in self._itens:
+                self._remover(chave)
+            self._itens[chave] = item
+            self.bytes += tamanho
+            for t in item["tags"]:
+                self._por_tag.setdefault(t, set()).add(chave)
+            while self.bytes > self.max_bytes:
+                self._remover(next(iter(self._itens)))
+        return item
+
+    def invalidar(self, user_id, tags):
+        with self._lock:
+            for tag in tags:
+                t = (user_id, tag)
+                self._versoes[t] = self._versoes.get(t, 0) + 1
+                for chave in list(self._por_tag.get(t, ())):
+                    self._remover(chave)
+
+    def _remover(self, chave):
+        item = self._itens.pop(chave)
+        self.bytes -= item["tamanho"]
+        for t in item["tags"]:
+            chaves = self._por_tag.get(t)
+            if chaves is not None:
+                chaves.discard(chave)
+                if not chaves:
+                    del self._por_tag[t]
+
+
+def get_cache():
+    """Cache de respostas da aplicação, ou None quando desligado."""
+    if not current_app.config["CACHE_ATIVO"]:
+        return None
+    return recurso("cache", lambda cfg: ResponseCache(cfg["CACHE_MAX_BYTES"], cfg["CACHE_TTL"]))
+
+
+def invalidar_cache(user_id, *tags):
+    """
+    Descarta as respostas em cache do usuário com as `tags`. Numa transação
+    de POST /batch, fica para depois do commit: invalidar antes deixaria uma
+    leitura concorrente guardar o estado antigo sob a versão nova das tags.
+    """
+    cache = get_cache()
+    if cache is None:
+        return
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return
+    pendentes = g.get("invalidacoes_lote")
+    if pendentes is not None:
+        pendentes.append((user_id, tags))
+        return
+    cache.invalidar(user_id, tags)
+
+
+def tag_mes(prefixo, ano, mes):
+    return f"{prefixo}:{int(ano):04d}-{int(mes):02d}"
+
+
+def cache_resposta(*tags):
+    """
+    Guarda a resposta 200 da rota no cache, por usuário e URL completa.
+
+    As tags podem usar os argumentos da rota, ex.: "despesas:{year:04d}-{month:02d}".
+    Respostas saem com ETag; If-None-Match igual devolve 304 sem corpo.
+    """
+    def decorador(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            cache = get_cache()
+            user_id = usuario_atual(request.args.get("user_id", type=int))
+            # Numa transação de POST /batch a leitura pode ver escritas ainda não confirmadas
+            if cache is None or user_id is None or g.get("transacao_lote") is not None:
+                return view(**kwargs)
+
+            chave = (user_id, request.full_path)
+            item = cache.get(chave)
+            if item is None:
+                tags_rota = [t.format(**kwargs) for t in tags]
+                versoes = cache.versoes(user_id, tags_rota)
+                resposta = make_response(view(**kwargs))
+                if resposta.status_code != 200 or resposta.is_streamed:
+                    return resposta
+                item = cache.put(chave, user_id, tags_rota, versoes,
+                                 resposta.get_data(), resposta.mimetype)
+                if item is None:
+                    return resposta
+
+            if item["etag"] in request.if_none_match:
+                resposta = Response(status=304)
+            else:
+                resposta = Response(item["corpo"], status=200, mimetype=item["mimetype"])
+            resposta.set_etag(item["etag"])
+            resposta.headers["Cache-Control"] = "private, no-cache"
+            return resposta
+        return wrapper
+    return decorador
+
+# -------------------------
+# Senhas
+# -------------------------
+class FilaCheia(RuntimeError):
+    """O pool de hash de senhas atingiu o limite de tarefas pendentes."""
+
+
+class HashPool:
+    """
+    Pool limitado de threads para a derivação de senhas (KDF).
+
+    O custo do scrypt/pbkdf2 fica restrito a `workers` threads, com no
+    máximo `fila_max` tarefas aguardando; acima disso a tarefa é recusada
+    de imediato (FilaCheia) em vez de acumular requisições presas. As
+    funções de KDF do hashlib liberam o GIL, então o cálculo não disputa
+    CPU com as threads que atendem as demais rotas.
+    """
+
+    def __init__(self, workers, fila_max):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="senha")
+        self._vagas = threading.BoundedSemaphore(workers + fila_max)
+        self._lock = threading.Lock()
+        self.workers = workers
+        self.em_fila = 0
+        self.em_execucao = 0
+        self.concluidas = 0
+        self.rejeitadas = 0
+        self.espera_total = 0.0
+        self.execucao_total = 0.0
+
+    def submit(self, fn, *args):
+        if not self._vagas.acquire(blocking=False):
+            with self._lock:
+                self.rejeitadas += 1
+            raise FilaCheia("Muitas verificações de senha em andamento")
+        enfileirado = time.perf_counter()
+        with self._lock:
+            self.em_fila += 1
+
+        def tarefa():
+            inicio = time.perf_counter()
+            with self._lock:
+                self.em_fila -= 1
+                self.em_execucao += 1
+                self.espera_total += inicio - enfileirado
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self.em_execucao -= 1
+                    self.concluidas += 1
+                    self.execucao_total += time.perf_counter() - inicio
+                self._vagas.release()
+
+        return self._executor.submit(tarefa)
+
+    def metricas(self):
+        with self._lock:
+            return {"workers": self.workers, "em_fila": self.em_fila,
+                    "em_execucao": self.em_execucao, "concluidas": self.concluidas,
+                    "rejeitadas": self.rejeitadas, "espera_total": self.espera_total,
+                    "execucao_total": self.execucao_total}
+
+
+def get_hash_pool():
+    return recurso("hash_pool", lambda cfg: HashPool(cfg["SENHA_WORKERS"], cfg["SENHA_FILA_MAX"]))
+
+
+def _metodo_senha_atual():
+    # Prefixo gravado pelo werkzeug para o método configurado ("scrypt" -> "scrypt:32768:8:1")
+    return recurso("metodo_senha",
+                   lambda cfg: generate_password_hash("", cfg["SENHA_METODO"]).split("$", 1)[0])
+
+
+def _eh_hash(armazenada):
+    metodo = armazenada.split("$", 1)[0]
+    return armazenada.count("$") == 2 and metodo.startswith(("scrypt:", "pbkdf2:"))
+
+
+def gerar_hash_senha(senha):
+    fut = get_hash_pool().submit(generate_password_hash, senha, current_app.config["SENHA_METODO"])
+    return fut.result(timeout=current_app.config["SENHA_TIMEOUT"])
+
+
+def verificar_senha(armazenada, senha):
+    """
+    Confere a senha e indica se o valor armazenado deve ser regravado.
+
+    Retorna (ok, precisa_rehash). Senhas antigas em texto puro e hashes com
+    parâmetros diferentes dos configurados pedem rehash após o login.
+    """
+    if not _eh_hash(armazenada):
+        ok = hmac.compare_digest(armazenada.encode(), senha.encode())
+        return ok, ok
+    fut = get_hash_pool().submit(check_password_hash, armazenada, senha)
+    ok = fut.result(timeout=current_app.config["SENHA_TIMEOUT"])
+    return ok, ok and armazenada.split("$", 1)[0] != _metodo_senha_atual()
+
+
+def resposta_senha_ocupada():
+    resposta = jsonify({"erro": "Servidor ocupado, tente novamente em instantes"})
+    resposta.headers["Retry-After"] = "1"
+    return resposta, 503
+
+# -------------------------
+# Tokens de sessão
+# -------------------------
+class TokensRevogados:
+    """Lista em memória de tokens revogados (por jti) até expirarem."""
+
+    def __init__(self):
+        self._expira = {}
+        self._lock = threading.Lock()
+
+    def revogar(self, jti, expira):
+        agora = time.time()
+        with self._lock:
+            self._expira = {k: v for k, v in self._expira.items() if v > agora}
+            self._expira[jti] = expira
+
+    def __contains__(self, jti):
+        return jti in self._expira
+
+
+def tokens_revogados():
+    return recurso("tokens_revogados", lambda cfg: TokensRevogados())
+
+
+def _serializador():
+    return URLSafeTimedSerializer(current_app.config["SECRET_KEY"], salt="sessao")
+
+
+def emitir_token(user_id):
+    return _serializador().dumps({"uid": user_id, "jti": secrets.token_hex(8)})
+
+
+def usuario_atual(informado):
+    """Usuário do token da requisição, se houver; senão o `user_id` informado."""
+    return g.get("user_id_token") or informado
+
+
+def autenticado(view):
+    """
+    Valida o token `Authorization: Bearer <token>` em memória, sem consultar
+    o banco, e guarda o usuário em g.user_id_token. Sem token, a rota segue
+    aceitando `user_id` na query/corpo, a menos que AUTH_OBRIGATORIA esteja
+    ligado. Com token, um `user_id` diferente do dono do token é recusado.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.user_id_token = None
+        cabecalho = request.headers.get("Authorization", "")
+        if cabecalho.startswith("Bearer "):
+            try:
+                dados, emitido = _serializador().loads(
+                    cabecalho[7:].strip(), max_age=current_app.config["TOKEN_VALIDADE"], return_timestamp=True)
+            except SignatureExpired:
+                return jsonify({"erro": "Token expirado"}), 401
+            except BadSignature:
+                return jsonify({"erro": "Token inválido"}), 401
+            if dados.get("jti") in tokens_revogados():
+                return jsonify({"erro": "Token revogado"}), 401
+            g.user_id_token = dados["uid"]
+            g.token_jti = dados["jti"]
+            g.token_expira = emitido.timestamp() + current_app.config["TOKEN_VALIDADE"]
+
+            corpo = request.get_json(silent=True)
+            informado = request.args.get("user_id")
+            if informado is None and isinstance(corpo, dict):
+                informado = corpo.get("user_id")
+            if informado is not None and str(informado) != str(g.user_id_token):
+                return jsonify({"erro": "Token não pertence ao usuário informado"}), 403
+        elif current_app.config["AUTH_OBRIGATORIA"]:
+            return jsonify({"erro": "Token de acesso ausente"}), 401
+        return executar_admitido(view, args, kwargs)
+    return wrapper
+
+# -------------------------
+# Controle de admissão
+# -------------------------
+# Antes de uma rota autenticada chegar ao banco: limite de taxa por usuário
+# (um token bucket para leituras e outro para escritas) e um teto global de
+# rotas em execução. O que passa do limite é recusado na hora (429/503 com
+# Retry-After) em vez de esperar numa fila sem fim por conexão ou pelo escritor.
+class LimitadorTaxa:
+    """
+    Token bucket por chave: `taxa` fichas por segundo, acumulando até `rajada`.
+
+    As chaves são espalhadas em faixas, cada uma com trava e dict próprios;
+    usuários diferentes quase nunca disputam a mesma trava, e cada consulta é
+    uma conta e uma atribuição.
+    """
+    FAIXAS = 64
+
+    def __init__(self, taxa, rajada, max_chaves=100_000):
+        self.taxa = taxa
+        self.rajada = max(1.0, rajada)
+        self._max_por_faixa = max(1, max_chaves // self.FAIXAS)
+        self._faixas = [({}, threading.Lock()) for _ in range(self.FAIXAS)]
+
+    def consumir(self, chave):
+        """Gasta uma ficha de `chave`: 0 se admitida, senão os segundos até a próxima ficha."""
+        baldes, lock = self._faixas[hash(chave) % self.FAIXAS]
+        agora = time.monotonic()
+        with lock:
+            balde = baldes.get(chave)
+            if balde is None:
+                if len(baldes) >= self._max_por_faixa:
+                    self._podar(baldes, agora)
+                fichas = self.rajada
+            else:
+                fichas = min(self.rajada, balde[0] + (agora - balde[1]) * self.taxa)
+            if fichas >= 1:
+                baldes[chave] = (fichas - 1, agora)
+                return 0.0
+            baldes[chave] = (fichas, agora)
+            return (1 - fichas) / self.taxa
+
+    def _podar(self, baldes, agora):
+        # Um balde que já teria enchido de novo equivale a não ter balde
+        cheio = self.rajada / self.taxa
+        for chave in [k for k, (_, t) in baldes.items() if agora - t >= cheio]:
+            del baldes[chave]
+
+
+def get_limitador(classe):
+    """Limitador de "leitura" ou "escrita", ou None quando a taxa configurada é 0."""
+    prefixo = f"LIMITE_{classe.upper()}"
+    if current_app.config[f"{prefixo}_POR_S"] <= 0:
+        return None
+    return recurso(f"limitador_{classe}",
+                   lambda cfg: LimitadorTaxa(cfg[f"{prefixo}_POR_S"], cfg[f"{prefixo}_RAJADA"]))
+
+
+def get_vagas():
+    """Semáforo com CONCORRENCIA_MAX vagas para rotas em execução, ou None (sem teto)."""
+    if current_app.config["CONCORRENCIA_MAX"] <= 0:
+        return None
+    return recurso("vagas", lambda cfg: threading.BoundedSemaphore(cfg["CONCORRENCIA_MAX"]))
+
+
+def resposta_sobrecarga(status, mensagem, espera, motivo):
+    metricas = get_metricas()
+    if metricas is not None:
+        metricas.contar("http_recusadas_total", motivo=motivo)
+    resposta = jsonify({"erro": mensagem})
+    resposta.headers["Retry-After"] = str(max(1, math.ceil(espera)))
+    return resposta, status
+
+
+def _chave_limite():
+    """Usuário da requisição (token, query ou corpo); sem usuário, o endereço do cliente."""
+    if g.user_id_token is not None:
+        return g.user_id_token
+    informado = request.args.get("user_id")
+    if informado is None:
+        corpo = request.get_json(silent=True)
+        if isinstance(corpo, dict):
+            informado = corpo.get("user_id")
+    return str(informado) if informado is not None else request.remote_addr
+
+
+def executar_admitido(view, args, kwargs):
+    classe = "leitura" if request.method in ("GET", "HEAD") else "escrita"
+    limitador = get_limitador(classe)
+    if limitador is not None:
+        espera = limitador.consumir(_chave_limite())
+        if espera:
+            return resposta_sobrecarga(429, "Muitas requisições, tente novamente em instantes", espera, classe)
+
+    vagas = get_vagas()
+    if vagas is None or g.get("em_lote"):
+        # Sub-requisições de POST /batch usam a vaga do próprio lote
+        return view(*args, **kwargs)
+    if not vagas.acquire(timeout=current_app.config["CONCORRENCIA_ESPERA_MS"] / 1000):
+        return resposta_sobrecarga(503, "Servidor ocupado, tente novamente em instantes", 1, "concorrencia")
+    liberar = True
+    try:
+        resposta = view(*args, **kwargs)
+        if isinstance(resposta, Response) and resposta.is_streamed:
+            # Em streaming (GET /despesas/export) a rota só termina quando o
+            # servidor fecha a resposta: a vaga fica ocupada até lá
+            resposta.call_on_close(vagas.release)
+            liberar = False
+        return resposta
+    finally:
+        if liberar:
+            vagas.release()
+
+# -------------------------
+# Identificadores de login
+# -------------------------
+def normalizar_email(email):
+    return email.strip().lower()
+
+
+def normalizar_cpf(cpf):
+    return re.sub(r"[.\-\s/]", "", cpf)
+
+
+def classificar_identificador(identificador):
+    """
+    Retorna ("email", valor) ou ("cpf", valor) já normalizados, ou None.
+
+    Assim o login consulta uma única coluna e usa o índice UNIQUE dela,
+    em vez de um OR entre e-mail e CPF.
+    """
+    if not isinstance(identificador, str):
+        return None
+    identificador = identificador.strip()
+    if "@" in identificador:
+        return "email", normalizar_email(identificador)
+    cpf = normalizar_cpf(identificador)
+    if cpf.isdigit():
+        return "cpf", cpf
+    return None
+
+
+class CacheNegativo:
+    """Identificadores que não existem, lembrados por `ttl` segundos."""
+
+    def __init__(self, ttl, max_itens):
+        self.ttl = ttl
+        self.max_itens = max_itens
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, chave):
+        with self._lock:
+            expira = self._itens.get(chave)
+            if expira is None:
+                return False
+            if expira < time.monotonic():
+                del self._itens[chave]
+                return False
+            return True
+
+    def adicionar(self, chave):
+        with self._lock:
+            self._itens[chave] = time.monotonic() + self.ttl
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+
+    def descartar(self, chave):
+        with self._lock:
+            self._itens.pop(chave, None)
+
+
+def identificadores_inexistentes():
+    return recurso("identificadores_inexistentes", lambda cfg: CacheNegativo(
+        cfg["LOGIN_CACHE_NEGATIVO_TTL"], cfg["LOGIN_CACHE_NEGATIVO_MAX"]))
 
 # -------------------------
 # Usuários
 # -------------------------
-@app.route('/register', methods=['POST'])
+@api.route('/register', methods=['POST'])
 def register():
     """
     Registrar um novo usuário
@@ -105,7 +2363,7 @@ def register():
       201:
         description: Usuário cadastrado com sucesso
       400:
-        description: Campos obrigatórios ausentes ou duplicados
+        description: Campos obrigatórios ausentes, inválidos ou duplicados
       500:
         description: Erro no banco de dados
     """
@@ -117,18 +2375,43 @@ def register():
 
     if not nome or not email or not cpf or not senha:
         return jsonify({"erro": "Campos 'nome', 'email', 'cpf' e 'senha' são obrigatórios"}), 400
+    if not all(isinstance(campo, str) for campo in (nome, email, cpf, senha)):
+        return jsonify({"erro": "Campos 'nome', 'email', 'cpf' e 'senha' devem ser texto"}), 400
+
+    email = normalizar_email(email)
+    cpf = normalizar_cpf(cpf)
+    if "@" not in email:
+        return jsonify({"erro": "E-mail inválido"}), 400
+    if not cpf.isdigit():
+        return jsonify({"erro": "CPF deve conter apenas dígitos"}), 400
 
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            # Verifica duplicados
-            c.execute("SELECT id FROM users WHERE email=? OR cpf=?", (email, cpf))
-            if c.fetchone():
-                return jsonify({"erro": "E-mail ou CPF já cadastrado"}), 400
+        senha_hash = gerar_hash_senha(senha)
+    except (FilaCheia, FuturesTimeout):
+        return resposta_senha_ocupada()
+
+    def inserir(conn):
+        c = conn.cursor()
+        # Verifica duplicados (uma busca por índice em cada coluna)
+        c.execute("""
+            SELECT 1 FROM users WHERE email=?
+            UNION ALL
+            SELECT 1 FROM users WHERE cpf=?
+            LIMIT 1
+        """, (email, cpf))
+        if c.fetchone():
+            return None
+
+        c.execute("INSERT INTO users (nome, email, cpf, senha) VALUES (?, ?, ?, ?)",
+                  (nome, email, cpf, senha_hash))
+        return c.lastrowid
 
-            c.execute("INSERT INTO users (nome, email, cpf, senha) VALUES (?, ?, ?, ?)",
-                      (nome, email, cpf, senha))
-            user_id = c.lastrowid
+    try:
+        user_id = executar_escrita(inserir)
+        if user_id is None:
+            return jsonify({"erro": "E-mail ou CPF já cadastrado"}), 400
+        identificadores_inexistentes().descartar(("email", email))
+        identificadores_inexistentes().descartar(("cpf", cpf))
 
         return jsonify({"message": "Usuário cadastrado com sucesso!",
                         "user": {"id": user_id, "nome": nome, "email": email, "cpf": cpf}}), 201
@@ -136,7 +2419,7 @@ def register():
     except sqlite3.Error as e:
         return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
 
-@app.route('/login', methods=['POST'])
+@api.route('/login', methods=['POST'])
 def login():
     """
     Login de usuário
@@ -188,12 +2471,21 @@ def login():
                 cpf:
                   type: string
                   example: "12345678900"
+            token:
+              type: string
+              description: "Token de sessão; envie como 'Authorization: Bearer <token>'"
+            expira_em:
+              type: integer
+              example: 86400
+              description: Validade do token em segundos
       400:
         description: Campos obrigatórios ausentes
       401:
         description: Usuário ou senha inválidos
       500:
         description: Erro no banco de dados
+      503:
+        description: Muitas verificações de senha em andamento (ver Retry-After)
     """
     data = request.get_json() or {}
     identificador = data.get("identificador")
@@ -201,25 +2493,74 @@ def login():
     if not identificador or not senha:
         return jsonify({"erro": "Campos 'identificador' e 'senha' são obrigatórios"}), 400
 
+    chave = classificar_identificador(identificador)
+    if chave is None or not isinstance(senha, str) or chave in identificadores_inexistentes():
+        return jsonify({"erro": "Usuário ou senha inválidos"}), 401
+    coluna, valor = chave
+
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             c = conn.cursor()
-            c.execute("SELECT id, nome, email, cpf FROM users WHERE (email=? OR cpf=?) AND senha=?",
-                      (identificador, identificador, senha))
+            # coluna vem de classificar_identificador ("email" ou "cpf")
+            c.execute(f"SELECT id, nome, email, cpf, senha FROM users WHERE {coluna}=?", (valor,))
             row = c.fetchone()
 
-        if row:
+        if not row:
+            identificadores_inexistentes().adicionar(chave)
+            return jsonify({"erro": "Usuário ou senha inválidos"}), 401
+
+        try:
+            ok, precisa_rehash = verificar_senha(row[4], senha)
+            if ok and precisa_rehash:
+                # Migra senhas antigas (texto puro ou parâmetros desatualizados)
+                novo_hash = gerar_hash_senha(senha)
+                executar_escrita(lambda conn: conn.execute(
+                    "UPDATE users SET senha=? WHERE id=? AND senha=?", (novo_hash, row[0], row[4])))
+        except (FilaCheia, FuturesTimeout):
+            return resposta_senha_ocupada()
+
+        if ok:
             user_safe = {"id": row[0], "nome": row[1], "email": row[2], "cpf": row[3]}
-            return jsonify({"message": "Login OK", "user": user_safe}), 200
+            return jsonify({"message": "Login OK", "user": user_safe,
+                            "token": emitir_token(row[0]),
+                            "expira_em": current_app.config["TOKEN_VALIDADE"]}), 200
         return jsonify({"erro": "Usuário ou senha inválidos"}), 401
 
     except sqlite3.Error as e:
         return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
 
+@api.route('/logout', methods=['POST'])
+@autenticado
+def logout():
+    """
+    Encerrar a sessão
+    ---
+    tags:
+      - Usuários
+    description: Revoga o token enviado no cabeçalho Authorization.
+    responses:
+      200:
+        description: Token revogado
+      401:
+        description: Token ausente, inválido ou expirado
+    """
+    if g.user_id_token is None:
+        return jsonify({"erro": "Token de acesso ausente"}), 401
+    tokens_revogados().revogar(g.token_jti, g.token_expira)
+    return jsonify({"message": "Logout OK"}), 200
+
 # -------------------------
 # Despesas
 # -------------------------
-@app.route('/despesas', methods=['POST'])
+def normalizar_despesa(valor, data_str):
+    """Converte valor para centavos e data para AAAAMMDD (ValueError se inválidos)."""
+    try:
+        return para_centavos(valor), data_para_num(datetime.strptime(data_str, "%Y-%m-%d"))
+    except (TypeError, ValueError):
+        raise ValueError("Valor deve ser numérico e data no formato YYYY-MM-DD")
+
+@api.route('/despesas', methods=['POST'])
+@autenticado
 def adicionar_despesa():
     """
     Adicionar uma nova despesa
@@ -265,46 +2606,193 @@ def adicionar_despesa():
         description: Erro no banco de dados
     """
     data = request.get_json() or {}
-    user_id = data.get("user_id")
+    user_id = usuario_atual(data.get("user_id"))
     descricao = data.get("descricao")
     valor = data.get("valor")
     data_str = data.get("data")
 
     if user_id is None or descricao is None or valor is None or data_str is None:
         return jsonify({"erro": "Campos 'user_id', 'descricao', 'valor' e 'data' são obrigatórios"}), 400
+    if not isinstance(descricao, str):
+        return jsonify({"erro": "Campo 'descricao' deve ser texto"}), 400
 
     try:
-        valor = float(valor)
-        datetime.strptime(data_str, "%Y-%m-%d")
-    except:
-        return jsonify({"erro": "Valor deve ser numérico e data no formato YYYY-MM-DD"}), 400
+        centavos, data_num = normalizar_despesa(valor, data_str)
+    except ValueError as e:
+        return jsonify({"erro": str(e)}), 400
 
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            c.execute("SELECT id FROM users WHERE id=?", (user_id,))
-            if not c.fetchone():
-                return jsonify({"erro": "Usuário não encontrado"}), 404
+    def inserir(conn):
+        c = conn.cursor()
+        c.execute("INSERT INTO despesas (user_id, descricao, valor_centavos, data_num) VALUES (?, ?, ?, ?)",
+                  (user_id, descricao, centavos, data_num))
+        despesa_id = c.lastrowid
+        somar_totais(c, [(user_id, descricao, centavos, data_num)])
+        return despesa_id
 
-            c.execute("INSERT INTO despesas (user_id, descricao, valor, data) VALUES (?, ?, ?, ?)",
-                      (user_id, descricao, valor, data_str))
-            despesa_id = c.lastrowid
+    try:
+        # Com token válido o usuário já foi verificado em memória
+        if g.user_id_token is None and not usuario_existe(user_id):
+            return jsonify({"erro": "Usuário não encontrado"}), 404
+        despesa_id = executar_escrita(inserir, user_id)
+        invalidar_cache(user_id, "despesas", tag_mes("despesas", *ano_mes(data_num)))
 
         return jsonify({"message": "Despesa adicionada com sucesso!",
-                        "despesa": {"id": despesa_id, "user_id": user_id,
-                                    "descricao": descricao, "valor": valor, "data": data_str}}), 201
+                        "despesa": {"id": despesa_id, "user_id": user_id, "descricao": descricao,
+                                    "valor": de_centavos(centavos), "data": num_para_data(data_num)}}), 201
+
+    except sqlite3.Error as e:
+        return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
+
+@api.route('/despesas/batch', methods=['POST'])
+@autenticado
+def adicionar_despesas_lote():
+    """
+    Adicionar despesas em lote
+    ---
+    tags:
+      - Despesas
+    description: >
+      Importa várias despesas de um usuário numa única requisição. O corpo pode
+      ser um array JSON ou NDJSON (Content-Type application/x-ndjson, um objeto
+      por linha). Todas as linhas são validadas antes da gravação, e as válidas
+      são inseridas numa única transação. Com `atomico=true`, qualquer linha
+      inválida faz com que nada seja gravado.
+    consumes:
+      - application/json
+      - application/x-ndjson
+    parameters:
+      - in: query
+        name: user_id
+        type: integer
+        required: true
+        description: ID do usuário dono das despesas
+        example: 1
+      - in: query
+        name: atomico
+        type: boolean
+        required: false
+        description: Tudo ou nada (padrão false)
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            type: object
+            required:
+              - descricao
+              - valor
+              - data
+            properties:
+              descricao:
+                type: string
+                example: "Almoço"
+              valor:
+                type: number
+                example: 25.50
+              data:
+                type: string
+                example: "2025-09-22"
+    responses:
+      201:
+        description: Todas as despesas foram inseridas
+      207:
+        description: Parte das linhas foi inserida; as demais constam em 'erros'
+      400:
+        description: Corpo inválido, nenhuma linha válida ou lote atômico com erros
+      404:
+        description: Usuário não encontrado
+      413:
+        description: Lote maior que o permitido
+      500:
+        description: Erro no banco de dados
+    """
+    user_id = usuario_atual(request.args.get("user_id", type=int))
+    if user_id is None:
+        return jsonify({"erro": "Query param 'user_id' é obrigatório"}), 400
+    atomico = request.args.get("atomico", "false").lower() in ("1", "true", "sim")
+
+    maximo = current_app.config["BATCH_MAX_LINHAS"]
+    excede = {"erro": f"Lote excede {maximo} linhas"}
+    erros = []
+    if request.mimetype == "application/x-ndjson":
+        # Lido linha a linha do corpo: passando do limite, o resto nem é lido
+        itens = []
+        for indice, linha in enumerate(request.stream):
+            if not linha.strip():
+                continue
+            if len(itens) + len(erros) == maximo:
+                return jsonify(excede), 413
+            try:
+                itens.append((indice, json.loads(linha)))
+            except ValueError:
+                erros.append({"indice": indice, "erro": "JSON inválido"})
+    else:
+        corpo = request.get_json(silent=True)
+        if not isinstance(corpo, list):
+            return jsonify({"erro": "Corpo deve ser um array JSON ou NDJSON"}), 400
+        if len(corpo) > maximo:
+            return jsonify(excede), 413
+        itens = list(enumerate(corpo))
+
+    linhas = []
+    for indice, item in itens:
+        if not isinstance(item, dict):
+            erros.append({"indice": indice, "erro": "Item deve ser um objeto"})
+            continue
+        if item.get("user_id") not in (None, user_id):
+            erros.append({"indice": indice, "erro": "'user_id' diferente do informado na query"})
+            continue
+        descricao = item.get("descricao")
+        if descricao is None or item.get("valor") is None or item.get("data") is None:
+            erros.append({"indice": indice, "erro": "Campos 'descricao', 'valor' e 'data' são obrigatórios"})
+            continue
+        if not isinstance(descricao, str):
+            erros.append({"indice": indice, "erro": "Campo 'descricao' deve ser texto"})
+            continue
+        try:
+            centavos, data_num = normalizar_despesa(item["valor"], item["data"])
+        except ValueError as e:
+            erros.append({"indice": indice, "erro": str(e)})
+            continue
+        linhas.append((user_id, descricao, centavos, data_num))
+
+    erros.sort(key=lambda e: e["indice"])
+    if erros and (atomico or not linhas):
+        return jsonify({"erro": "Nenhuma despesa inserida", "inseridas": 0, "erros": erros}), 400
+
+    def inserir(conn):
+        c = conn.cursor()
+        c.executemany("INSERT INTO despesas (user_id, descricao, valor_centavos, data_num) VALUES (?, ?, ?, ?)",
+                      linhas)
+        somar_totais(c, linhas)
+        return len(linhas)
+
+    try:
+        if g.user_id_token is None and not usuario_existe(user_id):
+            return jsonify({"erro": "Usuário não encontrado"}), 404
+        inseridas = executar_escrita(inserir, user_id)
+        meses = {tag_mes("despesas", *ano_mes(linha[3])) for linha in linhas}
+        invalidar_cache(user_id, "despesas", *meses)
+
+        return jsonify({"message": "Despesas adicionadas com sucesso!",
+                        "inseridas": inseridas, "erros": erros}), 207 if erros else 201
 
     except sqlite3.Error as e:
         return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
 
-@app.route('/despesas', methods=['GET'])
+@api.route('/despesas', methods=['GET'])
+@autenticado
+@cache_resposta("despesas")
 def listar_despesas():
     """
     Listar despesas de um usuário
     ---
     tags:
       - Despesas
-    description: Retorna todas as despesas de um usuário específico.
+    description: >
+      Retorna as despesas de um usuário em páginas. Use `next_cursor` da
+      resposta no parâmetro `cursor` para buscar a página seguinte.
     parameters:
       - in: query
         name: user_id
@@ -312,9 +2800,52 @@ def listar_despesas():
         required: true
         description: ID do usuário cujas despesas serão listadas
         example: 1
+      - in: query
+        name: limit
+        type: integer
+        required: false
+        description: Tamanho da página (padrão 100, máximo 1000)
+        example: 50
+      - in: query
+        name: cursor
+        type: string
+        required: false
+        description: Cursor opaco devolvido em `next_cursor`
+      - in: query
+        name: ordem
+        type: string
+        enum: [id, data]
+        required: false
+        description: Ordenação das despesas (padrão id)
+      - in: query
+        name: data_inicio
+        type: string
+        required: false
+        description: Data mínima (inclusive), formato YYYY-MM-DD
+        example: "2025-01-01"
+      - in: query
+        name: data_fim
+        type: string
+        required: false
+        description: Data máxima (inclusive), formato YYYY-MM-DD
+        example: "2025-12-31"
+      - in: query
+        name: valor_min
+        type: number
+        required: false
+      - in: query
+        name: valor_max
+        type: number
+        required: false
+      - in: query
+        name: fields
+        type: string
+        required: false
+        description: Campos retornados, separados por vírgula (id, descricao, valor, data)
+        example: "id,valor"
     responses:
       200:
-        description: Lista de despesas
+        description: Página de despesas
         schema:
           type: object
           properties:
@@ -335,25 +2866,566 @@ def listar_despesas():
                   data:
                     type: string
                     example: "2025-09-22"
+            next_cursor:
+              type: string
+              description: Cursor da próxima página, ou null se não houver
       400:
-        description: Query param 'user_id' ausente
+        description: Query param 'user_id' ausente ou parâmetros inválidos
+      500:
+        description: Erro no banco de dados
+    """
+    user_id = usuario_atual(request.args.get("user_id", type=int))
+    if user_id is None:
+        return jsonify({"erro": "Query param 'user_id' é obrigatório"}), 400
+
+    ordem = request.args.get("ordem", "id")
+    if ordem not in ("id", "data"):
+        return jsonify({"erro": "Parâmetro 'ordem' deve ser 'id' ou 'data'"}), 400
+
+    try:
+        limite = parametro_limite()
+        campos = parametro_campos(("id", "descricao", "valor", "data"))
+        data_inicio = parametro_data("data_inicio")
+        data_fim = parametro_data("data_fim")
+        valor_min = parametro_centavos("valor_min")
+        valor_max = parametro_centavos("valor_max")
+        cursor = request.args.get("cursor")
+        chave = decodificar_cursor(cursor, ordem) if cursor else None
+    except ParametroInvalido as e:
+        return jsonify({"erro": str(e)}), 400
+
+    filtros = ["user_id=?"]
+    args = [user_id]
+    if data_inicio is not None:
+        filtros.append("data_num >= ?")
+        args.append(data_para_num(data_inicio))
+    if data_fim is not None:
+        filtros.append("data_num <= ?")
+        args.append(data_para_num(data_fim))
+    if valor_min is not None:
+        filtros.append("valor_centavos >= ?")
+        args.append(valor_min)
+    if valor_max is not None:
+        filtros.append("valor_centavos <= ?")
+        args.append(valor_max)
+    if chave is not None:
+        if ordem == "id":
+            filtros.append("id > ?")
+            args.append(chave)
+        else:
+            filtros.append("(data_num, id) > (?, ?)")
+            args.extend(chave)
+    ordenacao = "id" if ordem == "id" else "data_num, id"
+
+    try:
+        with get_db_usuario(user_id) as conn:
+            c = conn.cursor()
+            c.execute("SELECT ano, mes, geracao, quantidade, min_id, max_id FROM meses_arquivados WHERE user_id=?",
+                      (user_id,))
+            meses = meses_da_pagina(c.fetchall(), ordem, chave, limite + 1,
+                                    data_para_num(data_inicio) if data_inicio else None,
+                                    data_para_num(data_fim) if data_fim else None,
+                                    valor_min is not None or valor_max is not None)
+            fonte, fonte_args = fonte_despesas(user_id, meses)
+            # Busca um registro a mais para saber se existe próxima página
+            c.execute(f"""
+                SELECT id, data_num, {json_objeto_sql(campos)} FROM {fonte}
+                WHERE {" AND ".join(filtros)}
+                ORDER BY {ordenacao}
+                LIMIT ?
+            """, (*fonte_args, *args, limite + 1))
+            rows = c.fetchall()
+
+        next_cursor = None
+        if len(rows) > limite:
+            rows = rows[:limite]
+            ultimo = rows[-1]
+            next_cursor = codificar_cursor(ordem, ultimo[0] if ordem == "id" else [ultimo[1], ultimo[0]])
+
+        return resposta_json_linhas("despesas", (r[2] for r in rows), next_cursor=next_cursor), 200
+    except sqlite3.Error as e:
+        return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
+
+@api.route('/despesas/export', methods=['GET'])
+@autenticado
+def exportar_despesas():
+    """
+    Exportar todas as despesas de um usuário
+    ---
+    tags:
+      - Despesas
+    description: >
+      Envia o histórico completo de despesas do usuário em streaming
+      (NDJSON, um objeto por linha, ou CSV), em ordem de id, incluindo os
+      meses arquivados. As linhas são lidas do banco em lotes, então o uso
+      de memória não cresce com o tamanho do histórico. Com
+      `Accept-Encoding: gzip` cada lote é comprimido ao ser enviado. Para
+      retomar uma exportação interrompida, passe em `apos_id` o último id
+      recebido.
+    produces:
+      - application/x-ndjson
+      - text/csv
+    parameters:
+      - in: query
+        name: user_id
+        type: integer
+        required: true
+        description: ID do usuário cujas despesas serão exportadas
+        example: 1
+      - in: query
+        name: formato
+        type: string
+        enum: [ndjson, csv]
+        required: false
+        description: Formato da exportação (padrão ndjson)
+      - in: query
+        name: apos_id
+        type: integer
+        required: false
+        description: Exporta só as despesas com id maior que este (retomada)
+      - in: header
+        name: Accept-Encoding
+        type: string
+        required: false
+        description: Com gzip, a resposta vem comprimida (Content-Encoding gzip)
+        example: gzip
+    responses:
+      200:
+        description: Despesas em NDJSON ou CSV
+      400:
+        description: Query param 'user_id' ausente, formato inválido ou 'apos_id' não inteiro
+    """
+    user_id = usuario_atual(request.args.get("user_id", type=int))
+    if user_id is None:
+        return jsonify({"erro": "Query param 'user_id' é obrigatório"}), 400
+
+    formato = request.args.get("formato", "ndjson")
+    if formato not in ("ndjson", "csv"):
+        return jsonify({"erro": "Parâmetro 'formato' deve ser 'ndjson' ou 'csv'"}), 400
+
+    try:
+        apos_id = int(request.args.get("apos_id", 0))
+    except ValueError:
+        return jsonify({"erro": "Parâmetro 'apos_id' deve ser um inteiro"}), 400
+
+    lote = current_app.config["EXPORT_LOTE"]
+    colunas = ("id", "descricao", "valor", "data")
+
+    if formato == "csv":
+        selecao = f"id, descricao, {SQL_VALOR}, {SQL_DATA}"
+    else:
+        selecao = json_objeto_sql(colunas)
+
+    def gerar():
+        c = get_db_usuario(user_id).cursor()
+        c.execute("SELECT ano, mes, geracao, quantidade, min_id, max_id FROM meses_arquivados WHERE user_id=?",
+                  (user_id,))
+        meses = c.fetchall()
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        if formato == "csv":
+            escritor.writerow(colunas)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # Um lote por consulta, continuando do último id: só os meses arquivados
+        # que podem ter ids do lote são descompactados
+        ultimo = apos_id
+        while True:
+            fonte, fonte_args = fonte_despesas(user_id, meses_da_pagina(meses, "id", ultimo, lote))
+            c.execute(f"SELECT id, {selecao} FROM {fonte} WHERE user_id=? AND id > ? ORDER BY id LIMIT ?",
+                      (*fonte_args, user_id, ultimo, lote))
+            rows = c.fetchall()
+            if not rows:
+                break
+            if formato == "csv":
+                escritor.writerows(r[1:] for r in rows)
+            else:
+                for r in rows:
+                    buffer.write(r[1])
+                    buffer.write("\n")
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            if len(rows) < lote:
+                break
+            ultimo = rows[-1][0]
+        c.close()
+
+    if formato == "csv":
+        mimetype, nome = "text/csv", "despesas.csv"
+    else:
+        mimetype, nome = "application/x-ndjson", "despesas.ndjson"
+    headers = {"Content-Disposition": f"attachment; filename={nome}", "Vary": "Accept-Encoding"}
+    trechos = gerar()
+    if request.accept_encodings["gzip"]:
+        trechos = gzip_em_trechos(trechos)
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(trechos), mimetype=mimetype, headers=headers)
+
+def consulta_busca(texto):
+    """
+    Expressão MATCH do FTS5 para o texto digitado: cada palavra vira um
+    prefixo entre aspas ("merc"*), todas obrigatórias. Operadores e aspas do
+    usuário não chegam ao FTS5. Devolve None se não houver palavras.
+    """
+    palavras = re.findall(r"\w+", texto or "")
+    if not palavras:
+        return None
+    return " ".join(f'"{p}"*' for p in palavras)
+
+
+def dono_busca(user_id):
+    """Valor da coluna `dono` dos índices de busca (ver _migracao_busca_por_usuario)."""
+    return f"u{user_id}"
+
+
+@api.route('/despesas/busca', methods=['GET'])
+@autenticado
+@cache_resposta("despesas")
+def buscar_despesas():
+    """
+    Buscar despesas pela descrição
+    ---
+    tags:
+      - Despesas
+    description: >
+      Busca de texto nas descrições das despesas de um usuário, ordenada por
+      relevância (bm25). Cada palavra de `q` casa por prefixo ("merc" encontra
+      "Mercado"), sem diferenciar maiúsculas nem acentos; todas as palavras
+      precisam aparecer. Use `next_cursor` para a página seguinte. Despesas
+      de meses arquivados (ARQUIVO_HORIZONTE_MESES) entram na busca, com a
+      relevância calculada no índice das descrições arquivadas.
+    parameters:
+      - in: query
+        name: user_id
+        type: integer
+        required: true
+        example: 1
+      - in: query
+        name: q
+        type: string
+        required: true
+        description: Texto buscado
+        example: "mercado"
+      - in: query
+        name: limit
+        type: integer
+        required: false
+        description: Tamanho da página (padrão 100, máximo 1000)
+      - in: query
+        name: cursor
+        type: string
+        required: false
+        description: Cursor opaco devolvido em `next_cursor`
+      - in: query
+        name: data_inicio
+        type: string
+        required: false
+        description: Data mínima (inclusive), formato YYYY-MM-DD
+      - in: query
+        name: data_fim
+        type: string
+        required: false
+        description: Data máxima (inclusive), formato YYYY-MM-DD
+      - in: query
+        name: valor_min
+        type: number
+        required: false
+      - in: query
+        name: valor_max
+        type: number
+        required: false
+      - in: query
+        name: fields
+        type: string
+        required: false
+        description: Campos retornados, separados por vírgula (id, descricao, valor, data)
+    responses:
+      200:
+        description: Página de despesas encontradas, da mais para a menos relevante
+        schema:
+          type: object
+          properties:
+            despesas:
+              type: array
+              items:
+                type: object
+                properties:
+                  id:
+                    type: integer
+                    example: 1
+                  descricao:
+                    type: string
+                    example: "Mercado"
+                  valor:
+                    type: number
+                    example: 120.35
+                  data:
+                    type: string
+                    example: "2025-09-22"
+            next_cursor:
+              type: string
+              description: Cursor da próxima página, ou null se não houver
+      400:
+        description: Query param 'user_id' ou 'q' ausente, ou parâmetros inválidos
+      500:
+        description: Erro no banco de dados
+    """
+    user_id = usuario_atual(request.args.get("user_id", type=int))
+    if user_id is None:
+        return jsonify({"erro": "Query param 'user_id' é obrigatório"}), 400
+
+    consulta = consulta_busca(request.args.get("q"))
+    if consulta is None:
+        return jsonify({"erro": "Query param 'q' é obrigatório"}), 400
+
+    try:
+        limite = parametro_limite()
+        campos = parametro_campos(("id", "descricao", "valor", "data"))
+        data_inicio = parametro_data("data_inicio")
+        data_fim = parametro_data("data_fim")
+        valor_min = parametro_centavos("valor_min")
+        valor_max = parametro_centavos("valor_max")
+        cursor = request.args.get("cursor")
+        # A ordem por relevância não tem chave estável entre páginas: o cursor guarda o deslocamento
+        deslocamento = decodificar_cursor(cursor, "busca") if cursor else 0
+    except ParametroInvalido as e:
+        return jsonify({"erro": str(e)}), 400
+
+    # Restrita ao usuário dentro do próprio MATCH
+    consulta = f'dono:"{dono_busca(user_id)}" AND descricao:({consulta})'
+    filtros = ["1"]
+    args = [consulta, user_id, consulta, user_id]
+    if data_inicio is not None:
+        filtros.append("data_num >= ?")
+        args.append(data_para_num(data_inicio))
+    if data_fim is not None:
+        filtros.append("data_num <= ?")
+        args.append(data_para_num(data_fim))
+    if valor_min is not None:
+        filtros.append("valor_centavos >= ?")
+        args.append(valor_min)
+    if valor_max is not None:
+        filtros.append("valor_centavos <= ?")
+        args.append(valor_max)
+
+    try:
+        with get_db_usuario(user_id) as conn:
+            c = conn.cursor()
+            # Despesas da tabela e despesas arquivadas, cada uma no seu índice
+            c.execute(f"""
+                SELECT {json_objeto_sql(campos)} FROM (
+                    SELECT id, relevancia, descricao, valor_centavos, data_num FROM (
+                        SELECT rowid AS id, rank AS relevancia FROM despesas_busca WHERE despesas_busca MATCH ?
+                    ) JOIN despesas USING (id)
+                    WHERE user_id=?
+                    UNION ALL
+                    SELECT rowid, rank, descricao, valor_centavos, data_num FROM despesas_busca_arquivo
+                    WHERE despesas_busca_arquivo MATCH ? AND user_id=?
+                )
+                WHERE {" AND ".join(filtros)}
+                ORDER BY relevancia, id
+                LIMIT ? OFFSET ?
+            """, (*args, limite + 1, deslocamento))
+            rows = c.fetchall()
+
+        next_cursor = None
+        if len(rows) > limite:
+            rows = rows[:limite]
+            next_cursor = codificar_cursor("busca", deslocamento + limite)
+
+        return resposta_json_linhas("despesas", (r[0] for r in rows), next_cursor=next_cursor), 200
+    except sqlite3.Error as e:
+        return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
+
+@api.route('/despesas/resumo', methods=['GET'])
+@autenticado
+@cache_resposta("despesas", "metas")
+def resumo_despesas():
+    """
+    Resumo de gastos por mês e por ano
+    ---
+    tags:
+      - Despesas
+    description: >
+      Retorna, para um intervalo de meses, o total e a quantidade de despesas
+      por mês (com a meta e o percentual atingido), os totais por ano e,
+      opcionalmente, as descrições com maior gasto.
+    parameters:
+      - in: query
+        name: user_id
+        type: integer
+        required: true
+        description: ID do usuário
+        example: 1
+      - in: query
+        name: inicio
+        type: string
+        required: false
+        description: Primeiro mês (inclusive), formato YYYY-MM
+        example: "2025-01"
+      - in: query
+        name: fim
+        type: string
+        required: false
+        description: Último mês (inclusive), formato YYYY-MM
+        example: "2025-12"
+      - in: query
+        name: top
+        type: integer
+        required: false
+        description: Quantidade de descrições com maior gasto a retornar (máx. 100)
+        example: 5
+    responses:
+      200:
+        description: Resumo do período
+        schema:
+          type: object
+          properties:
+            meses:
+              type: array
+              items:
+                type: object
+                properties:
+                  ano:
+                    type: integer
+                    example: 2025
+                  mes:
+                    type: integer
+                    example: 9
+                  total:
+                    type: number
+                    example: 1250.50
+                  quantidade:
+                    type: integer
+                    example: 42
+                  meta:
+                    type: number
+                    example: 1500.00
+                  percentual:
+                    type: number
+                    example: 83.37
+                  dentro_da_meta:
+                    type: boolean
+                    example: true
+            anos:
+              type: array
+              items:
+                type: object
+                properties:
+                  ano:
+                    type: integer
+                    example: 2025
+                  total:
+                    type: number
+                    example: 15000.00
+                  quantidade:
+                    type: integer
+                    example: 480
+            total:
+              type: number
+              example: 15000.00
+            top_descricoes:
+              type: array
+              items:
+                type: object
+                properties:
+                  descricao:
+                    type: string
+                    example: "Mercado"
+                  total:
+                    type: number
+                    example: 3200.00
+                  quantidade:
+                    type: integer
+                    example: 12
+      400:
+        description: Query param 'user_id' ausente ou parâmetros inválidos
       500:
         description: Erro no banco de dados
     """
-    user_id = request.args.get("user_id", type=int)
+    user_id = usuario_atual(request.args.get("user_id", type=int))
     if user_id is None:
         return jsonify({"erro": "Query param 'user_id' é obrigatório"}), 400
+
+    try:
+        inicio = parametro_data("inicio", "%Y-%m")
+        fim = parametro_data("fim", "%Y-%m")
+    except ParametroInvalido as e:
+        return jsonify({"erro": str(e)}), 400
+    top = request.args.get("top", 0, type=int)
+    if top < 0:
+        return jsonify({"erro": "Parâmetro 'top' deve ser positivo"}), 400
+    top = min(top, 100)
+
+    ano_ini, mes_ini = (inicio.year, inicio.month) if inicio else (0, 1)
+    ano_fim, mes_fim = (fim.year, fim.month) if fim else (9999, 12)
+    periodo = (ano_ini, mes_ini, ano_fim, mes_fim)
+
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db_usuario(user_id) as conn:
             c = conn.cursor()
-            c.execute("SELECT id, descricao, valor, data FROM despesas WHERE user_id=?", (user_id,))
+            # Totais mensais pré-calculados + metas, agrupados numa só passada
+            c.execute("""
+                SELECT ano, mes, SUM(total_centavos), SUM(quantidade), MAX(meta) FROM (
+                    SELECT ano, mes, total_centavos, quantidade, NULL AS meta FROM despesas_mensal
+                    WHERE user_id=? AND (ano, mes) >= (?, ?) AND (ano, mes) <= (?, ?)
+                    UNION ALL
+                    SELECT ano, mes, 0, 0, valor_centavos FROM metas
+                    WHERE user_id=? AND (ano, mes) >= (?, ?) AND (ano, mes) <= (?, ?)
+                )
+                GROUP BY ano, mes
+                ORDER BY ano, mes
+            """, (user_id, *periodo, user_id, *periodo))
             rows = c.fetchall()
-        despesas = [{"id": r[0], "descricao": r[1], "valor": r[2], "data": r[3]} for r in rows]
-        return jsonify({"despesas": despesas}), 200
+
+            top_descricoes = []
+            if top:
+                filtros = ["user_id=?"]
+                args = [user_id]
+                if inicio:
+                    filtros.append("data_num >= ?")
+                    args.append(intervalo_mes(ano_ini, mes_ini)[0])
+                if fim:
+                    filtros.append("data_num < ?")
+                    args.append(intervalo_mes(ano_fim, mes_fim)[1])
+                fonte, fonte_args = fonte_despesas(user_id, meses_arquivados(
+                    c, user_id, "(ano, mes) >= (?, ?) AND (ano, mes) <= (?, ?)", periodo))
+                c.execute(f"""
+                    SELECT descricao, SUM(valor_centavos) AS soma, COUNT(*) FROM {fonte}
+                    WHERE {" AND ".join(filtros)}
+                    GROUP BY descricao
+                    ORDER BY soma DESC
+                    LIMIT ?
+                """, (*fonte_args, *args, top))
+                top_descricoes = [{"descricao": r[0], "total": de_centavos(r[1]), "quantidade": r[2]}
+                                  for r in c.fetchall()]
+
+        # Somas feitas em centavos; convertidas para reais só na resposta
+        meses = []
+        anos = {}
+        for ano, mes, total, quantidade, meta in rows:
+            percentual = round(total / meta * 100, 2) if meta else None
+            meses.append({"ano": ano, "mes": mes, "total": de_centavos(total), "quantidade": quantidade,
+                          "meta": de_centavos(meta), "percentual": percentual,
+                          "dentro_da_meta": None if meta is None else total <= meta})
+            acumulado = anos.setdefault(ano, {"ano": ano, "total": 0, "quantidade": 0})
+            acumulado["total"] += total
+            acumulado["quantidade"] += quantidade
+        total_geral = sum(a["total"] for a in anos.values())
+        for acumulado in anos.values():
+            acumulado["total"] = de_centavos(acumulado["total"])
+
+        return jsonify({"meses": meses, "anos": list(anos.values()),
+                        "total": de_centavos(total_geral),
+                        "top_descricoes": top_descricoes}), 200
+
     except sqlite3.Error as e:
         return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
 
-@app.route('/despesas/<int:id>', methods=['PUT'])
+@api.route('/despesas/<int:id>', methods=['PUT'])
+@autenticado
 def atualizar_despesa(id):
     """
     Atualizar uma despesa
@@ -422,40 +3494,57 @@ def atualizar_despesa(id):
         description: Erro no banco de dados
     """
     data = request.get_json() or {}
-    user_id = data.get("user_id")
+    user_id = usuario_atual(data.get("user_id"))
     if user_id is None:
         return jsonify({"erro": "Campo 'user_id' obrigatório"}), 400
 
     descricao = data.get("descricao")
     valor = data.get("valor")
+    if descricao is not None and not isinstance(descricao, str):
+        return jsonify({"erro": "Campo 'descricao' deve ser texto"}), 400
 
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            c.execute("SELECT id FROM despesas WHERE id=? AND user_id=?", (id, user_id))
-            if not c.fetchone():
-                return jsonify({"erro": "Despesa não encontrada"}), 404
+    centavos = None
+    if valor is not None:
+        try:
+            centavos = para_centavos(valor)
+        except ValueError:
+            return jsonify({"erro": "Valor deve ser numérico"}), 400
 
-            if valor is not None:
-                valor = float(valor)
+    arquivo = arquivo_frio(current_app.config)
 
-            c.execute("""
-                UPDATE despesas
-                SET descricao = COALESCE(?, descricao),
-                    valor = COALESCE(?, valor)
-                WHERE id=? AND user_id=?
-            """, (descricao, valor, id, user_id))
-            c.execute("SELECT id, descricao, valor, data FROM despesas WHERE id=? AND user_id=?", (id, user_id))
-            row = c.fetchone()
+    def atualizar(conn):
+        c = conn.cursor()
+        restaurar_se_arquivada(c, arquivo, user_id, id)
+        c.execute("""
+            UPDATE despesas
+            SET descricao = COALESCE(?, descricao),
+                valor_centavos = COALESCE(?, valor_centavos)
+            WHERE id=? AND user_id=?
+            RETURNING id, descricao, valor_centavos, data_num
+        """, (descricao, centavos, id, user_id))
+        rows = c.fetchall()
+        if not rows:
+            return None
+        row = rows[0]
+        if centavos is not None:
+            recalcular_total_mes(c, user_id, row[3])
+        return row
+
+    try:
+        row = executar_escrita(atualizar, user_id)
+        if row is None:
+            return jsonify({"erro": "Despesa não encontrada"}), 404
+        invalidar_cache(user_id, "despesas", tag_mes("despesas", *ano_mes(row[3])))
 
         return jsonify({"message": "Despesa modificada com sucesso!",
                         "despesa": {"id": row[0], "descricao": row[1],
-                                    "valor": row[2], "data": row[3]}}), 200
+                                    "valor": de_centavos(row[2]), "data": num_para_data(row[3])}}), 200
 
     except sqlite3.Error as e:
         return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
 
-@app.route('/despesas/<int:id>', methods=['DELETE'])
+@api.route('/despesas/<int:id>', methods=['DELETE'])
+@autenticado
 def deletar_despesa(id):
     """
     Deletar uma despesa
@@ -492,25 +3581,37 @@ def deletar_despesa(id):
       500:
         description: Erro no banco de dados
     """
-    user_id = request.args.get("user_id", type=int)
+    user_id = usuario_atual(request.args.get("user_id", type=int))
     if user_id is None:
         return jsonify({"erro": "Query param 'user_id' é obrigatório"}), 400
 
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            c.execute("SELECT id FROM despesas WHERE id=? AND user_id=?", (id, user_id))
-            if not c.fetchone():
-                return jsonify({"erro": "Despesa não encontrada"}), 404
+    arquivo = arquivo_frio(current_app.config)
+
+    def remover(conn):
+        c = conn.cursor()
+        restaurar_se_arquivada(c, arquivo, user_id, id)
+        c.execute("DELETE FROM despesas WHERE id=? AND user_id=? RETURNING data_num", (id, user_id))
+        rows = c.fetchall()
+        if not rows:
+            return None
+
+        recalcular_total_mes(c, user_id, rows[0][0])
+        return rows[0][0]
 
-            c.execute("DELETE FROM despesas WHERE id=? AND user_id=?", (id, user_id))
+    try:
+        data_num = executar_escrita(remover, user_id)
+        if data_num is None:
+            return jsonify({"erro": "Despesa não encontrada"}), 404
+        invalidar_cache(user_id, "despesas", tag_mes("despesas", *ano_mes(data_num)))
 
         return jsonify({"message": "Despesa removida com sucesso!"}), 200
 
     except sqlite3.Error as e:
         return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
 
-@app.route('/despesas/<int:year>/<int:month>', methods=['GET'])
+@api.route('/despesas/<int:year>/<int:month>', methods=['GET'])
+@autenticado
+@cache_resposta("despesas:{year:04d}-{month:02d}")
 def despesas_por_mes(year, month):
     """
     Listar despesas de um usuário em um mês específico
@@ -568,25 +3669,32 @@ def despesas_por_mes(year, month):
       500:
         description: Erro no banco de dados
     """
-    user_id = request.args.get("user_id", type=int)
+    user_id = usuario_atual(request.args.get("user_id", type=int))
     if user_id is None:
         return jsonify({"erro": "Query param 'user_id' é obrigatório"}), 400
 
+    if not 1 <= month <= 12:
+        return jsonify({"despesas": [], "total": 0}), 200
+
+    inicio, fim = intervalo_mes(year, month)
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db_usuario(user_id) as conn:
             c = conn.cursor()
-            c.execute("SELECT id, descricao, valor, data FROM despesas WHERE user_id=?", (user_id,))
+            fonte, fonte_args = fonte_despesas(
+                user_id, meses_arquivados(c, user_id, "ano=? AND mes=?", (year, month)))
+            # Filtro por intervalo em (user_id, data_num), atendido pelo índice idx_despesas_user_data
+            c.execute(f"""
+                SELECT {json_objeto_sql(("id", "descricao", "valor", "data"))} FROM {fonte}
+                WHERE user_id=? AND data_num >= ? AND data_num < ?
+                ORDER BY data_num, id
+            """, (*fonte_args, user_id, inicio, fim))
             rows = c.fetchall()
+            c.execute("SELECT total_centavos FROM despesas_mensal WHERE user_id=? AND ano=? AND mes=?",
+                      (user_id, year, month))
+            row = c.fetchone()
+            total = de_centavos(row[0]) if row else 0
 
-        filtradas = []
-        total = 0
-        for r in rows:
-            dt = datetime.strptime(r[3], "%Y-%m-%d")
-            if dt.year == year and dt.month == month:
-                filtradas.append({"id": r[0], "descricao": r[1], "valor": r[2], "data": r[3]})
-                total += r[2]
-
-        return jsonify({"despesas": filtradas, "total": total}), 200
+        return resposta_json_linhas("despesas", (r[0] for r in rows), total=total), 200
 
     except sqlite3.Error as e:
         return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
@@ -594,10 +3702,11 @@ def despesas_por_mes(year, month):
 # -------------------------
 # Metas
 # -------------------------
-@app.route('/metas', methods=['POST'])
+@api.route('/metas', methods=['POST'])
+@autenticado
 def criar_atualizar_meta():
     data = request.get_json() or {}
-    user_id = data.get("user_id")
+    user_id = usuario_atual(data.get("user_id"))
     ano = data.get("ano")
     mes = data.get("mes")
     valor = data.get("valor")
@@ -609,26 +3718,29 @@ def criar_atualizar_meta():
         user_id = int(user_id)
         ano = int(ano)
         mes = int(mes)
-        valor = float(valor)
+        centavos = para_centavos(valor)
     except:
         return jsonify({"erro": "Campos 'user_id', 'ano', 'mes' e 'valor' devem ser numéricos"}), 400
 
+    def salvar(conn):
+        c = conn.cursor()
+        # Cria ou atualiza numa instrução só. O RETURNING mostra a linha antes dos
+        # gatilhos AFTER: uma meta recém-criada ainda tem versao 0 (o default),
+        # que metas_versao_ai troca em seguida; uma existente já tem versao >= 1.
+        c.execute("""
+            INSERT INTO metas (user_id, ano, mes, valor_centavos) VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, ano, mes) DO UPDATE SET valor_centavos=excluded.valor_centavos
+            RETURNING versao = 0
+        """, (user_id, ano, mes, centavos))
+        return bool(c.fetchone()[0])
+
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            # Verifica se já existe meta
-            c.execute("SELECT id FROM metas WHERE user_id=? AND ano=? AND mes=?", (user_id, ano, mes))
-            row = c.fetchone()
-            if row:
-                # Atualiza
-                c.execute("UPDATE metas SET valor=? WHERE id=?", (valor, row[0]))
-                return jsonify({"message": "Meta atualizada com sucesso!",
-                                "meta": {"user_id": user_id, "ano": ano, "mes": mes, "valor": valor}}), 200
-            else:
-                # Cria nova
-                c.execute("INSERT INTO metas (user_id, ano, mes, valor) VALUES (?, ?, ?, ?)", (user_id, ano, mes, valor))
-                return jsonify({"message": "Meta criada com sucesso!",
-                                "meta": {"user_id": user_id, "ano": ano, "mes": mes, "valor": valor}}), 201
+        criada = executar_escrita(salvar, user_id)
+        invalidar_cache(user_id, "metas", tag_mes("metas", ano, mes))
+        meta = {"user_id": user_id, "ano": ano, "mes": mes, "valor": de_centavos(centavos)}
+        if criada:
+            return jsonify({"message": "Meta criada com sucesso!", "meta": meta}), 201
+        return jsonify({"message": "Meta atualizada com sucesso!", "meta": meta}), 200
 
     except sqlite3.Error as e:
         return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
@@ -636,14 +3748,18 @@ def criar_atualizar_meta():
 # -------------------------
 # Listar metas
 # -------------------------
-@app.route('/metas', methods=['GET'])
+@api.route('/metas', methods=['GET'])
+@autenticado
+@cache_resposta("metas")
 def listar_metas():
     """
     Listar todas as metas de um usuário
     ---
     tags:
       - Metas
-    description: Retorna todas as metas cadastradas de um usuário.
+    description: >
+      Retorna as metas de um usuário em páginas, ordenadas por ano e mês.
+      Use `next_cursor` da resposta no parâmetro `cursor` para a página seguinte.
     parameters:
       - in: query
         name: user_id
@@ -651,9 +3767,46 @@ def listar_metas():
         required: true
         description: ID do usuário cujas metas serão listadas
         example: 1
+      - in: query
+        name: limit
+        type: integer
+        required: false
+        description: Tamanho da página (padrão 100, máximo 1000)
+        example: 12
+      - in: query
+        name: cursor
+        type: string
+        required: false
+        description: Cursor opaco devolvido em `next_cursor`
+      - in: query
+        name: mes_inicio
+        type: string
+        required: false
+        description: Primeiro mês (inclusive), formato YYYY-MM
+        example: "2025-01"
+      - in: query
+        name: mes_fim
+        type: string
+        required: false
+        description: Último mês (inclusive), formato YYYY-MM
+        example: "2025-12"
+      - in: query
+        name: valor_min
+        type: number
+        required: false
+      - in: query
+        name: valor_max
+        type: number
+        required: false
+      - in: query
+        name: fields
+        type: string
+        required: false
+        description: Campos retornados, separados por vírgula (ano, mes, valor)
+        example: "mes,valor"
     responses:
       200:
-        description: Lista de metas
+        description: Página de metas
         schema:
           type: object
           properties:
@@ -671,48 +3824,709 @@ def listar_metas():
                   valor:
                     type: number
                     example: 1500.00
+            next_cursor:
+              type: string
+              description: Cursor da próxima página, ou null se não houver
       400:
-        description: Query param 'user_id' ausente
+        description: Query param 'user_id' ausente ou parâmetros inválidos
       500:
         description: Erro no banco de dados
     """
-    user_id = request.args.get("user_id", type=int)
+    user_id = usuario_atual(request.args.get("user_id", type=int))
     if user_id is None:
         return jsonify({"erro": "Query param 'user_id' é obrigatório"}), 400
 
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        limite = parametro_limite()
+        campos = parametro_campos(("ano", "mes", "valor"))
+        mes_inicio = parametro_data("mes_inicio", "%Y-%m")
+        mes_fim = parametro_data("mes_fim", "%Y-%m")
+        valor_min = parametro_centavos("valor_min")
+        valor_max = parametro_centavos("valor_max")
+        cursor = request.args.get("cursor")
+        chave = decodificar_cursor(cursor, "ano_mes") if cursor else None
+    except ParametroInvalido as e:
+        return jsonify({"erro": str(e)}), 400
+
+    filtros = ["user_id=?"]
+    args = [user_id]
+    if mes_inicio is not None:
+        filtros.append("(ano, mes) >= (?, ?)")
+        args.extend((mes_inicio.year, mes_inicio.month))
+    if mes_fim is not None:
+        filtros.append("(ano, mes) <= (?, ?)")
+        args.extend((mes_fim.year, mes_fim.month))
+    if valor_min is not None:
+        filtros.append("valor_centavos >= ?")
+        args.append(valor_min)
+    if valor_max is not None:
+        filtros.append("valor_centavos <= ?")
+        args.append(valor_max)
+    if chave is not None:
+        filtros.append("(ano, mes) > (?, ?)")
+        args.extend(chave)
+
+    try:
+        with get_db_usuario(user_id) as conn:
             c = conn.cursor()
-            c.execute("SELECT ano, mes, valor FROM metas WHERE user_id=?", (user_id,))
+            c.execute(f"""
+                SELECT ano, mes, {json_objeto_sql(campos)} FROM metas
+                WHERE {" AND ".join(filtros)}
+                ORDER BY ano, mes
+                LIMIT ?
+            """, (*args, limite + 1))
             rows = c.fetchall()
 
-        metas = [{"ano": r[0], "mes": r[1], "valor": r[2]} for r in rows]
-        return jsonify({"metas": metas}), 200
+        next_cursor = None
+        if len(rows) > limite:
+            rows = rows[:limite]
+            next_cursor = codificar_cursor("ano_mes", [rows[-1][0], rows[-1][1]])
+
+        return resposta_json_linhas("metas", (r[2] for r in rows), next_cursor=next_cursor), 200
 
     except sqlite3.Error as e:
         return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
 
-@app.route('/metas/<int:ano>/<int:mes>', methods=['GET'])
+@api.route('/metas/<int:ano>/<int:mes>', methods=['GET'])
+@autenticado
+@cache_resposta("metas:{ano:04d}-{mes:02d}")
 def meta_mes(ano, mes):
-    user_id = request.args.get("user_id", type=int)
+    user_id = usuario_atual(request.args.get("user_id", type=int))
     if user_id is None:
         return jsonify({"erro": "Query param 'user_id' é obrigatório"}), 400
 
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db_usuario(user_id) as conn:
             c = conn.cursor()
-            c.execute("SELECT valor FROM metas WHERE user_id=? AND ano=? AND mes=?", (user_id, ano, mes))
+            c.execute("SELECT valor_centavos FROM metas WHERE user_id=? AND ano=? AND mes=?", (user_id, ano, mes))
             row = c.fetchone()
 
         if row:
-            return jsonify({"meta": {"user_id": user_id, "ano": ano, "mes": mes, "valor": row[0]}}), 200
+            return jsonify({"meta": {"user_id": user_id, "ano": ano, "mes": mes,
+                                     "valor": de_centavos(row[0])}}), 200
         return jsonify({"erro": "Meta não encontrada"}), 404
 
     except sqlite3.Error as e:
         return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
 
+@api.route('/metas/<int:ano>/<int:mes>/progresso', methods=['GET'])
+@autenticado
+@cache_resposta("despesas:{ano:04d}-{mes:02d}", "metas:{ano:04d}-{mes:02d}")
+def progresso_meta(ano, mes):
+    """
+    Gasto do mês comparado com a meta
+    ---
+    tags:
+      - Metas
+    description: >
+      Retorna, numa única consulta, a meta do mês e o total gasto (a partir dos
+      totais mensais pré-calculados), com saldo e percentual atingido.
+    parameters:
+      - in: path
+        name: ano
+        type: integer
+        required: true
+        example: 2025
+      - in: path
+        name: mes
+        type: integer
+        required: true
+        example: 9
+      - in: query
+        name: user_id
+        type: integer
+        required: true
+        description: ID do usuário
+        example: 1
+    responses:
+      200:
+        description: Meta e gasto do mês
+        schema:
+          type: object
+          properties:
+            user_id:
+              type: integer
+              example: 1
+            ano:
+              type: integer
+              example: 2025
+            mes:
+              type: integer
+              example: 9
+            meta:
+              type: number
+              example: 1500.00
+              description: Valor da meta, ou null se não houver
+            gasto:
+              type: number
+              example: 1250.50
+            quantidade:
+              type: integer
+              example: 42
+            minimo:
+              type: number
+              example: 3.50
+            maximo:
+              type: number
+              example: 320.00
+            saldo:
+              type: number
+              example: 249.50
+              description: Meta menos gasto, ou null se não houver meta
+            percentual:
+              type: number
+              example: 83.37
+              description: Gasto em relação à meta (%), ou null se não houver meta
+      400:
+        description: Query param 'user_id' ausente
+      500:
+        description: Erro no banco de dados
+    """
+    user_id = usuario_atual(request.args.get("user_id", type=int))
+    if user_id is None:
+        return jsonify({"erro": "Query param 'user_id' é obrigatório"}), 400
+
+    try:
+        with get_db_usuario(user_id) as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT (SELECT valor_centavos FROM metas WHERE user_id=? AND ano=? AND mes=?),
+                       t.total_centavos, t.quantidade, t.minimo_centavos, t.maximo_centavos
+                FROM (SELECT 1)
+                LEFT JOIN despesas_mensal t ON t.user_id=? AND t.ano=? AND t.mes=?
+            """, (user_id, ano, mes, user_id, ano, mes))
+            meta, gasto, quantidade, minimo, maximo = c.fetchone()
+
+        gasto = gasto or 0
+        saldo = percentual = None
+        if meta is not None:
+            saldo = meta - gasto
+            percentual = round(gasto / meta * 100, 2) if meta else None
+        return jsonify({"user_id": user_id, "ano": ano, "mes": mes,
+                        "meta": de_centavos(meta), "gasto": de_centavos(gasto), "quantidade": quantidade or 0,
+                        "minimo": de_centavos(minimo), "maximo": de_centavos(maximo),
+                        "saldo": de_centavos(saldo), "percentual": percentual}), 200
+
+    except sqlite3.Error as e:
+        return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
+
+# -------------------------
+# Sincronização incremental
+# -------------------------
+@api.route('/sync', methods=['GET'])
+@autenticado
+@cache_resposta("despesas", "metas")
+def sincronizar():
+    """
+    Alterações em despesas e metas desde uma versão
+    ---
+    tags:
+      - Sincronização
+    description: >
+      Cada inclusão, alteração ou remoção de despesa ou meta recebe uma versão
+      crescente. Passe em `since` a última `versao` recebida (0 na primeira
+      vez) para obter só o que mudou depois dela: despesas e metas incluídas
+      ou alteradas (estado atual) e as removidas. Enquanto `tem_mais` for
+      true, repita a chamada com `since` igual à `versao` devolvida.
+    parameters:
+      - in: query
+        name: user_id
+        type: integer
+        required: true
+        example: 1
+      - in: query
+        name: since
+        type: integer
+        required: false
+        description: Última versão já recebida (padrão 0)
+        example: 0
+      - in: query
+        name: limit
+        type: integer
+        required: false
+        description: Máximo de alterações por página (padrão 100, máximo 1000)
+    responses:
+      200:
+        description: Alterações posteriores a `since`, em ordem de versão
+        schema:
+          type: object
+          properties:
+            despesas:
+              type: array
+              items:
+                type: object
+                properties:
+                  id:
+                    type: integer
+                    example: 1
+                  descricao:
+                    type: string
+                    example: "Almoço"
+                  valor:
+                    type: number
+                    example: 25.50
+                  data:
+                    type: string
+                    example: "2025-09-22"
+                  versao:
+                    type: integer
+                    example: 42
+            metas:
+              type: array
+              items:
+                type: object
+                properties:
+                  id:
+                    type: integer
+                  ano:
+                    type: integer
+                  mes:
+                    type: integer
+                  valor:
+                    type: number
+                  versao:
+                    type: integer
+            removidas:
+              type: array
+              items:
+                type: object
+                properties:
+                  tabela:
+                    type: string
+                    enum: [despesas, metas]
+                  id:
+                    type: integer
+                  versao:
+                    type: integer
+            versao:
+              type: integer
+              description: Versão a enviar em `since` na próxima chamada
+            tem_mais:
+              type: boolean
+      400:
+        description: Query param 'user_id' ausente ou parâmetros inválidos
+      500:
+        description: Erro no banco de dados
+    """
+    user_id = usuario_atual(request.args.get("user_id", type=int))
+    if user_id is None:
+        return jsonify({"erro": "Query param 'user_id' é obrigatório"}), 400
+
+    try:
+        since = int(request.args.get("since", "0"))
+        if since < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({"erro": "Parâmetro 'since' deve ser um inteiro não negativo"}), 400
+    try:
+        limite = parametro_limite()
+    except ParametroInvalido as e:
+        return jsonify({"erro": str(e)}), 400
+
+    try:
+        with get_db_usuario(user_id) as conn:
+            c = conn.cursor()
+            # Despesas arquivadas mantêm a versão: só entram meses com alguma versão depois de `since`
+            fonte, fonte_args = fonte_despesas(
+                user_id, meses_arquivados(c, user_id, "max_versao > ?", (since,)))
+            # Cada parte é lida pelo índice (user_id, versao) da própria tabela
+            c.execute(f"""
+                SELECT versao, 'despesas', {json_objeto_sql(("id", "descricao", "valor", "data", "versao"))}
+                FROM {fonte} WHERE user_id=? AND versao > ?
+                UNION ALL
+                SELECT versao, 'metas', {json_objeto_sql(("id", "ano", "mes", "valor", "versao"))}
+                FROM metas WHERE user_id=? AND versao > ?
+                UNION ALL
+                SELECT versao, 'removidas', {json_objeto_sql(("tabela", "id", "versao"))}
+                FROM remocoes WHERE user_id=? AND versao > ?
+                ORDER BY 1
+                LIMIT ?
+            """, (*fonte_args, user_id, since, user_id, since, user_id, since, limite + 1))
+            rows = c.fetchall()
+
+        tem_mais = len(rows) > limite
+        rows = rows[:limite]
+        partes = {"despesas": [], "metas": [], "removidas": []}
+        for _, tipo, objeto in rows:
+            partes[tipo].append(objeto)
+        versao = rows[-1][0] if rows else since
+        return resposta_json_listas(partes, versao=versao, tem_mais=tem_mais), 200
+
+    except sqlite3.Error as e:
+        return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
+
+# -------------------------
+# Lote de operações
+# -------------------------
+# POST /batch executa várias chamadas da API numa só ida e volta. Cada
+# operação passa pelo despacho normal do Flask (autenticação, limites, rota,
+# hooks) dentro do contexto da aplicação da requisição externa, então todas
+# usam a mesma conexão do pool (g.db). Com "transacao", as escritas também
+# ficam numa única transação, confirmada só se todas as operações derem certo.
+METODOS_LOTE = ("GET", "POST", "PUT", "DELETE")
+# Chaves de `g` que pertencem ao lote inteiro, e não a cada operação
+_CHAVES_LOTE = ("db", "db_shards", "transacao_lote", "invalidacoes_lote", "em_lote")
+
+
+class ConexaoLote:
+    """
+    Conexão entregue às rotas durante um lote com transação: `with conn` e
+    commit() não confirmam nada; o lote faz commit ou rollback no final.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, nome):
+        return getattr(self._conn, nome)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, exc, tb):
+        return False
+
+    def commit(self):
+        pass
+
+
+def _na_transacao_lote(conn):
+    lote = g.get("transacao_lote")
+    if lote is None:
+        return conn
+    envolvida = lote.get(id(conn))
+    if envolvida is None:
+        # IMMEDIATE: o lote pega o lock de escrita logo, em vez de falhar ao promover a leitura
+        conn.execute("BEGIN IMMEDIATE")
+        envolvida = lote[id(conn)] = ConexaoLote(conn)
+    return envolvida
+
+
+def _encerrar_transacao_lote(confirmar):
+    pendentes = g.pop("invalidacoes_lote", [])
+    try:
+        for envolvida in g.pop("transacao_lote", {}).values():
+            if confirmar:
+                envolvida._conn.commit()
+            else:
+                envolvida._conn.rollback()
+    finally:
+        # Também depois de um rollback ou de um commit que falhou no meio (shards): só custa um cache miss
+        for user_id, tags in pendentes:
+            invalidar_cache(user_id, *tags)
+
+
+def _corpo_resposta(resposta):
+    if resposta.is_json:
+        return resposta.get_json()
+    texto = resposta.get_data(as_text=True)
+    return texto or None
+
+
+def executar_operacao(operacao, autorizacao):
+    """Despacha uma operação do lote; devolve (status, corpo)."""
+    if not isinstance(operacao, dict):
+        return 400, {"erro": "Operação deve ser um objeto"}
+    metodo = str(operacao.get("method", "GET")).upper()
+    caminho = operacao.get("path")
+    if metodo not in METODOS_LOTE:
+        return 400, {"erro": f"Método deve ser um de {', '.join(METODOS_LOTE)}"}
+    if not isinstance(caminho, str) or not caminho.startswith("/"):
+        return 400, {"erro": "Campo 'path' obrigatório, começando com '/'"}
+    if caminho.split("?", 1)[0].rstrip("/") == "/batch":
+        return 400, {"erro": "POST /batch não pode ser aninhado"}
+    cabecalhos = operacao.get("headers") or {}
+    if not isinstance(cabecalhos, dict):
+        return 400, {"erro": "Campo 'headers' deve ser um objeto"}
+    if autorizacao and not any(k.lower() == "authorization" for k in cabecalhos):
+        cabecalhos = {**cabecalhos, "Authorization": autorizacao}
+
+    argumentos = {"path": caminho, "method": metodo, "headers": cabecalhos,
+                  "environ_base": {"REMOTE_ADDR": request.remote_addr}}
+    if operacao.get("body") is not None:
+        argumentos["json"] = operacao["body"]
+    environ = EnvironBuilder(**argumentos).get_environ()
+
+    app = current_app._get_current_object()
+    salvo = {k: v for k, v in vars(g).items() if k not in _CHAVES_LOTE}
+    try:
+        with app.request_context(environ):
+            try:
+                resposta = app.full_dispatch_request()
+            except Exception:
+                app.logger.exception("Erro na operação %s %s de POST /batch", metodo, caminho)
+                return 500, {"erro": "Erro interno"}
+            return resposta.status_code, _corpo_resposta(resposta)
+    finally:
+        # O contexto da aplicação é compartilhado: devolve ao lote o que a operação alterou em `g`
+        for chave in [k for k in vars(g) if k not in _CHAVES_LOTE]:
+            delattr(g, chave)
+        vars(g).update(salvo)
+
+
+@api.route('/batch', methods=['POST'])
+@autenticado
+def executar_lote():
+    """
+    Executar várias operações numa só requisição
+    ---
+    tags:
+      - Lote
+    description: >
+      Recebe uma lista de operações da própria API e devolve, na mesma ordem,
+      o status e o corpo de cada uma. As operações rodam em sequência, na mesma
+      conexão com o banco; o token do cabeçalho Authorization vale para todas.
+      Com `transacao: true`, as escritas ficam numa única transação: na
+      primeira operação que falhar (status >= 400) tudo é desfeito e as
+      seguintes não são executadas (status 424).
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: object
+          required:
+            - operacoes
+          properties:
+            transacao:
+              type: boolean
+              example: false
+            operacoes:
+              type: array
+              items:
+                type: object
+                properties:
+                  method:
+                    type: string
+                    enum: [GET, POST, PUT, DELETE]
+                    example: "GET"
+                  path:
+                    type: string
+                    example: "/metas?user_id=1"
+                  body:
+                    type: object
+                  headers:
+                    type: object
+    responses:
+      200:
+        description: Todas as operações terminaram com sucesso
+        schema:
+          type: object
+          properties:
+            respostas:
+              type: array
+              items:
+                type: object
+                properties:
+                  status:
+                    type: integer
+                    example: 200
+                  body:
+                    type: object
+            confirmada:
+              type: boolean
+              description: Só com `transacao`; false se as escritas foram desfeitas
+      207:
+        description: Alguma operação falhou (ver o status de cada uma)
+      400:
+        description: Corpo inválido
+      413:
+        description: Operações demais num só lote
+      500:
+        description: Erro no banco de dados
+    """
+    corpo = request.get_json(silent=True)
+    operacoes = corpo.get("operacoes") if isinstance(corpo, dict) else None
+    if not isinstance(operacoes, list):
+        return jsonify({"erro": "Campo 'operacoes' deve ser uma lista"}), 400
+    if len(operacoes) > current_app.config["LOTE_MAX_OPERACOES"]:
+        return jsonify({"erro": f"Lote excede {current_app.config['LOTE_MAX_OPERACOES']} operações"}), 413
+    transacao = bool(corpo.get("transacao"))
+    autorizacao = request.headers.get("Authorization")
+
+    respostas = []
+    falhou = False
+    g.em_lote = True
+    if transacao:
+        g.transacao_lote = {}
+        g.invalidacoes_lote = []
+    try:
+        for operacao in operacoes:
+            if transacao and falhou:
+                respostas.append({"status": 424, "body": {"erro": "Não executada: uma operação anterior falhou"}})
+                continue
+            status, corpo_resposta = executar_operacao(operacao, autorizacao)
+            respostas.append({"status": status, "body": corpo_resposta})
+            falhou = falhou or status >= 400
+        if transacao:
+            _encerrar_transacao_lote(confirmar=not falhou)
+    except sqlite3.Error as e:
+        return jsonify({"erro": f"Erro no banco de dados: {e}"}), 500
+    finally:
+        g.pop("em_lote", None)
+        if "transacao_lote" in g:
+            _encerrar_transacao_lote(confirmar=False)
+
+    resultado = {"respostas": respostas}
+    if transacao:
+        resultado["confirmada"] = not falhou
+    return jsonify(resultado), 207 if falhou else 200
+
+# -------------------------
+# Métricas (rota e hooks)
+# -------------------------
+def iniciar_medicao():
+    g.inicio_requisicao = time.perf_counter()
+
+
+def anotar_status(resposta):
+    g.status_requisicao = resposta.status_code
+    return resposta
+
+
+def registrar_medicao(exc):
+    # teardown_request: roda também após erros e, em respostas em streaming, ao fim do envio
+    inicio = g.pop("inicio_requisicao", None)
+    metricas = get_metricas()
+    if inicio is None or metricas is None:
+        return
+    duracao = time.perf_counter() - inicio
+    rota = request.url_rule.rule if request.url_rule is not None else "(sem rota)"
+    status = 500 if exc is not None else g.pop("status_requisicao", 500)
+    metricas.observar("http_requisicao_segundos", duracao, rota=rota, metodo=request.method)
+    metricas.contar("http_requisicoes_total", rota=rota, metodo=request.method, status=status)
+
+
+def _medidores():
+    """Valores lidos no momento da coleta: pool, escritor, cache e hash de senha."""
+    recursos = current_app.extensions["mvp"]
+    medidores = []
+    # Com sharding há um pool (e um escritor) por arquivo: os valores são somados
+    pools = [v for k, v in recursos.items() if k.split(":")[0] == "pool"]
+    if pools:
+        medidores += [("sqlite_pool_tamanho", "gauge", sum(p.size for p in pools)),
+                      ("sqlite_pool_conexoes_abertas", "gauge", sum(p.abertas for p in pools)),
+                      ("sqlite_pool_conexoes_livres", "gauge", sum(p._livres.qsize() for p in pools))]
+    escritores = [v for k, v in recursos.items() if k.split(":")[0] == "escritor"]
+    if escritores:
+        medidores += [("sqlite_escritor_fila", "gauge", sum(e.pendentes() for e in escritores)),
+                      ("sqlite_escritor_lotes_total", "counter", sum(e.lotes for e in escritores)),
+                      ("sqlite_escritor_escritas_total", "counter", sum(e.escritas for e in escritores))]
+    cache = recursos.get("cache")
+    if cache is not None:
+        medidores += [("cache_respostas_bytes", "gauge", cache.bytes),
+                      ("cache_respostas_itens", "gauge", len(cache._itens)),
+                      ("cache_respostas_acertos_total", "counter", cache.hits),
+                      ("cache_respostas_falhas_total", "counter", cache.misses)]
+    hash_pool = recursos.get("hash_pool")
+    if hash_pool is not None:
+        m = hash_pool.metricas()
+        medidores += [("senha_hash_em_fila", "gauge", m["em_fila"]),
+                      ("senha_hash_em_execucao", "gauge", m["em_execucao"]),
+                      ("senha_hash_concluidos_total", "counter", m["concluidas"]),
+                      ("senha_hash_rejeitados_total", "counter", m["rejeitadas"]),
+                      ("senha_hash_espera_segundos_total", "counter", m["espera_total"]),
+                      ("senha_hash_execucao_segundos_total", "counter", m["execucao_total"])]
+    return medidores
+
+
+@api.route('/metrics', methods=['GET'])
+def exportar_metricas():
+    """
+    Métricas da API no formato texto do Prometheus
+    ---
+    tags:
+      - Métricas
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Latência por rota, tempo dos statements SQL, pool, cache e hash de senha
+      404:
+        description: Métricas desligadas (METRICAS_ATIVAS=0)
+    """
+    registro = get_metricas()
+    if registro is None:
+        return jsonify({"erro": "Métricas desligadas"}), 404
+    return Response(registro.exportar(_medidores()),
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# -------------------------
+# Fábrica da aplicação
+# -------------------------
+def _configurar_swagger(app):
+    modo = app.config["SWAGGER_MODO"]
+    if modo == "dinamico":
+        # flasgger (e o parser YAML) só são importados quando a doc é gerada em tempo real
+        from flasgger import Swagger
+        Swagger(app, template=SWAGGER_TEMPLATE)
+    elif modo == "estatico":
+        # Spec pré-compilada por `flask gerar-spec`: servida como arquivo, sem flasgger
+        caminho = app.config["SWAGGER_SPEC_FILE"]
+
+        @app.route("/apispec_1.json")
+        def apispec_estatica():
+            if not os.path.exists(caminho):
+                return jsonify({"erro": "Especificação OpenAPI não gerada"}), 404
+            return send_file(caminho, mimetype="application/json", max_age=3600)
+    elif modo != "desligado":
+        raise ValueError(f"SWAGGER_MODO inválido: {modo!r}")
+
+
+def create_app(config=None):
+    """
+    Cria e configura a aplicação. `config` sobrescreve os valores padrão
+    (lidos das variáveis de ambiente). O banco não é tocado aqui: use
+    `flask init-db` (ou init_db() dentro de um app context) antes de servir.
+    """
+    app = Flask(__name__)
+    app.config.from_mapping(configuracao_padrao())
+    if config:
+        app.config.from_mapping(config)
+    app.json = escolher_json_provider(app.config["JSON_ENCODER"])(app)
+    app.extensions["mvp"] = {}
+    CORS(app)
+    app.register_blueprint(api)
+    app.teardown_appcontext(devolver_db)
+    if app.config["METRICAS_ATIVAS"]:
+        app.before_request(iniciar_medicao)
+        app.after_request(anotar_status)
+        app.teardown_request(registrar_medicao)
+    _configurar_swagger(app)
+    return app
+
+
+@api.cli.command("gerar-spec")
+def gerar_spec_comando():
+    """Gera SWAGGER_SPEC_FILE a partir das docstrings das rotas (usado por SWAGGER_MODO=estatico)."""
+    caminho = current_app.config["SWAGGER_SPEC_FILE"]
+    app = create_app({"SWAGGER_MODO": "dinamico", "DB_FILE": current_app.config["DB_FILE"]})
+    resposta = app.test_client().get("/apispec_1.json")
+    os.makedirs(os.path.dirname(caminho) or ".", exist_ok=True)
+    with open(caminho, "w", encoding="utf-8") as f:
+        json.dump(resposta.get_json(), f, ensure_ascii=False, indent=2, sort_keys=True)
+    print(f"Especificação gravada em {caminho}.")
+
+
+_app_padrao = None
+
+
+def __getattr__(nome):
+    # Compatibilidade com `app:app` (flask run, waitress): cria a aplicação na primeira leitura
+    global _app_padrao
+    if nome == "app":
+        if _app_padrao is None:
+            _app_padrao = iniciar_arquivador(create_app())
+        return _app_padrao
+    raise AttributeError(f"module {__name__!r} has no attribute {nome!r}")
+
+
 # -------------------------
 # Run
 # -------------------------
 if __name__ == '__main__':
+    app = iniciar_arquivador(create_app())
+    with app.app_context():
+        init_db()
     app.run(debug=True)
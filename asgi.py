@@ -0,0 +1,158 @@
+# asgi.py
+# Ponto de entrada ASGI da API, alternativo ao Waitress (WSGI).
+#
+#   flask --app app init-db
+#   uvicorn asgi:app --host 0.0.0.0 --port 5000
+#
+# O servidor ASGI cuida da conexão com o cliente no event loop: o corpo da
+# requisição é lido e a resposta é enviada sem ocupar thread nenhuma. Só o
+# processamento da rota — que é onde o SQLite é acessado — roda num executor
+# dedicado, com tantas threads quanto conexões no pool. Clientes lentos ou
+# rajadas de conexões abertas deixam de prender as threads que falam com o
+# banco. As rotas são as mesmas do app Flask; o caminho WSGI continua igual.
+#
+# Com ARQUIVO_INTERVALO_S > 0 cada processo roda o arquivamento periódico: com
+# `uvicorn --workers N`, deixe-o desligado e agende `flask arquivar-despesas`.
+
+import asyncio
+import contextvars
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from app import create_app, iniciar_arquivador
+
+# Bytes lidos do iterável da resposta por ida ao executor (streaming de /despesas/export)
+LOTE_RESPOSTA = 64 * 1024
+
+
+def montar_environ(scope, corpo):
+    """Environ WSGI (PEP 3333) equivalente ao scope HTTP do ASGI."""
+    servidor = scope.get("server") or ("localhost", 80)
+    cliente = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": servidor[0],
+        "SERVER_PORT": str(servidor[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": cliente[0],
+        "REMOTE_PORT": str(cliente[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(corpo),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for nome, valor in scope.get("headers", []):
+        nome = nome.decode("latin-1").upper().replace("-", "_")
+        valor = valor.decode("latin-1")
+        if nome in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            chave = nome
+        else:
+            chave = "HTTP_" + nome
+        environ[chave] = f"{environ[chave]},{valor}" if chave in environ else valor
+    environ.setdefault("CONTENT_LENGTH", str(len(corpo)))
+    return environ
+
+
+class AdaptadorASGI:
+    """
+    Executa uma aplicação WSGI sob um servidor ASGI.
+
+    A leitura do corpo e o envio da resposta são `await`s no event loop; a
+    chamada à aplicação e a leitura de cada trecho da resposta rodam em
+    `executor`. Entre um trecho e outro de uma resposta em streaming a thread
+    fica livre, mesmo que o cliente demore a consumir os dados.
+    """
+
+    def __init__(self, wsgi_app, workers):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="asgi-rotas")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+        else:
+            raise RuntimeError(f"Tipo de conexão ASGI não suportado: {scope['type']}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            mensagem = await receive()
+            if mensagem["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif mensagem["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        partes = []
+        while True:
+            mensagem = await receive()
+            if mensagem["type"] == "http.disconnect":
+                return
+            partes.append(mensagem.get("body", b""))
+            if not mensagem.get("more_body", False):
+                break
+        environ = montar_environ(scope, b"".join(partes))
+
+        loop = asyncio.get_running_loop()
+        # Um contexto por requisição: o contexto do Flask empurrado na primeira
+        # chamada continua visível nas seguintes, mesmo em outra thread do executor
+        contexto = contextvars.Context()
+        inicio = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and inicio:
+                raise exc_info[1].with_traceback(exc_info[2])
+            inicio["status"] = int(status.split(" ", 1)[0])
+            inicio["headers"] = [(n.lower().encode("latin-1"), v.encode("latin-1")) for n, v in headers]
+
+        def chamar():
+            iteravel = self.wsgi_app(environ, start_response)
+            iterador = iter(iteravel)
+            return iteravel, iterador, self._ler(iterador)
+
+        iteravel, iterador, (trecho, fim) = await loop.run_in_executor(self.executor, contexto.run, chamar)
+        try:
+            await send({"type": "http.response.start", "status": inicio["status"],
+                        "headers": inicio["headers"]})
+            while not fim:
+                await send({"type": "http.response.body", "body": trecho, "more_body": True})
+                trecho, fim = await loop.run_in_executor(self.executor, contexto.run, self._ler, iterador)
+            await send({"type": "http.response.body", "body": trecho, "more_body": False})
+        finally:
+            fechar = getattr(iteravel, "close", None)
+            if fechar is not None:
+                # Libera a conexão do banco presa a uma resposta em streaming
+                await loop.run_in_executor(self.executor, contexto.run, fechar)
+
+    @staticmethod
+    def _ler(iterador):
+        """Junta trechos da resposta até LOTE_RESPOSTA bytes; devolve (bytes, terminou)."""
+        partes, tamanho = [], 0
+        for parte in iterador:
+            if parte:
+                partes.append(parte)
+                tamanho += len(parte)
+                if tamanho >= LOTE_RESPOSTA:
+                    return b"".join(partes), False
+        return b"".join(partes), True
+
+
+def create_asgi_app(config=None):
+    """App ASGI com um executor do tamanho do pool de conexões (ou ASGI_WORKERS)."""
+    flask_app = iniciar_arquivador(create_app(config))
+    workers = int(os.environ.get("ASGI_WORKERS", flask_app.config["DB_POOL_SIZE"]))
+    return AdaptadorASGI(flask_app, workers)
+
+
+app = create_asgi_app()
@@ -0,0 +1,478 @@
+# bench/endpoints.py
+# Benchmark reprodutível de todas as rotas da API.
+#
+# Monta um banco sintético (usuários x despesas por usuário, com metas e
+# totais mensais), guardado em --pasta e reaproveitado entre execuções com os
+# mesmos parâmetros. Cada execução trabalha numa cópia dessa base, de modo que
+# as rotas de escrita não alteram o resultado da próxima rodada.
+#
+# As rotas são exercitadas pelo test client do Flask e, com --waitress e/ou
+# --asgi, também por HTTP contra um Waitress (WSGI) ou um uvicorn (asgi.py)
+# locais, com --clientes conexões simultâneas. O resultado (vazão e p50/p95/p99 por rota)
+# sai em JSON para ser comparado entre commits com --comparar.
+#
+# Uso:
+#   python bench/endpoints.py --perfil pequeno
+#   python bench/endpoints.py --usuarios 1000 --despesas-por-usuario 100 --waitress --saida atual.json
+#   python bench/endpoints.py --perfil medio --comparar anterior.json
+#   python bench/endpoints.py --waitress --asgi --threads 8 --clientes 64
+
+import argparse
+import datetime
+import glob
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+import app as api  # noqa: E402
+
+# (usuários, despesas por usuário): 10 mil, 1 milhão e 10 milhões de despesas
+PERFIS = {
+    "pequeno": (1_000, 10),
+    "medio": (10_000, 100),
+    "grande": (100_000, 100),
+}
+
+DESCRICOES = ["Mercado", "Aluguel", "Transporte", "Almoço", "Farmácia", "Internet",
+              "Academia", "Cinema", "Padaria", "Combustível", "Restaurante", "Luz"]
+ANOS = (2023, 2024, 2025)
+SENHA = "senha"
+
+
+# -------------------------
+# Base sintética
+# -------------------------
+def caminho_base(pasta, usuarios, por_usuario, semente):
+    return os.path.join(pasta, f"base-{usuarios}x{por_usuario}-s{semente}.db")
+
+
+def construir_base(caminho, usuarios, por_usuario, semente, senha_metodo):
+    """Cria o schema pela própria aplicação e insere os dados em lotes."""
+    from werkzeug.security import generate_password_hash
+
+    provisorio = caminho + ".tmp"
+    if os.path.exists(provisorio):
+        os.remove(provisorio)
+    aplicacao = api.create_app({"DB_FILE": provisorio, "SWAGGER_MODO": "desligado"})
+    with aplicacao.app_context():
+        api.init_db()
+
+    rng = random.Random(semente)
+    # Todos os usuários compartilham o mesmo hash: calcular um por usuário dominaria o tempo de montagem
+    senha_hash = generate_password_hash(SENHA, senha_metodo)
+    conn = sqlite3.connect(provisorio)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    lote = 50_000
+
+    for inicio in range(0, usuarios, lote):
+        conn.executemany(
+            "INSERT INTO users (id, nome, email, cpf, senha) VALUES (?, ?, ?, ?, ?)",
+            ((i, f"Usuário {i}", f"usuario{i}@exemplo.com", f"{i:011d}", senha_hash)
+             for i in range(inicio + 1, min(usuarios, inicio + lote) + 1)))
+
+    def despesas():
+        for user_id in range(1, usuarios + 1):
+            for _ in range(por_usuario):
+                data = datetime.date(rng.choice(ANOS), rng.randint(1, 12), rng.randint(1, 28))
+                yield (user_id, rng.choice(DESCRICOES), rng.randint(100, 50000), api.data_para_num(data))
+
+    gerador = despesas()
+    while True:
+        linhas = [linha for _, linha in zip(range(lote), gerador)]
+        if not linhas:
+            break
+        conn.executemany("INSERT INTO despesas (user_id, descricao, valor_centavos, data_num) VALUES (?, ?, ?, ?)",
+                         linhas)
+
+    conn.executemany(
+        "INSERT INTO metas (user_id, ano, mes, valor_centavos) VALUES (?, ?, ?, ?)",
+        ((user_id, 2025, mes, rng.randint(500, 5000) * 100)
+         for user_id in range(1, usuarios + 1) for mes in range(1, 13)))
+    api.reconstruir_totais(conn.cursor())
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.close()
+    os.replace(provisorio, caminho)
+
+
+# -------------------------
+# Cenário de cada rota
+# -------------------------
+class Cenario:
+    """
+    Gera as requisições de cada rota de forma determinística (mesma semente,
+    mesma sequência). As despesas do usuário u têm ids contíguos, então PUT e
+    DELETE apontam sempre para linhas existentes.
+    """
+
+    def __init__(self, usuarios, por_usuario, semente, tokens):
+        self.usuarios = usuarios
+        self.por_usuario = por_usuario
+        self.rng = random.Random(semente)
+        self.tokens = tokens
+        self.novos = 0
+        self.apagadas = 0
+
+    def usuario(self):
+        return self.rng.randint(1, self.usuarios)
+
+    def despesa(self):
+        return {"descricao": self.rng.choice(DESCRICOES), "valor": round(self.rng.uniform(1, 500), 2),
+                "data": f"2025-{self.rng.randint(1, 12):02d}-{self.rng.randint(1, 28):02d}"}
+
+    def requisicoes(self):
+        """Pares (nome da rota, função que devolve (método, caminho, corpo JSON, headers))."""
+        u = self.usuario
+
+        def post_despesa():
+            return "POST", "/despesas", {"user_id": u(), **self.despesa()}, None
+
+        def post_lote():
+            return "POST", f"/despesas/batch?user_id={u()}", [self.despesa() for _ in range(100)], None
+
+        def put_despesa():
+            user_id = u()
+            despesa_id = (user_id - 1) * self.por_usuario + self.rng.randint(1, self.por_usuario)
+            return "PUT", f"/despesas/{despesa_id}", {"user_id": user_id, "valor": 42.5}, None
+
+        def delete_despesa():
+            # Percorre as despesas na ordem dos ids, uma vez cada, espalhando entre usuários
+            n = self.apagadas
+            self.apagadas += 1
+            user_id = n % self.usuarios + 1
+            despesa_id = (user_id - 1) * self.por_usuario + n // self.usuarios % self.por_usuario + 1
+            return "DELETE", f"/despesas/{despesa_id}?user_id={user_id}", None, None
+
+        def register():
+            self.novos += 1
+            return "POST", "/register", {"nome": "Bench", "email": f"bench{self.novos}@exemplo.com",
+                                         "cpf": f"9{self.novos:010d}", "senha": SENHA}, None
+
+        def login():
+            user_id = u()
+            identificador = f"usuario{user_id}@exemplo.com" if user_id % 2 else f"{user_id:011d}"
+            return "POST", "/login", {"identificador": identificador, "senha": SENHA}, None
+
+        def abrir_app():
+            # As leituras que um cliente móvel faz ao abrir, numa só requisição
+            user_id, mes = u(), self.rng.randint(1, 12)
+            return "POST", "/batch", {"operacoes": [
+                {"path": f"/metas?user_id={user_id}"},
+                {"path": f"/metas/2025/{mes}?user_id={user_id}"},
+                {"path": f"/despesas/2025/{mes}?user_id={user_id}"},
+            ]}, None
+
+        def logout():
+            return "POST", "/logout", None, {"Authorization": f"Bearer {self.tokens.pop()}"}
+
+        return [
+            ("GET /despesas", lambda: ("GET", f"/despesas?user_id={u()}", None, None)),
+            ("GET /despesas ordem=data", lambda: ("GET", f"/despesas?user_id={u()}&ordem=data&data_inicio=2025-01-01", None, None)),
+            ("GET /despesas/busca", lambda: ("GET", f"/despesas/busca?user_id={u()}&q={self.rng.choice(DESCRICOES)[:4]}", None, None)),
+            ("GET /despesas/export", lambda: ("GET", f"/despesas/export?user_id={u()}", None, None)),
+            ("GET /despesas/resumo", lambda: ("GET", f"/despesas/resumo?user_id={u()}&top=5", None, None)),
+            ("GET /despesas/<ano>/<mes>", lambda: ("GET", f"/despesas/2025/{self.rng.randint(1, 12)}?user_id={u()}", None, None)),
+            ("GET /metas", lambda: ("GET", f"/metas?user_id={u()}", None, None)),
+            ("GET /metas/<ano>/<mes>", lambda: ("GET", f"/metas/2025/{self.rng.randint(1, 12)}?user_id={u()}", None, None)),
+            ("GET /metas/<ano>/<mes>/progresso", lambda: ("GET", f"/metas/2025/{self.rng.randint(1, 12)}/progresso?user_id={u()}", None, None)),
+            ("GET /sync", lambda: ("GET", f"/sync?user_id={u()}&since={self.rng.randint(0, 1000)}", None, None)),
+            ("GET /metrics", lambda: ("GET", "/metrics", None, None)),
+            ("POST /despesas", post_despesa),
+            ("POST /despesas/batch", post_lote),
+            ("PUT /despesas/<id>", put_despesa),
+            ("DELETE /despesas/<id>", delete_despesa),
+            ("POST /metas", lambda: ("POST", "/metas", {"user_id": u(), "ano": 2026, "mes": self.rng.randint(1, 12),
+                                                        "valor": 1000.0}, None)),
+            ("POST /batch", abrir_app),
+            ("POST /register", register),
+            ("POST /login", login),
+            ("POST /logout", logout),
+        ]
+
+
+# -------------------------
+# Execução
+# -------------------------
+def resumo(amostras, erros, duracao):
+    ordenadas = sorted(amostras)
+
+    def p(q):
+        return round(ordenadas[min(len(ordenadas) - 1, int(q * len(ordenadas)))] * 1000, 3)
+
+    return {"requisicoes": len(ordenadas), "erros": erros,
+            "vazao_rps": round(len(ordenadas) / duracao, 1) if duracao else None,
+            "p50_ms": p(0.50), "p95_ms": p(0.95), "p99_ms": p(0.99),
+            "media_ms": round(statistics.mean(ordenadas) * 1000, 3)}
+
+
+def medir_test_client(aplicacao, gerar, quantidade, aquecimento):
+    cliente = aplicacao.test_client()
+    amostras, erros = [], 0
+    for i in range(aquecimento + quantidade):
+        metodo, caminho, corpo, headers = gerar()
+        inicio = time.perf_counter()
+        r = cliente.open(caminho, method=metodo, json=corpo, headers=headers)
+        r.get_data()
+        decorrido = time.perf_counter() - inicio
+        r.close()
+        if i >= aquecimento:
+            amostras.append(decorrido)
+            erros += r.status_code >= 400
+    return amostras, erros
+
+
+def medir_http(porta, gerar, quantidade, aquecimento, clientes):
+    trava = threading.Lock()
+    restantes = [aquecimento + quantidade]
+    amostras, erros = [], [0]
+
+    def trabalhador():
+        conn = http.client.HTTPConnection("127.0.0.1", porta, timeout=60)
+        while True:
+            with trava:
+                if restantes[0] <= 0:
+                    break
+                restantes[0] -= 1
+                contar = restantes[0] < quantidade
+                metodo, caminho, corpo, headers = gerar()
+            headers = dict(headers or {})
+            dados = None
+            if corpo is not None:
+                dados = json.dumps(corpo).encode()
+                headers["Content-Type"] = "application/json"
+            inicio = time.perf_counter()
+            conn.request(metodo, caminho, body=dados, headers=headers)
+            r = conn.getresponse()
+            r.read()
+            decorrido = time.perf_counter() - inicio
+            if contar:
+                with trava:
+                    amostras.append(decorrido)
+                    erros[0] += r.status >= 400
+        conn.close()
+
+    with ThreadPoolExecutor(clientes) as executor:
+        for futuro in [executor.submit(trabalhador) for _ in range(clientes)]:
+            futuro.result()
+    return amostras, erros[0]
+
+
+# Scripts dos servidores; argumentos: raiz do projeto, config (JSON), porta, threads
+SERVIDORES = {
+    "waitress": """
+import json, logging, sys
+sys.path.insert(0, sys.argv[1])
+logging.getLogger("waitress.queue").setLevel(logging.ERROR)
+import app as api
+from waitress import serve
+serve(api.create_app(json.loads(sys.argv[2])), host="127.0.0.1", port=int(sys.argv[3]), threads=int(sys.argv[4]))
+""",
+    "asgi": """
+import json, os, sys
+sys.path.insert(0, sys.argv[1])
+os.environ["ASGI_WORKERS"] = sys.argv[4]
+import uvicorn
+from asgi import create_asgi_app
+uvicorn.run(create_asgi_app(json.loads(sys.argv[2])), host="127.0.0.1", port=int(sys.argv[3]),
+            log_level="warning", access_log=False)
+""",
+}
+PACOTES_SERVIDOR = {"waitress": "waitress", "asgi": "uvicorn"}
+
+
+def iniciar_servidor(modo, config, threads):
+    """Sobe o servidor num processo separado, para não disputar o GIL com os clientes."""
+    pacote = PACOTES_SERVIDOR[modo]
+    try:
+        __import__(pacote)
+    except ImportError:
+        sys.exit(f"--{modo} requer o pacote {pacote} (pip install {pacote})")
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        porta = s.getsockname()[1]
+    processo = subprocess.Popen([sys.executable, "-c", SERVIDORES[modo], RAIZ, json.dumps(config),
+                                 str(porta), str(threads)])
+    limite = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", porta), timeout=1).close()
+            return processo, porta
+        except OSError:
+            if processo.poll() is not None or time.monotonic() > limite:
+                processo.kill()
+                sys.exit(f"Servidor {modo} não iniciou")
+            time.sleep(0.05)
+
+
+def executar(args, base, modo):
+    trabalho = os.path.join(args.pasta, f"trabalho-{os.getpid()}-{modo}.db")
+    shutil.copyfile(base, trabalho)
+    config = {"DB_FILE": trabalho, "SWAGGER_MODO": "desligado", "SENHA_METODO": args.senha_metodo}
+    config.update(args.config)
+    # SECRET_KEY fixa para que os tokens emitidos aqui valham também no processo do Waitress
+    config.setdefault("SECRET_KEY", "bench")
+    aplicacao = api.create_app(config)
+    with aplicacao.app_context():
+        if aplicacao.config["DB_SHARDS"] > 1:
+            # A base sintética é montada sem sharding: distribui a cópia entre os shards
+            api.rebalancear_shards(aplicacao.config["DB_SHARDS"])
+        api.init_db()
+        quantidade_tokens = args.requisicoes + args.aquecimento
+        tokens = [api.emitir_token(i % args.usuarios + 1) for i in range(quantidade_tokens)]
+    cenario = Cenario(args.usuarios, args.despesas_por_usuario, args.semente, tokens)
+
+    servidor = porta = None
+    if modo != "test_client":
+        servidor, porta = iniciar_servidor(modo, config, args.threads)
+
+    resultados = []
+    try:
+        for nome, gerar in cenario.requisicoes():
+            if args.rotas and not any(f in nome for f in args.rotas):
+                continue
+            inicio = time.perf_counter()
+            if modo != "test_client":
+                amostras, erros = medir_http(porta, gerar, args.requisicoes, args.aquecimento, args.clientes)
+            else:
+                amostras, erros = medir_test_client(aplicacao, gerar, args.requisicoes, args.aquecimento)
+            # A vazão considera só a parte medida, descontando a proporção do aquecimento
+            duracao = (time.perf_counter() - inicio) * args.requisicoes / (args.requisicoes + args.aquecimento)
+            item = {"rota": nome, "modo": modo, **resumo(amostras, erros, duracao)}
+            resultados.append(item)
+            print(f"[{modo}] {nome:<36} p50={item['p50_ms']:>8}ms p99={item['p99_ms']:>8}ms "
+                  f"{item['vazao_rps']:>9} req/s erros={erros}", file=sys.stderr)
+    finally:
+        if servidor is not None:
+            servidor.terminate()
+            servidor.wait()
+        recursos = aplicacao.extensions["mvp"]
+        for nome in sorted(recursos, reverse=True):  # escritores antes dos pools
+            if nome.split(":")[0] in ("escritor", "pool"):
+                recursos.pop(nome).close()
+        for arquivo in glob.glob(glob.escape(os.path.splitext(trabalho)[0]) + "*"):
+            os.remove(arquivo)
+    return resultados
+
+
+def versao_git():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(anterior, atual):
+    """Tabela de p50/p99 e vazão do resultado anterior para o atual, por rota e modo."""
+    antes = {(r["rota"], r["modo"]): r for r in anterior["resultados"]}
+    print(f"{'rota':<36} {'modo':<12} {'p50 (ms)':>20} {'p99 (ms)':>20} {'req/s':>20}")
+    for r in atual["resultados"]:
+        a = antes.get((r["rota"], r["modo"]))
+        if a is None:
+            continue
+
+        def delta(campo):
+            variacao = (r[campo] - a[campo]) / a[campo] * 100 if a[campo] else 0.0
+            return f"{a[campo]}→{r[campo]} ({variacao:+.0f}%)"
+
+        print(f"{r['rota']:<36} {r['modo']:<12} {delta('p50_ms'):>20} {delta('p99_ms'):>20} "
+              f"{delta('vazao_rps'):>20}")
+
+
+def parse_config(pares):
+    config = {}
+    for par in pares:
+        chave, _, valor = par.partition("=")
+        try:
+            config[chave] = json.loads(valor)
+        except ValueError:
+            config[chave] = valor
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de todas as rotas da API")
+    parser.add_argument("--perfil", choices=sorted(PERFIS), help="Tamanho pré-definido da base")
+    parser.add_argument("--usuarios", type=int, default=1_000)
+    parser.add_argument("--despesas-por-usuario", type=int, default=10)
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--requisicoes", type=int, default=500, help="Requisições medidas por rota")
+    parser.add_argument("--aquecimento", type=int, default=50, help="Requisições descartadas por rota")
+    parser.add_argument("--rotas", help="Só as rotas cujo nome contém um destes textos (separados por vírgula)")
+    parser.add_argument("--waitress", action="store_true", help="Mede também por HTTP num Waitress local")
+    parser.add_argument("--asgi", action="store_true", help="Mede também por HTTP no uvicorn com asgi.py")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="Threads do Waitress / do executor do asgi.py")
+    parser.add_argument("--clientes", type=int, help="Conexões HTTP simultâneas (padrão: --threads)")
+    parser.add_argument("--senha-metodo", default="pbkdf2:sha256:1",
+                        help="SENHA_METODO da base e da aplicação (use o de produção para medir o KDF)")
+    parser.add_argument("--config", action="append", default=[], metavar="CHAVE=VALOR",
+                        help="Sobrescreve a configuração da aplicação (ex.: DB_MODO_WAL=true)")
+    parser.add_argument("--pasta", default=os.path.join(tempfile.gettempdir(), "mvp-bench"),
+                        help="Onde guardar as bases sintéticas")
+    parser.add_argument("--saida", help="Arquivo JSON de resultado (padrão: stdout)")
+    parser.add_argument("--comparar", help="Resultado anterior (JSON) para comparar com este")
+    args = parser.parse_args()
+    if args.perfil:
+        args.usuarios, args.despesas_por_usuario = PERFIS[args.perfil]
+    args.clientes = args.clientes or args.threads
+    args.rotas = [r.strip() for r in args.rotas.split(",")] if args.rotas else None
+    args.config = parse_config(args.config)
+    os.makedirs(args.pasta, exist_ok=True)
+
+    base = caminho_base(args.pasta, args.usuarios, args.despesas_por_usuario, args.semente)
+    if not os.path.exists(base):
+        print(f"Montando {base} ({args.usuarios * args.despesas_por_usuario} despesas)...", file=sys.stderr)
+        inicio = time.perf_counter()
+        construir_base(base, args.usuarios, args.despesas_por_usuario, args.semente, args.senha_metodo)
+        print(f"Base pronta em {time.perf_counter() - inicio:.1f}s", file=sys.stderr)
+
+    resultados = executar(args, base, "test_client")
+    if args.waitress:
+        resultados += executar(args, base, "waitress")
+    if args.asgi:
+        resultados += executar(args, base, "asgi")
+
+    saida = {
+        "benchmark": "endpoints",
+        "commit": versao_git(),
+        "data": datetime.datetime.now().isoformat(timespec="seconds"),
+        "ambiente": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                     "plataforma": platform.platform(), "cpus": os.cpu_count()},
+        "parametros": {"usuarios": args.usuarios, "despesas_por_usuario": args.despesas_por_usuario,
+                       "semente": args.semente, "requisicoes": args.requisicoes,
+                       "aquecimento": args.aquecimento, "threads": args.threads,
+                       "clientes": args.clientes,
+                       "senha_metodo": args.senha_metodo, "config": args.config},
+        "resultados": resultados,
+    }
+    texto = json.dumps(saida, indent=2, ensure_ascii=False)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            f.write(texto)
+    else:
+        print(texto)
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            comparar(json.load(f), saida)
+
+
+if __name__ == "__main__":
+    main()
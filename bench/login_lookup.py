@@ -0,0 +1,123 @@
+# bench/login_lookup.py
+# Mede a latência da busca de usuário no login conforme a tabela cresce.
+#
+# Compara a consulta antiga (email=? OR cpf=?) com a busca por uma única
+# coluna usada hoje em /login, em bases sintéticas de 1 mil a 1 milhão de
+# usuários. Opcionalmente mede também o POST /login completo pelo test client.
+#
+# Uso:
+#   python bench/login_lookup.py
+#   python bench/login_lookup.py --tamanhos 1000,10000 --consultas 5000 --http
+#   python bench/login_lookup.py --saida resultado.json
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentis(amostras):
+    ordenadas = sorted(amostras)
+
+    def p(q):
+        return ordenadas[min(len(ordenadas) - 1, int(q * len(ordenadas)))]
+
+    return {"p50_us": round(p(0.50) * 1e6, 2), "p95_us": round(p(0.95) * 1e6, 2),
+            "p99_us": round(p(0.99) * 1e6, 2), "media_us": round(statistics.mean(ordenadas) * 1e6, 2)}
+
+
+def crescer(conn, de, ate, senha_hash):
+    lote = 50_000
+    for inicio in range(de, ate, lote):
+        fim = min(ate, inicio + lote)
+        conn.executemany(
+            "INSERT INTO users (id, nome, email, cpf, senha) VALUES (?, ?, ?, ?, ?)",
+            ((i, f"Usuário {i}", f"usuario{i}@exemplo.com", f"{i:011d}", senha_hash)
+             for i in range(inicio + 1, fim + 1)))
+    conn.commit()
+
+
+def medir(conn, sql, parametros):
+    amostras = []
+    for args in parametros:
+        inicio = time.perf_counter()
+        conn.execute(sql, args).fetchone()
+        amostras.append(time.perf_counter() - inicio)
+    return percentis(amostras)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latência da busca de usuário no login")
+    parser.add_argument("--tamanhos", default="1000,10000,100000,1000000",
+                        help="Quantidades de usuários, separadas por vírgula")
+    parser.add_argument("--consultas", type=int, default=2000, help="Buscas por tamanho")
+    parser.add_argument("--http", action="store_true", help="Mede também POST /login completo")
+    parser.add_argument("--saida", help="Arquivo JSON de resultado (padrão: stdout)")
+    args = parser.parse_args()
+    tamanhos = sorted(int(t) for t in args.tamanhos.split(","))
+
+    pasta = tempfile.mkdtemp(prefix="bench-login-")
+    os.environ["DB_FILE"] = os.path.join(pasta, "login.db")
+    # Hash barato: o objetivo é medir a busca, não o custo do KDF
+    os.environ.setdefault("SENHA_METODO", "pbkdf2:sha256:1")
+    os.environ["LOGIN_CACHE_NEGATIVO_TTL"] = "0"
+    sys.path.insert(0, RAIZ)
+    import app as api
+
+    aplicacao = api.create_app({"SWAGGER_MODO": "desligado"})
+    with aplicacao.app_context():
+        api.init_db()
+
+    from werkzeug.security import generate_password_hash
+    senha_hash = generate_password_hash("senha", aplicacao.config["SENHA_METODO"])
+
+    conn = api.sqlite3.connect(aplicacao.config["DB_FILE"])
+    cliente = aplicacao.test_client() if args.http else None
+    rng = random.Random(42)
+    resultados = []
+    atual = 0
+    for tamanho in tamanhos:
+        crescer(conn, atual, tamanho, senha_hash)
+        atual = tamanho
+        ids = [rng.randint(1, tamanho) for _ in range(args.consultas)]
+        emails = [(f"usuario{i}@exemplo.com",) for i in ids]
+        cpfs = [(f"{i:011d}",) for i in ids]
+
+        item = {
+            "usuarios": tamanho,
+            "or_email": medir(conn, "SELECT id, nome, email, cpf, senha FROM users WHERE email=? OR cpf=?",
+                              [(e, e) for (e,) in emails]),
+            "or_cpf": medir(conn, "SELECT id, nome, email, cpf, senha FROM users WHERE email=? OR cpf=?",
+                            [(c, c) for (c,) in cpfs]),
+            "email": medir(conn, "SELECT id, nome, email, cpf, senha FROM users WHERE email=?", emails),
+            "cpf": medir(conn, "SELECT id, nome, email, cpf, senha FROM users WHERE cpf=?", cpfs),
+        }
+        if cliente is not None:
+            amostras = []
+            for (email,) in emails[:min(500, len(emails))]:
+                inicio = time.perf_counter()
+                r = cliente.post("/login", json={"identificador": email, "senha": "senha"})
+                amostras.append(time.perf_counter() - inicio)
+                assert r.status_code == 200, r.get_data(as_text=True)
+            item["http_login"] = percentis(amostras)
+        resultados.append(item)
+        print(f"{tamanho:>9} usuários: email p50={item['email']['p50_us']}us "
+              f"cpf p50={item['cpf']['p50_us']}us OR p50={item['or_email']['p50_us']}us",
+              file=sys.stderr)
+
+    saida = json.dumps({"benchmark": "login_lookup", "resultados": resultados}, indent=2)
+    if args.saida:
+        with open(args.saida, "w") as f:
+            f.write(saida)
+    else:
+        print(saida)
+
+
+if __name__ == "__main__":
+    main()
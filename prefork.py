@@ -0,0 +1,105 @@
+# prefork.py
+# Sobe vários processos Waitress atendendo o mesmo socket (pre-fork; só Linux/macOS).
+#
+#   DB_SHARDS=4 DB_MODO_WAL=1 python prefork.py --workers 4 --threads 8 --port 5000
+#
+# O processo principal cria/migra o banco, abre o socket e cria os workers com
+# fork; cada worker monta a própria aplicação (pools, escritor, caches) depois
+# do fork. Um worker que morre é recriado. SIGTERM/SIGINT encerram todos.
+# Com ARQUIVO_INTERVALO_S > 0, só o worker 0 (e o que o substituir) roda o
+# arquivamento periódico; o processo principal não roda.
+#
+# Cada processo tem memória própria: o cache de respostas vem desligado com
+# mais de um worker (CACHE_ATIVO=1 para forçar), e um logout só revoga o token
+# no worker que o atendeu até o token expirar (TOKEN_VALIDADE). Sem SECRET_KEY,
+# o processo principal sorteia uma antes do fork, comum a todos os workers.
+
+import argparse
+import os
+import secrets
+import signal
+import socket
+import sys
+import time
+
+from app import create_app, iniciar_arquivador, init_db
+
+
+def servir_worker(sock, threads, arquivador=False):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    from waitress import serve
+    app = create_app()
+    if arquivador:
+        iniciar_arquivador(app)
+    serve(app, sockets=[sock], threads=threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor Waitress com vários processos (pre-fork)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processos")
+    parser.add_argument("--threads", type=int, default=8, help="Threads do Waitress por processo")
+    args = parser.parse_args()
+    if not hasattr(os, "fork"):
+        sys.exit("prefork.py precisa de os.fork (use run_server.bat no Windows)")
+
+    if args.workers > 1:
+        # Invalidações do cache não chegam aos outros processos
+        os.environ.setdefault("CACHE_ATIVO", "0")
+    # Uma chave só para todos os workers: sem isso, cada um sortearia a sua e um
+    # token emitido por um worker seria recusado pelos outros
+    os.environ.setdefault("SECRET_KEY", secrets.token_hex(32))
+    with create_app().app_context():
+        init_db()
+
+    sock = socket.create_server((args.host, args.port), backlog=1024)
+    sock.set_inheritable(True)
+    workers = {}
+    parando = False
+
+    def iniciar(vaga):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                servir_worker(sock, args.threads, arquivador=vaga == 0)
+            finally:
+                os._exit(0)
+        workers[pid] = (time.monotonic(), vaga)
+
+    def parar(signum, frame):
+        nonlocal parando
+        parando = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, parar)
+    signal.signal(signal.SIGINT, parar)
+    for vaga in range(args.workers):
+        iniciar(vaga)
+    print(f"{args.workers} workers em http://{args.host}:{args.port} (pids {sorted(workers)})", file=sys.stderr)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        worker = workers.pop(pid, None)
+        if worker is None or parando:
+            continue
+        inicio, vaga = worker
+        print(f"Worker {pid} terminou (status {status}); recriando", file=sys.stderr)
+        if time.monotonic() - inicio < 1:
+            time.sleep(1)  # evita recriar em laço um worker que falha ao subir
+        iniciar(vaga)
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
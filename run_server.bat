@@ -2,8 +2,12 @@
 REM Ativa o virtualenv
 call venv\Scripts\activate
 
-REM Roda o app com Waitress
-python -m waitress --host=0.0.0.0 --port=5000 app:app
+REM Cria/migra o banco (passo explícito; importar o app não toca no banco)
+flask --app app init-db
+
+REM Roda o app com Waitress, servindo a spec pré-compilada em static\apispec.json
+set SWAGGER_MODO=estatico
+python -m waitress --host=0.0.0.0 --port=5000 --call app:create_app
 
 REM Pausa para ver erros
 pause
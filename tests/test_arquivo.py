@@ -0,0 +1,126 @@
+# Listagem de despesas antes e depois de arquivar_despesas(): a paginação por
+# id e por data, com filtros de data e valor, precisa devolver as mesmas
+# despesas com os meses pulados por meses_da_pagina.
+
+import random
+from datetime import datetime
+
+import pytest
+
+import app as api
+
+HOJE = datetime(2025, 6, 10)
+
+CONSULTAS = [
+    "",
+    "&ordem=data",
+    "&data_inicio=2024-03-15&data_fim=2024-11-02",
+    "&ordem=data&data_inicio=2024-03-15&data_fim=2024-11-02",
+    "&data_inicio=2023-12-31",
+    "&ordem=data&data_fim=2024-01-01",
+    "&valor_min=100&valor_max=500",
+    "&ordem=data&valor_min=300",
+    "&data_inicio=2023-06-01&valor_max=250",
+    "&ordem=data&data_inicio=2024-02-10&data_fim=2025-03-20&valor_min=50",
+]
+
+
+@pytest.fixture()
+def cliente(tmp_path):
+    app = api.create_app({
+        "DB_FILE": str(tmp_path / "dados.db"),
+        "SWAGGER_MODO": "desligado",
+        "SENHA_METODO": "pbkdf2:sha256:1",
+        "CACHE_ATIVO": False,
+    })
+    with app.app_context():
+        api.init_db()
+    return app, app.test_client()
+
+
+def criar_usuarios(client, quantidade=3, despesas=150):
+    """Usuários com despesas de 2023 a 2025, em lotes intercalados (ids de um mês não são contíguos)."""
+    rng = random.Random(7)
+    usuarios = []
+    for i in range(quantidade):
+        r = client.post("/register", json={"nome": "Teste", "email": f"u{i}@teste.com",
+                                           "cpf": f"{i:011d}", "senha": "segredo"})
+        assert r.status_code == 201, r.json
+        usuarios.append(r.json["user"]["id"])
+    for _ in range(despesas // 50):
+        for user_id in usuarios:
+            lote = [{
+                "descricao": rng.choice(["Mercado", "Uber", "Padaria", "Farmácia"]),
+                "valor": rng.randint(1, 99999) / 100,
+                "data": f"{rng.choice([2023, 2024, 2025])}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            } for _ in range(50)]
+            r = client.post(f"/despesas/batch?user_id={user_id}", json=lote)
+            assert r.status_code == 201, r.json
+    return usuarios
+
+
+def paginar(client, user_id, consulta, limite):
+    despesas, cursor = [], None
+    while True:
+        url = f"/despesas?user_id={user_id}&limit={limite}{consulta}"
+        if cursor:
+            url += f"&cursor={cursor}"
+        r = client.get(url)
+        assert r.status_code == 200, r.json
+        despesas += r.json["despesas"]
+        cursor = r.json["next_cursor"]
+        if not cursor:
+            return despesas
+
+
+def listagens(client, usuarios):
+    return {
+        (user_id, consulta, limite): paginar(client, user_id, consulta, limite)
+        for user_id in usuarios for consulta in CONSULTAS for limite in (1, 7, 50, 1000)
+    }
+
+
+def test_paginacao_igual_depois_de_arquivar(cliente):
+    app, client = cliente
+    usuarios = criar_usuarios(client)
+    antes = listagens(client, usuarios)
+
+    with app.app_context():
+        arquivadas = api.arquivar_despesas(6, HOJE)
+    assert arquivadas > 0
+    depois = listagens(client, usuarios)
+
+    for chave, despesas in antes.items():
+        assert depois[chave] == despesas, chave
+
+
+def test_paginacao_com_mes_arquivado_alterado(cliente):
+    # Despesa nova num mês arquivado fica na tabela até a próxima execução
+    app, client = cliente
+    usuarios = criar_usuarios(client, quantidade=1, despesas=100)
+    with app.app_context():
+        api.arquivar_despesas(6, HOJE)
+    user_id = usuarios[0]
+    r = client.post("/despesas", json={"user_id": user_id, "descricao": "Nova", "valor": 1.5,
+                                       "data": "2023-05-05"})
+    assert r.status_code == 201, r.json
+    antes = listagens(client, usuarios)
+
+    with app.app_context():
+        assert api.arquivar_despesas(6, HOJE) == 1
+    assert listagens(client, usuarios) == antes
+
+
+def test_meses_da_pagina_para_quando_completa():
+    # (ano, mes, geracao, quantidade, min_id, max_id)
+    meses = [(2023, 1, 10, 5, 1, 50), (2023, 2, 11, 5, 20, 60), (2023, 3, 12, 5, 70, 80), (2023, 4, 13, 5, 90, 99)]
+    assert api.meses_da_pagina(meses, "data", None, 5) == [(2023, 1, 10)]
+    # Em ordem de id, o mês 2 começa antes do fim do mês 1 e também entra
+    assert api.meses_da_pagina(meses, "id", None, 5) == [(2023, 1, 10), (2023, 2, 11)]
+    assert api.meses_da_pagina(meses, "id", 60, 5) == [(2023, 3, 12)]
+    assert api.meses_da_pagina(meses, "data", (20230301, 70), 5) == [(2023, 3, 12), (2023, 4, 13)]
+    # Filtros que cortam o mês não o contam como completo
+    assert api.meses_da_pagina(meses, "data", None, 5, inicio=20230115) == [
+        (2023, 1, 10), (2023, 2, 11)]
+    assert api.meses_da_pagina(meses, "data", None, 5, filtro_valor=True) == [m[:3] for m in meses]
+    assert api.meses_da_pagina(meses, "data", None, 5, inicio=20230301, fim=20230331) == [(2023, 3, 12)]
@@ -0,0 +1,148 @@
+# Tokens de sessão: emissão no /login, verificação pelo decorador autenticado,
+# revogação no /logout e AUTH_OBRIGATORIA.
+
+import time
+
+import pytest
+
+import app as api
+
+
+def criar(tmp_path, **config):
+    app = api.create_app({
+        "DB_FILE": str(tmp_path / "dados.db"),
+        "SWAGGER_MODO": "desligado",
+        "SENHA_METODO": "pbkdf2:sha256:1",
+        **config,
+    })
+    with app.app_context():
+        api.init_db()
+    return app.test_client()
+
+
+@pytest.fixture()
+def client(tmp_path):
+    return criar(tmp_path)
+
+
+def registrar(client, indice=0):
+    email = f"u{indice}@teste.com"
+    r = client.post("/register", json={"nome": "Teste", "email": email, "cpf": f"{indice:011d}", "senha": "segredo"})
+    assert r.status_code == 201, r.json
+    return r.json["user"]["id"], email
+
+
+def entrar(client, identificador, senha="segredo"):
+    r = client.post("/login", json={"identificador": identificador, "senha": senha})
+    assert r.status_code == 200, r.json
+    return {"Authorization": f"Bearer {r.json['token']}"}
+
+
+def test_login_emite_token_do_usuario(client):
+    user_id, email = registrar(client)
+    r = client.post("/login", json={"identificador": email, "senha": "segredo"})
+    assert r.status_code == 200
+    assert r.json["user"]["id"] == user_id
+    assert r.json["expira_em"] > 0
+
+    cabecalho = {"Authorization": f"Bearer {r.json['token']}"}
+    # Com token, o user_id pode ser omitido: vale o dono do token
+    r = client.post("/despesas", headers=cabecalho,
+                    json={"descricao": "Mercado", "valor": 10, "data": "2025-01-05"})
+    assert r.status_code == 201, r.json
+    assert r.json["despesa"]["user_id"] == user_id
+    assert len(client.get("/despesas", headers=cabecalho).json["despesas"]) == 1
+    assert client.get(f"/despesas?user_id={user_id}", headers=cabecalho).status_code == 200
+
+
+def test_senha_errada_nao_emite_token(client):
+    _, email = registrar(client)
+    r = client.post("/login", json={"identificador": email, "senha": "errada"})
+    assert r.status_code == 401
+    assert "token" not in r.json
+
+
+def test_token_invalido(client):
+    user_id, _ = registrar(client)
+    r = client.get(f"/despesas?user_id={user_id}", headers={"Authorization": "Bearer nao-e-um-token"})
+    assert r.status_code == 401
+    assert r.json == {"erro": "Token inválido"}
+
+
+def test_token_de_outra_chave(tmp_path):
+    # Token assinado com outra SECRET_KEY (outro processo sem chave compartilhada)
+    client = criar(tmp_path, SECRET_KEY="a")
+    user_id, email = registrar(client)
+    cabecalho = entrar(client, email)
+    outro = criar(tmp_path, SECRET_KEY="b")
+    assert outro.get(f"/despesas?user_id={user_id}", headers=cabecalho).status_code == 401
+    assert criar(tmp_path, SECRET_KEY="a").get(f"/despesas?user_id={user_id}", headers=cabecalho).status_code == 200
+
+
+def test_token_expirado(client, monkeypatch):
+    user_id, email = registrar(client)
+    cabecalho = entrar(client, email)
+    agora = time.time()
+    monkeypatch.setattr(time, "time", lambda: agora + 24 * 3600 + 60)
+    r = client.get(f"/despesas?user_id={user_id}", headers=cabecalho)
+    assert r.status_code == 401
+    assert r.json == {"erro": "Token expirado"}
+
+
+def test_logout_revoga_token(client):
+    user_id, email = registrar(client)
+    cabecalho = entrar(client, email)
+    outra_sessao = entrar(client, email)
+
+    assert client.post("/logout", headers=cabecalho).status_code == 200
+    for metodo, caminho in (("GET", f"/despesas?user_id={user_id}"), ("GET", "/metas"), ("POST", "/logout")):
+        r = client.open(caminho, method=metodo, headers=cabecalho)
+        assert r.status_code == 401, caminho
+        assert r.json == {"erro": "Token revogado"}
+    # Só o token do logout é revogado
+    assert client.get("/despesas", headers=outra_sessao).status_code == 200
+
+
+def test_logout_sem_token(client):
+    assert client.post("/logout").status_code == 401
+
+
+def test_token_de_outro_usuario(client):
+    user_id, email = registrar(client)
+    outro, _ = registrar(client, 1)
+    cabecalho = entrar(client, email)
+
+    pedidos = [
+        ("GET", f"/despesas?user_id={outro}", None),
+        ("GET", f"/metas/2025/1?user_id={outro}", None),
+        ("POST", "/despesas", {"user_id": outro, "descricao": "x", "valor": 1, "data": "2025-01-01"}),
+        ("POST", "/metas", {"user_id": outro, "ano": 2025, "mes": 1, "valor": 1}),
+        ("DELETE", f"/despesas/1?user_id={outro}", None),
+    ]
+    for metodo, caminho, corpo in pedidos:
+        r = client.open(caminho, method=metodo, headers=cabecalho, json=corpo)
+        assert r.status_code == 403, caminho
+        assert r.json == {"erro": "Token não pertence ao usuário informado"}
+    assert client.get(f"/despesas?user_id={outro}").json["despesas"] == []
+
+
+def test_auth_obrigatoria(tmp_path):
+    client = criar(tmp_path, AUTH_OBRIGATORIA=True)
+    user_id, email = registrar(client)
+
+    for metodo, caminho, corpo in (
+        ("GET", f"/despesas?user_id={user_id}", None),
+        ("POST", "/despesas", {"user_id": user_id, "descricao": "x", "valor": 1, "data": "2025-01-01"}),
+        ("GET", f"/metas?user_id={user_id}", None),
+        ("GET", f"/sync?user_id={user_id}", None),
+        ("POST", "/batch", {"operacoes": [{"method": "GET", "path": f"/metas?user_id={user_id}"}]}),
+    ):
+        r = client.open(caminho, method=metodo, json=corpo)
+        assert r.status_code == 401, caminho
+        assert r.json == {"erro": "Token de acesso ausente"}
+
+    cabecalho = entrar(client, email)
+    assert client.get(f"/despesas?user_id={user_id}", headers=cabecalho).status_code == 200
+    r = client.post("/batch", headers=cabecalho, json={"operacoes": [{"method": "GET", "path": "/metas"}]})
+    assert r.status_code == 200
+    assert r.json["respostas"][0]["status"] == 200
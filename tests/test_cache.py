@@ -0,0 +1,129 @@
+# Cache de respostas (ResponseCache/cache_resposta): ETag e If-None-Match, e
+# invalidação depois de cada escrita em /despesas e /metas. As respostas com
+# cache são comparadas às de uma segunda aplicação, sem cache, sobre o mesmo banco.
+
+import sqlite3
+
+import pytest
+
+import app as api
+
+URLS = [
+    "/despesas?user_id={u}",
+    "/despesas?user_id={u}&ordem=data&fields=id,valor",
+    "/despesas/2025/1?user_id={u}",
+    "/despesas/2025/2?user_id={u}",
+    "/despesas/resumo?user_id={u}&top=3",
+    "/despesas/busca?user_id={u}&q=merc",
+    "/metas?user_id={u}",
+    "/metas/2025/1?user_id={u}",
+    "/metas/2025/1/progresso?user_id={u}",
+    "/sync?user_id={u}",
+]
+
+
+@pytest.fixture()
+def clientes(tmp_path):
+    """(app com cache, cliente com cache, cliente sem cache), no mesmo arquivo de dados."""
+    config = {
+        "DB_FILE": str(tmp_path / "dados.db"),
+        "SWAGGER_MODO": "desligado",
+        "SENHA_METODO": "pbkdf2:sha256:1",
+    }
+    app = api.create_app({**config, "CACHE_ATIVO": True})
+    with app.app_context():
+        api.init_db()
+    referencia = api.create_app({**config, "CACHE_ATIVO": False})
+    return app, app.test_client(), referencia.test_client()
+
+
+def registrar(client, indice=0):
+    r = client.post("/register", json={"nome": "Teste", "email": f"u{indice}@teste.com",
+                                       "cpf": f"{indice:011d}", "senha": "segredo"})
+    assert r.status_code == 201, r.json
+    return r.json["user"]["id"]
+
+
+def conferir(client, referencia, user_id):
+    for url in URLS:
+        url = url.format(u=user_id)
+        assert client.get(url).json == referencia.get(url).json, url
+
+
+def test_etag_e_if_none_match(clientes):
+    app, client, _ = clientes
+    user_id = registrar(client)
+    client.post("/despesas", json={"user_id": user_id, "descricao": "Mercado", "valor": 10, "data": "2025-01-05"})
+    url = f"/despesas/2025/1?user_id={user_id}"
+
+    primeira = client.get(url)
+    assert primeira.status_code == 200
+    assert primeira.headers["Cache-Control"] == "private, no-cache"
+    etag = primeira.headers["ETag"]
+
+    repetida = client.get(url, headers={"If-None-Match": etag})
+    assert repetida.status_code == 304
+    assert repetida.data == b""
+    assert repetida.headers["ETag"] == etag
+    assert client.get(url, headers={"If-None-Match": '"outra"'}).status_code == 200
+
+    client.post("/despesas", json={"user_id": user_id, "descricao": "Uber", "valor": 5, "data": "2025-01-06"})
+    depois = client.get(url, headers={"If-None-Match": etag})
+    assert depois.status_code == 200
+    assert depois.headers["ETag"] != etag
+    assert depois.json["total"] == 15
+
+
+def test_resposta_vem_do_cache(clientes, tmp_path):
+    # Uma escrita direta no banco, sem passar pelas rotas, não invalida nada
+    app, client, referencia = clientes
+    user_id = registrar(client)
+    url = f"/despesas?user_id={user_id}"
+    assert client.get(url).json["despesas"] == []
+    with sqlite3.connect(tmp_path / "dados.db") as conn:
+        conn.execute("INSERT INTO despesas (user_id, descricao, valor_centavos, data_num) VALUES (?, 'x', 100, 20250101)",
+                     (user_id,))
+    assert client.get(url).json["despesas"] == []
+    assert len(referencia.get(url).json["despesas"]) == 1
+
+
+def test_invalidacao_depois_de_cada_escrita(clientes):
+    app, client, referencia = clientes
+    user_id = registrar(client)
+    outro = registrar(client, 1)
+    escritas = [
+        ("POST", "/despesas", {"user_id": user_id, "descricao": "Mercado", "valor": 10, "data": "2025-01-05"}),
+        ("POST", "/despesas", {"user_id": user_id, "descricao": "Mercearia", "valor": 7.5, "data": "2025-02-10"}),
+        ("POST", f"/despesas/batch?user_id={user_id}",
+         [{"descricao": "Uber", "valor": 3, "data": "2025-01-20"}, {"descricao": "Mercado", "valor": 4, "data": "2025-02-01"}]),
+        ("PUT", "/despesas/{primeira}", {"user_id": user_id, "descricao": "Padaria", "valor": 2}),
+        ("DELETE", "/despesas/{segunda}?user_id=" + str(user_id), None),
+        ("POST", "/metas", {"user_id": user_id, "ano": 2025, "mes": 1, "valor": 100}),
+        ("POST", "/metas", {"user_id": user_id, "ano": 2025, "mes": 1, "valor": 50}),
+        ("POST", "/metas", {"user_id": user_id, "ano": 2025, "mes": 2, "valor": 80}),
+    ]
+    ids = {}
+    for metodo, caminho, corpo in escritas:
+        conferir(client, referencia, user_id)
+        conferir(client, referencia, outro)
+        r = client.open(caminho.format(**ids), method=metodo, json=corpo)
+        assert r.status_code in (200, 201), (caminho, r.json)
+        if caminho == "/despesas":
+            ids["segunda" if "primeira" in ids else "primeira"] = r.json["despesa"]["id"]
+        conferir(client, referencia, user_id)
+        conferir(client, referencia, outro)
+
+
+def test_escrita_em_um_mes_nao_invalida_outro(clientes):
+    app, client, _ = clientes
+    user_id = registrar(client)
+    outro = registrar(client, 1)
+    client.post("/despesas", json={"user_id": user_id, "descricao": "Mercado", "valor": 10, "data": "2025-01-05"})
+    client.post("/metas", json={"user_id": user_id, "ano": 2025, "mes": 1, "valor": 100})
+    urls = [f"/despesas/2025/1?user_id={user_id}", f"/metas/2025/1?user_id={user_id}", f"/despesas?user_id={outro}"]
+    etags = {url: client.get(url).headers["ETag"] for url in urls}
+
+    client.post("/despesas", json={"user_id": user_id, "descricao": "Uber", "valor": 5, "data": "2025-02-05"})
+    client.post("/metas", json={"user_id": user_id, "ano": 2025, "mes": 2, "valor": 100})
+    for url, etag in etags.items():
+        assert client.get(url, headers={"If-None-Match": etag}).status_code == 304, url
@@ -0,0 +1,126 @@
+# POST /batch com transacao=true: uma operação que falha desfaz todas as
+# anteriores, também quando elas caem em shards diferentes, e o cache de
+# respostas só é invalidado depois do commit.
+
+import threading
+
+import pytest
+
+import app as api
+
+
+@pytest.fixture(params=[1, 3], ids=["um_arquivo", "tres_shards"])
+def cliente(request, tmp_path):
+    app = api.create_app({
+        "DB_FILE": str(tmp_path / "dados.db"),
+        "DB_SHARDS": request.param,
+        "SWAGGER_MODO": "desligado",
+        "SENHA_METODO": "pbkdf2:sha256:1",
+    })
+    with app.app_context():
+        api.init_db()
+    return app, app.test_client()
+
+
+def registrar(client, quantidade):
+    usuarios = []
+    for i in range(quantidade):
+        r = client.post("/register", json={"nome": "Teste", "email": f"u{i}@teste.com",
+                                           "cpf": f"{i:011d}", "senha": "segredo"})
+        assert r.status_code == 201, r.json
+        usuarios.append(r.json["user"]["id"])
+    return usuarios
+
+
+def operacoes_escrita(usuarios):
+    """Uma despesa e uma meta para cada usuário, em janeiro de 2025."""
+    operacoes = []
+    for user_id in usuarios:
+        operacoes.append({"method": "POST", "path": "/despesas",
+                          "body": {"user_id": user_id, "descricao": "Mercado", "valor": 10, "data": "2025-01-05"}})
+        operacoes.append({"method": "POST", "path": "/metas",
+                          "body": {"user_id": user_id, "ano": 2025, "mes": 1, "valor": 100}})
+    return operacoes
+
+
+def estado(client, user_id):
+    return (client.get(f"/despesas?user_id={user_id}").json["despesas"],
+            client.get(f"/metas?user_id={user_id}").json["metas"],
+            client.get(f"/despesas/2025/1?user_id={user_id}").json["total"])
+
+
+def test_falha_desfaz_todas_as_operacoes(cliente):
+    app, client = cliente
+    usuarios = registrar(client, 4)
+    if app.config["DB_SHARDS"] > 1:
+        shards = {api.shard_do_usuario(u, app.config["DB_SHARDS"]) for u in usuarios}
+        assert len(shards) > 1
+    antes = {u: estado(client, u) for u in usuarios}
+
+    operacoes = operacoes_escrita(usuarios)
+    operacoes.append({"method": "POST", "path": "/despesas", "body": {"user_id": usuarios[0], "descricao": "x"}})
+    operacoes.append({"method": "POST", "path": "/metas",
+                      "body": {"user_id": usuarios[1], "ano": 2025, "mes": 2, "valor": 1}})
+    r = client.post("/batch", json={"transacao": True, "operacoes": operacoes})
+
+    assert r.status_code == 207
+    assert r.json["confirmada"] is False
+    status = [resposta["status"] for resposta in r.json["respostas"]]
+    assert status == [201] * (2 * len(usuarios)) + [400, 424]
+    for user_id in usuarios:
+        assert estado(client, user_id) == antes[user_id]
+
+
+def test_sucesso_confirma_em_todos_os_shards(cliente):
+    app, client = cliente
+    usuarios = registrar(client, 4)
+    r = client.post("/batch", json={"transacao": True, "operacoes": operacoes_escrita(usuarios)})
+
+    assert r.status_code == 200
+    assert r.json["confirmada"] is True
+    for user_id in usuarios:
+        despesas, metas, total = estado(client, user_id)
+        assert [d["descricao"] for d in despesas] == ["Mercado"]
+        assert [m["valor"] for m in metas] == [100]
+        assert total == 10
+
+
+def test_sem_transacao_mantem_operacoes_anteriores(cliente):
+    app, client = cliente
+    (user_id,) = registrar(client, 1)
+    operacoes = operacoes_escrita([user_id])
+    operacoes.append({"method": "POST", "path": "/despesas", "body": {"user_id": user_id}})
+    r = client.post("/batch", json={"operacoes": operacoes})
+
+    assert r.status_code == 207
+    assert [resposta["status"] for resposta in r.json["respostas"]] == [201, 201, 400]
+    assert estado(client, user_id)[2] == 10
+
+
+def test_cache_invalidado_so_depois_do_commit(cliente, monkeypatch):
+    # Uma leitura concorrente logo depois de cada invalidação: se a invalidação
+    # viesse antes do commit, ela guardaria no cache o estado antigo
+    app, client = cliente
+    (user_id,) = registrar(client, 1)
+    urls = [f"/despesas?user_id={user_id}", f"/despesas/2025/1?user_id={user_id}", f"/metas?user_id={user_id}"]
+    for url in urls:
+        assert client.get(url).status_code == 200
+
+    invalidar = api.ResponseCache.invalidar
+    leituras = []
+
+    def invalidar_e_ler(self, *args):
+        invalidar(self, *args)
+        leitor = threading.Thread(target=lambda: leituras.extend(app.test_client().get(u).json for u in urls))
+        leitor.start()
+        leitor.join()
+
+    monkeypatch.setattr(api.ResponseCache, "invalidar", invalidar_e_ler)
+    r = client.post("/batch", json={"transacao": True, "operacoes": operacoes_escrita([user_id])})
+    assert r.json["confirmada"] is True
+    assert leituras
+
+    despesas, metas, total = estado(client, user_id)
+    assert [d["descricao"] for d in despesas] == ["Mercado"]
+    assert [m["valor"] for m in metas] == [100]
+    assert total == 10